@@ -0,0 +1,179 @@
+# coding=utf-8
+"""
+Benchmark of the calculator on the examples of the help page (form.example_dict()), each run through calc() with
+plain output ('ipud') and with LaTeX output.
+
+For every example and mode it reports the latency percentiles of calc(), the throughput, and the number of objects
+one calculation leaves allocated (with the peak of allocated memory on Python 3, from tracemalloc). Over all examples
+it reports the time spent in each stage of a request (see metrics.py), if the calculator was imported after this
+module or with PQCALC_METRICS set. Results are saved as a JSON baseline, and a later run fails if the median latency
+of an example grew by more than a threshold.
+
+Usage:
+  python benchmark.py --save baseline.json
+  python benchmark.py --baseline baseline.json --threshold 0.25
+
+By default the caches of the calculator are cleared before each calculation, so that every run scans, compiles and
+evaluates its input; with --warm the caches are kept and mostly their lookups are measured.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import io
+import json
+import sys
+from timeit import default_timer
+
+import metrics
+metrics.enable()  # for the stages of the calculator, which is imported next (in this process only)
+
+import calculator
+import quantities
+from form import example_dict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+modes = [("plain", 'ipud'), ("latex", False)]
+
+
+def clear_caches():
+    for cache in [calculator.line_cache, calculator.expression_cache, calculator.unit_clusters,
+                  quantities.literals, quantities.unit_layouts]:
+        cache.clear()
+
+
+def percentile(values, p):
+    """The p-th percentile (0 to 100) of a list of numbers, by linear interpolation"""
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    i = int(k)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (k - i)
+
+
+def allocations(commands, mob):
+    """
+    Runs one calculation to count the objects it leaves allocated (garbage-collected ones, e.g. in the caches) and,
+    on Python 3, the peak of memory allocated while it runs
+
+    :return: number of objects, peak in KiB (None on Python 2)
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        if tracemalloc is not None:
+            tracemalloc.start()
+        calculator.calc("", commands, mob)
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        return len(gc.get_objects()) - before, peak
+    finally:
+        gc.enable()
+
+
+def run(examples=None, repeat=20, warm=False):
+    """
+    :param examples: names of the examples to run (default: all)
+    :param repeat: number of timed calculations per example and mode
+    :param warm: keep the caches between calculations
+    :return: dictionary of results, with "examples" keyed by "name/mode" and "stages" keyed by stage
+    """
+    exdict = example_dict()
+    results = dict(python=sys.version.split()[0], repeat=repeat, warm=warm, examples={}, stages={})
+    metrics.reset()
+    for name in (examples or exdict):
+        commands = exdict[name]
+        for mode, mob in modes:
+            clear_caches()
+            objects, peak = allocations(commands, mob)
+            latencies = []
+            for i in range(repeat):
+                if not warm:
+                    clear_caches()
+                start = default_timer()
+                calculator.calc("", commands, mob)
+                latencies.append(default_timer() - start)
+            results["examples"]["%s/%s" % (name, mode)] = dict(
+                p50=percentile(latencies, 50), p90=percentile(latencies, 90), p99=percentile(latencies, 99),
+                per_second=len(latencies) / sum(latencies), objects=objects, peak_kb=peak)
+    for stage, h in metrics.stages.items():
+        if h.count:
+            results["stages"][stage] = dict(calls=h.count, seconds=h.total, mean=h.total / h.count,
+                                            per_second=h.count / h.total if h.total else None)
+    return results
+
+
+def regressions(results, baseline, threshold=0.25):
+    """
+    :param threshold: allowed relative growth of the median latency, e.g. 0.25 for 25%
+    :return: list of (example/mode, baseline median, median) for the examples that got slower than allowed
+    """
+    slower = []
+    for key, new in sorted(results["examples"].items()):
+        old = baseline["examples"].get(key)
+        if old is not None and new["p50"] > old["p50"] * (1 + threshold):
+            slower.append((key, old["p50"], new["p50"]))
+    return slower
+
+
+def report(results):
+    lines = ["%-32s %9s %9s %9s %8s %8s %8s" % ("example/mode", "p50 ms", "p90 ms", "p99 ms", "per s", "objects",
+                                                "peak KiB")]
+    for key, r in sorted(results["examples"].items()):
+        lines.append("%-32s %9.3f %9.3f %9.3f %8.0f %8d %8s" % (
+            key[:32], r["p50"] * 1000, r["p90"] * 1000, r["p99"] * 1000, r["per_second"], r["objects"],
+            "%.0f" % r["peak_kb"] if r["peak_kb"] is not None else "-"))
+    lines.append("")
+    lines.append("%-32s %9s %9s %9s" % ("stage", "calls", "mean ms", "total s"))
+    if not results["stages"]:
+        lines.append("(stages not timed: the calculator was imported before benchmark.py without PQCALC_METRICS)")
+    for stage, s in sorted(results["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        lines.append("%-32s %9d %9.3f %9.3f" % (stage, s["calls"], s["mean"] * 1000, s["seconds"]))
+    return "\n".join(lines)
+
+
+def show(text):
+    """Prints text as UTF-8, also to a pipe on Python 2"""
+    print(text.encode("utf-8") if sys.version_info[0] < 3 else text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark calc() on the examples of the help page")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calculations per example and mode")
+    parser.add_argument("--warm", action="store_true", help="keep the caches between calculations")
+    parser.add_argument("--example", action="append", help="run only this example (may be given several times)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed growth of median latency (0.25: 25%%)")
+    args = parser.parse_args(argv)
+    results = run(args.example, args.repeat, args.warm)
+    show(report(results))
+    if args.save:
+        text = json.dumps(results, indent=1, sort_keys=True, ensure_ascii=False)
+        with io.open(args.save, "w", encoding="utf-8") as f:
+            f.write(text.decode("utf-8") if isinstance(text, bytes) else text)
+    if args.baseline:
+        with io.open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        for key, old, new in slower:
+            show("REGRESSION %s: median %.3f ms, baseline %.3f ms" % (key, new * 1000, old * 1000))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,21 +15,24 @@ Call hierarchy:
         class State(OrderedDict):
         classify_input(a, state):
 
-        check_name(sym, state):
-        interpret(t, state):
-            scan(t):
-                identifier(scanner, token):
-                operator(scanner, token):
-                float2(scanner, token):
-                comment(scanner, token):
-            make_paired_tokens(raw_tokens):
-                fixoperator(operator, tokens):
-            create_Python_expression(paired_tokens, state):
-                interpret_N_U_cluster(quant, orig_paired):
-                magic(numberstring):
-            eval(expression)
-        register_result(result0, sym, state):
-        show_work(result, sym, flags, error=False, addon="", skipsteps=False):
+        calculate(name, expression, state):
+            check_name(sym, state):
+            fingerprint(q):
+            definition(sym, state):
+            interpret(t, state):
+                compiled(t, flags):
+                    lex(t):  (does the work of scan(t) and make_paired_tokens(raw_tokens))
+                        fixoperator(operator, tokens):
+                        append_paired(tokens, ttype, operator, ttext):
+                    compile_expression(paired_tokens, flags):
+                        interpret_N_U_cluster(first, paired, complaint, start=0):
+                            unit_factor(unitstr, quantstr):
+                        magic(numberstring):
+                CompiledExpression.evaluate(state)
+            register_result(result0, sym, state):
+            show_work(result, sym, flags, error=False, addon="", skipsteps=False):
+            show_montecarlo(result, state):
+            show_budget(q, state):
 
         comments(line):
         convert_units(input_type, command, quant, units, state):
@@ -41,6 +44,10 @@ Call hierarchy:
         change_flag(flags, name, expression):
         deal_with_errors(err, a, state):
 
+    sweep(commands, inputs, memory=None):
+        sweep_column(sym, q, points):
+    sweep_table(columns):
+
 
 """
 
@@ -50,32 +57,39 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import quantities
 from quantities import Q, Units, QuantError, latex_name, unitquant
-from re import Scanner, UNICODE, match
-from form import exdict
+from re import Scanner, UNICODE, match, compile as compile_re
 from fractions import Fraction
+from itertools import islice
+from lrucache import LRUCache
+import metrics
+import montecarlo
+import statecodec
 
 class CalcError(ArithmeticError): pass
 
 
+@metrics.timed("calc")
 def calc(memory, commands, mob):
     '''
 
-    :param memory: quantities already defined, given as repr()s line by line in a string
+    :param memory: quantities already defined, as written by statecodec.encode() (or as repr()s line by line),
+                   or a State kept on the server (see sessions.py), in which case no memory is returned
     :param commands: string of user input specifying math operations to define new quantities
     :param mob: device the output will be sent to (determines format)
     :return: everything needed to show the result in a browser and keep state for the next calculation
     '''
-    state = State(memory, mob)
+    if isinstance(memory, State):
+        state = memory
+        state.start_request()
+    else:
+        state = State(memory, mob)
     command_list = commands.replace('\r', '').split("\n")
     try:
         for command in command_list:
             #print ("%s" % command)
             input_type, name, expression = classify_input(command, state)
             if input_type == Calculation:
-                name = check_name(name, state)
-                quantity = interpret(expression, state)
-                state.printwork(show_work(quantity, name, state.flags))
-                register_result(quantity, name, state)
+                calculate(name, expression, state)
             elif input_type == Comment:
                 create_comment(command, state)
             elif input_type in [ConversionUsing, ConversionIn]:
@@ -86,21 +100,92 @@ def calc(memory, commands, mob):
             state.log_input(command)
     except (CalcError, OverflowError, QuantError) as err:
         deal_with_errors(err, command, state)
-    return state.export()
+    return state.export(with_memory=(state is not memory))
     # return output, logput, memory, known, mob, oneline, linespace
 
 
+def sweep(commands, inputs, memory=None):
+    '''
+    Evaluates a worksheet for many values of some of its inputs at once, e.g. for T from 273 K to 373 K.
+
+    Each calculation is compiled once and evaluated on arrays holding all the points (see quantities.QArray) instead of
+    calling calc() for every point. Lines defining one of the inputs are skipped, and "using" sets the units shown in
+    the table. There is no output besides the table.
+
+    :param commands: string of user input, as for calc()
+    :param inputs: dictionary of names and their values as QArray, all of the same length
+    :param memory: quantities already defined, as for calc()
+    :return: list of (name, units, values, uncertainties) for each quantity, the values and uncertainties as arrays in
+             the units given as text
+    :raise CalcError, QuantError: for input calc() would complain about
+    '''
+    state = State(memory)
+    points = 1
+    for sym in inputs:
+        q = inputs[sym]
+        state[sym] = quantities.QArray(q.number, sym, q.units, q.uncert, q.prefu)
+        points = max(points, q.number.size)
+    for command in commands.replace('\r', '').split("\n"):
+        input_type, name, expression = classify_input(command, state)
+        if input_type == Calculation:
+            sym = check_name(name, state)
+            if sym not in inputs:
+                q = interpret(expression, state)
+                state[sym] = type(q)(q.number, sym, q.units, q.uncert, q.prefu)
+        elif input_type == ConversionUsing:
+            prefu = expression.split()
+            if name not in state or any(p not in unitquant for p in prefu):
+                raise CalcError("Can't show %s using %s" % (name, expression))
+            q = state[name]
+            state[name] = type(q)(q.number, q.name, q.units, q.uncert, prefu)
+        elif input_type == Flags:
+            change_flag(state.flags, name, expression)
+    return [sweep_column(sym, state[sym], points) for sym in state]
+
+
+def sweep_column(sym, q, points):
+    """
+    :param sym: name of the quantity
+    :param q: Q() or QArray with the given number of points
+    :return: the name, units, values and uncertainties as for sweep()
+    """
+    numpy = quantities.numpy
+    number = numpy.broadcast_to(numpy.asarray(q.number, dtype=float), (points,))
+    uncert = numpy.broadcast_to(numpy.asarray(q.uncert, dtype=float), (points,))
+    value, poslist, neglist = quantities.unit_string(number, q.units, q.prefu)
+    magnitude = abs(number).max()
+    if magnitude:
+        uncert = uncert * (abs(value).max() / magnitude)
+    return sym, quantities.unit_text(poslist, neglist), value, uncert
+
+
+def sweep_table(columns):
+    """
+    :param columns: result of sweep()
+    :return: lines of tab-separated text, a header with names and units followed by one row for each point
+    """
+    lines = ["\t".join("%s (%s)" % (sym, units) if units else sym for sym, units, values, uncerts in columns)]
+    for row in zip(*[zip(values, uncerts) for sym, units, values, uncerts in columns]):
+        lines.append("\t".join(quantities.ascii_number(v, quantities.sigfig(v, u), u) for v, u in row))
+    return lines
+
+
 from collections import OrderedDict
 
 
 class State(OrderedDict):
+    @metrics.timed("state")
     def __init__(self, memory=None, mob=None):
         """
-        Loads quantities from previous calculations by evaluating their repr()s
+        Loads quantities from previous calculations, either decoding memory written by export() or, for memory
+        from older versions, reading their repr()s (see statecodec.decode_legacy)
 
-        :param memory: String of repr()s
-        :stores OrderedDict of symbols, output, logput
+        :param memory: String from statecodec.encode() or string of repr()s
+        :stores OrderedDict of symbols, output, logput, and the highest version of each name that the sensitivities
+                of the quantities stored so far refer to (see definition())
         """
+        self.changed = set()
+        self.versions = {}
         OrderedDict.__init__(self)
         self.flags = set()
         self.output = []
@@ -110,13 +195,31 @@ class State(OrderedDict):
         if mob == 'ipud':
             self.flags.add('plain math')
         if memory:
-            old = memory.replace('\r', '').split('\n')
-            for a in old:
-                if a.startswith('__'):
-                    self.flags.add(a)
+            try:
+                if statecodec.is_encoded(memory):
+                    symbols, flags = statecodec.decode(memory)
                 else:
-                    sym = a.split("'")[1]
-                    self[sym] = eval(a)
+                    symbols, flags = statecodec.decode_legacy(memory)
+            except statecodec.CodecError as err:
+                self.printit('<div style="color: red;">Warning: quantities from earlier calculations were lost (%s)</div><br>' % err)
+            else:
+                self.flags.update(flags)
+                for sym, q in symbols:
+                    self[sym] = q
+        self.changed.clear()
+
+    def __setitem__(self, sym, q):
+        OrderedDict.__setitem__(self, sym, q)
+        self.changed.add(sym)
+        for key in q.sensitivity or ():
+            if isinstance(key, tuple) and key[1] > self.versions.get(key[0], 0):
+                self.versions[key[0]] = key[1]
+
+    def start_request(self):
+        """Clears output and input log of a State that is reused for another request"""
+        self.output = []
+        self.logput = []
+        self.good_input = []
 
     def printit(self, str):
         self.output.append(str)
@@ -135,12 +238,11 @@ class State(OrderedDict):
     def log_input(self, inp):
         self.good_input.append(inp)
 
-    def export(self):
+    @metrics.timed("export")
+    def export(self, with_memory=True):
         if self.output and not self.output[-1].endswith("<hr>"):
             self.output = ["<hr>"] + self.output
-        memory = [self[s].__repr__() for s in self]
-        flags = [f for f in self.flags]
-        memory.extend(flags)
+        memory = [statecodec.encode(self, self.flags)] if with_memory else []
         known = [s + " = " + self[s].__str__() for s in self]
         oneline = ("__oneline__" in self.flags)
         if "__latex__" in self.flags:
@@ -208,6 +310,74 @@ def classify_input(a, state):
 Empty, Calculation, ConversionIn, ConversionUsing, Comment, Flags = range(6)
 
 
+def calculate(name, expression, state):
+    '''
+    Calculates a new quantity, shows the work and registers the result. A line that was calculated before (by
+    any user) with the same values for every symbol it references is not evaluated again; its result and output are
+    taken from line_cache instead. The symbols come from the identifier tokens of the compiled expression, so they are
+    the edges of the dependency graph of the worksheet: after a change of one input, e.g. T = 298 K, only the lines
+    downstream of T are re-evaluated and passed through show_work() again.
+
+    :param name: name of the new quantity
+    :param expression: the expression to evaluate
+    :param state: contains known quantities as ordered dict, along with flags and output
+    '''
+    sym = check_name(name, state)
+    expression = expression.strip()
+    try:
+        symbols = compiled(expression, state.flags).symbols
+        key = (definition(sym, state), expression, frozenset(state.flags),
+               tuple(fingerprint(state.get(s)) for p, s in symbols))
+    except (SyntaxError, OverflowError, AttributeError):
+        key = None  # interpret() reports the error
+    cached = line_cache.get(key) if key is not None else None
+    if cached is not None:
+        result, output, logput = cached
+        state.output.extend(output)
+        state.logput.extend(logput)
+        state[sym] = result
+        return
+    start, logstart = len(state.output), len(state.logput)
+    quantity = interpret(expression, state)
+    if '__correlated__' in state.flags and quantity.sensitivity and not quantities.is_array(quantity.number):
+        quantity = Q._make(quantity.number, quantity.name, quantity.units, quantities.correlated_uncert(quantity),
+                           quantity.prefu, quantity.provenance, quantity.sensitivity)
+    state.printwork(show_work(quantity, sym, state.flags))
+    if '__montecarlo__' in state.flags:
+        show_montecarlo(quantity, state)
+    if quantity.name == "budget(%s)":
+        show_budget(quantity.provenance[0], state)
+    register_result(quantity, sym, state)
+    if key is not None:
+        line_cache.put(key, (state[sym], state.output[start:], state.logput[logstart:]))
+
+
+def fingerprint(q):
+    """Everything about a known quantity that can change the result or the output of a calculation using it"""
+    if q is None:
+        return None
+    sensitivity = tuple(sorted(q.sensitivity.items())) if q.sensitivity is not None else None
+    return q.number, type(q.number), q.units, q.uncert, q.prefu, sensitivity
+
+
+def definition(sym, state):
+    """
+    The key of the quantity about to be known as sym among the inputs of other quantities (see
+    quantities.sensitivities): (sym, 0) for a new name, or, for a name that is defined again, a version that none of
+    the known quantities refers to yet
+
+    :param sym: name of the quantity
+    :param state: contains known quantities as ordered dict, along with flags and output
+    :return: (sym, version)
+    """
+    if sym not in state:
+        return sym, 0
+    return sym, state.versions.get(sym, 0) + 1
+
+
+line_cache = LRUCache(2048)
+
+
 def check_name(sym, state):
     '''
     Check whether the name chosen for a quantity conforms to the rules and doesn't clash with a name already used
@@ -241,8 +411,8 @@ def interpret(t, state):
     '''
     Process input mathematical expression into a valid Python expression and return the result of evaluating it. This is
     a four step process. First, the string is broken into tokens by scan(), then grouped into pairs of operators and
-    values by make_paired_tokens(), then turned into a valid Python expression by create_Python_expression, and finally
-    evaluated with eval() to yield a quantity Q().
+    values by make_paired_tokens(), then compiled by compile_expression(), and finally evaluated with the known
+    quantities bound to its symbols to yield a quantity Q().
 
     :param t: the expression as string
     :param state: contains known quantities as ordered dict, along with flags and output
@@ -295,15 +465,19 @@ def interpret(t, state):
     Q(5.0, '%s * %s', Units(), 0.2, set([]), (Q(2.0, units=Units(), uncert=0.0), Q(2.5, 'a', Units(), 0.1)))
     '''
 
-    paired = make_paired_tokens(scan(t))
     try:
-        expression = create_Python_expression(paired, state)
-        q = eval(expression)
-################ EVAL EVAl EVAL #######################
-        if type(q) != Q:
-            print(expression)
+        expression = compiled(t, state.flags)
+        q = expression.evaluate(state)
+        if not isinstance(q, Q):
+            print(expression.source)
             print(q)
-            raise CalcError('<div style="color: red;">misused comma? %s</div><br>' % expression)
+            raise CalcError('<div style="color: red;">misused comma? %s</div><br>' % t)
+        if quantities.provenance_size(q, max_provenance) > max_provenance:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Too many steps: more than %d quantities calculated '
+                            'in one line</div><br>' % (t, max_provenance))
+        if quantities.provenance_depth(q) > max_provenance_depth:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Too many steps: more than %d operations in a '
+                            'row</div><br>' % (t, max_provenance_depth))
         return q
     except SyntaxError as err:
         raise CalcError('<br>%s<br><br><div style="color: red;">Mangled math: %s</div><br>' % (t, err))
@@ -313,6 +487,64 @@ def interpret(t, state):
         raise CalcError('<br>%s<br><br><div style="color: red;">Comma again?: %s</div><br>' % (t, duh))
 
 
+def compiled(t, flags):
+    """
+    Look up the compiled form of an expression in expression_cache, compiling it if it is not there yet.
+
+    The key is the stripped expression text together with the flags that change how it is compiled, so identical
+    lines entered by different users (or in different requests) are scanned and compiled only once.
+
+    :param t: the expression as string
+    :param flags: switches of the current state
+    :return: a CompiledExpression
+    """
+    t = t.strip()
+    key = (t, '__tutor__' in flags, '__showuncert__' in flags)
+    expression = expression_cache.get(key)
+    if expression is None:
+        tokens = lex(t)
+        check_budget(tokens, t)
+        expression = compile_expression(tokens, flags)
+        expression_cache.put(key, expression)
+    return expression
+
+
+expression_cache = LRUCache(4096)
+
+max_tokens = 2000  # paired tokens in one line
+max_token_length = 1000  # characters of a number, unit or name (Python 2 takes quadratic time to read long numbers)
+max_nesting = 50  # parentheses inside each other (Python 2 can't compile an expression nested about 100 deep)
+max_provenance = 5000  # quantities calculated in one line
+max_provenance_depth = 200  # operations in a row in one line (showing the work recurses through them)
+
+
+def check_budget(tokens, t):
+    """
+    Rejects a line that would tie up the server for long, before it is compiled
+
+    :param tokens: paired tokens of the line, from lex()
+    :param t: the line as string
+    :raise CalcError: if the line has too many tokens, too long a token or parentheses nested too deep
+    """
+    if len(tokens) > max_tokens:
+        raise CalcError('<br>%s<br><br><div style="color: red;">Too long: %d terms (at most %d in one line)</div><br>' %
+                        (t, len(tokens), max_tokens))
+    depth = deepest = 0
+    for ttype, operator, ttext in tokens:
+        if len(ttext) > max_token_length:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Too long: %s... (at most %d characters)</div><br>' %
+                            (t, ttext[:20], max_token_length))
+        for c in operator:
+            if c == "(":
+                depth += 1
+                deepest = max(depth, deepest)
+            elif c == ")":
+                depth -= 1
+    if deepest > max_nesting:
+        raise CalcError('<br>%s<br><br><div style="color: red;">Too deeply nested: %d parentheses (at most %d)</div><br>'
+                        % (t, deepest, max_nesting))
+
+
 def scan(t):
     '''
     Scan text for identifers('I'), operators('O'), numbers('N') and comments('C') using the regular expression scanner.
@@ -394,6 +626,87 @@ identifier: has to start with non-operator non-digit, may have something in brac
 identifier: anything in brackets followed by anything
 """
 
+lexer = compile_re(r"(?P<C>[#!].*)|(?P<O>[ ,()/*^+-]+)|(?P<N>((\d*\.\d+)|(\d+\.?))(\(\d\d?\))?([Ee][+-]?\d+)?)|(?P<I>%s)"
+                   % re_identifier, UNICODE)
+function_names = frozenset(quantities.functions)
+
+
+@metrics.timed("lex")
+def lex(t):
+    '''
+    Does the work of scan() and make_paired_tokens() (including fixfractions()) in a single pass over the text: the
+    tokens of one regular expression are classified as they are matched, units and functions by a set lookup, and
+    paired with the operator in front of them right away.
+
+    :param t: string of the expression to be parsed
+    :return: a list of paired tokens (item ID, pre-operator, item text), same as make_paired_tokens(scan(t))
+
+    >>> lex('3 mol/L')
+    [[u'N', u'*', u'3'], [u'U', u'*', u'mol'], [u'U', u'/', u'L'], [u'Z', u'*', u'']]
+    '''
+    t = t + " "
+    tokens = []
+    operator = None
+    paren = 0
+    misplaced = None
+    pos = 0
+    end = len(t)
+    while pos < end:
+        m = lexer.match(t, pos)
+        if m is None:
+            raise CalcError("got stuck on |%s| (character %d)" % (t[pos:], pos + 1))
+        ttype = m.lastgroup
+        ttext = m.group().strip()
+        if ttype == "O":
+            for i, c in enumerate(m.group()):
+                if c == "(":
+                    paren += 1
+                elif c == ")":
+                    if not paren and misplaced is None:
+                        misplaced = pos + i + 1
+                    paren -= 1
+            operator = ttext or "*"
+            for c in operator:
+                if c in "+-*/^,":
+                    break
+            else:
+                operator = fixoperator(operator, tokens)
+            pos = m.end()
+            continue
+        if ttype == "C":  # the operator in front of a comment is kept as it is (make_paired_tokens() does the same)
+            break
+        if ttype == "I":
+            if ttext.endswith("Ohm") and ttext.replace("Ohm", "Ω") in quantities.unitquant:
+                ttext = ttext.replace("Ohm", "Ω")
+            if ttext in quantities.unitquant:
+                if ttext.startswith("u"):
+                    ttext = "μ" + ttext[1:]
+                ttype = "U"
+            elif ttext in function_names:
+                ttype = "F"
+        append_paired(tokens, ttype, "*" if operator is None else operator.replace("^", "**"), ttext)
+        operator = None
+        pos = m.end()
+    if misplaced is not None:
+        raise CalcError("Closing parenthesis ')' (character %d) is missing a matching opening one '(' to the left of it"
+                        % misplaced)
+    if paren:
+        raise CalcError("Parentheses don't match: need %d more ')'" % paren)
+    if ttype != "C" and operator is not None:
+        operator = operator.replace("^", "**")
+    append_paired(tokens, "Z", "*" if operator is None else operator, "")
+    return tokens
+
+
+def append_paired(tokens, ttype, operator, ttext):
+    """Appends a paired token, folding a fraction of integers in parentheses, e.g. (1/2), into one number"""
+    if (len(tokens) > 1 and tokens[-2][0] == 'N' and tokens[-1][0] == 'N' and tokens[-2][1].endswith('(') and
+            operator.startswith(')') and tokens[-1][1] == '/' and '.' not in tokens[-2][2] and
+            '.' not in tokens[-1][2] and int(tokens[-1][2]) != 0):
+        denominator, numerator = tokens.pop(), tokens.pop()
+        tokens.append(['N', numerator[1], '%s / %s' % (numerator[2], denominator[2])])
+    tokens.append([ttype, operator, ttext])
+
 
 def make_paired_tokens(raw_tokens):
     '''
@@ -450,16 +763,17 @@ def make_paired_tokens(raw_tokens):
 
 def fixfractions(tokens):
     newtokens = []
-    while tokens:
+    i = 0
+    while i < len(tokens):
         # ['N','...(','integer'],['N','/','integer'],['...',')','...]
-        if (len(tokens) > 2 and tokens[0][0] == 'N' and tokens[1][0] == 'N' and tokens[0][1].endswith('(') and tokens[2][1].startswith(')') and tokens[1][1] == '/' and
-            '.' not in tokens[0][2] and '.' not in tokens[1][2] and int(tokens[1][2]) != 0):
-                fractoken = ['N', tokens[0][1], '%s / %s' % (tokens[0][2], tokens[1][2])]
-                newtokens.append(fractoken)
-                tokens.pop(0)
-                tokens.pop(0)
+        if (len(tokens) > i + 2 and tokens[i][0] == 'N' and tokens[i + 1][0] == 'N' and tokens[i][1].endswith('(') and
+                tokens[i + 2][1].startswith(')') and tokens[i + 1][1] == '/' and
+                '.' not in tokens[i][2] and '.' not in tokens[i + 1][2] and int(tokens[i + 1][2]) != 0):
+            newtokens.append(['N', tokens[i][1], '%s / %s' % (tokens[i][2], tokens[i + 1][2])])
+            i += 2
         else:
-            newtokens.append(tokens.pop(0))
+            newtokens.append(tokens[i])
+            i += 1
     return newtokens
 
 
@@ -490,43 +804,76 @@ def fixoperator(operator, tokens):
     return operator[:i + 1] + "*" + operator[i + 1:]
 
 
-def create_Python_expression(paired_tokens, state):
+class CompiledExpression(object):
+    """
+    A user expression compiled to Python bytecode. Symbols are not spliced into the source as repr()s but bound by
+    name to the live quantities in the state when the expression is evaluated. Numbers and units are evaluated once
+    at compile time and bound as constants.
+
+    Attributes:
+      source(str): the Python source, with placeholders s0, s1, ... for symbols and c0, c1, ... for constants
+      code: the compiled source
+      symbols(list): pairs (placeholder, symbol name)
+      constants(dict): quantities Q() keyed by placeholder
+    """
+
+    def __init__(self, source, symbols, constants):
+        self.source = source
+        self.code = compile(source, '<pqcalc>', 'eval')
+        self.symbols = symbols
+        self.constants = constants
+
+    @metrics.timed("evaluate")
+    def evaluate(self, state):
+        """
+        :param state: contains known quantities as ordered dict, along with flags and output
+        :return: the value of the expression
+        """
+        namespace = dict(self.constants)
+        namespace['quantities'] = quantities
+        for placeholder, sym in self.symbols:
+            if sym not in state:
+                raise CalcError("unknown symbol |%s| encountered" % sym)
+            namespace[placeholder] = state[sym]
+        return eval(self.code, namespace)
+
+
+@metrics.timed("compile")
+def compile_expression(paired_tokens, flags):
     '''
 
     :param paired_tokens: parsed and processed list of tokens from make_paired_tokens
-    :param state: contains known quantities as ordered dict, along with flags and output
-    :return: a string containing a valid python expression yielding a quantity Q() as result
+    :param flags: switches of the current state, used to complain in tutor mode
+    :return: a CompiledExpression yielding a quantity Q() when evaluated
 
     User input '3 mol/L'
-    >>> create_Python_expression([['N', '*', '3'], ['U', '*', 'mol'], ['U', '/', 'L'], ['Z', '*', '']], {})
-    u"Q(3000.0, '', Units(m=-3,mol=1), 0.0, set(['L', 'mol']))"
+    >>> compile_expression([['N', '*', '3'], ['U', '*', 'mol'], ['U', '/', 'L'], ['Z', '*', '']], set()).source
+    u'c0'
 
     User input '30 s + 1 min)
-    >>> create_Python_expression([['N', '*', '30'], ['U', '*', 's'], ['N', '+', '1'], ['U', '*', 'min'], ['Z', '*', '']], {})
-    u"Q(30.0, '', Units(s=1), 0.0, set(['s']))+Q(60.0, '', Units(s=1), 0.0, set(['min']))"
-
-    User input '4 7'
-    >>> create_Python_expression([['N', '*', '4'], ['N', '*', '7'], ['Z', '*', '']], {})
-    u"Q('4')*Q('7')"
-
-    User input '2a'
-    >>> create_Python_expression([['N', '*', '2'], ['I', '*', 'a'], ['Z', '*', '']], {})
-    calculator.CalcError: unknown symbol a encountered
+    >>> compile_expression([['N', '*', '30'], ['U', '*', 's'], ['N', '+', '1'], ['U', '*', 'min'], ['Z', '*', '']], set()).source
+    u'c0+c1'
 
     User input '2a'
-    >>> create_Python_expression([['N', '*', '2'], ['I', '*', 'a'], ['Z', '*', '']], State("Q(number=5.0, name='a')"))
-    u"Q('2')*Q(5.0, 'a', Units(), 0.0)"
+    >>> e = compile_expression([['N', '*', '2'], ['I', '*', 'a'], ['Z', '*', '']], set())
+    >>> e.source, e.symbols
+    (u'c0*s0', [(u's0', u'a')])
 
     User input 'log(7)'
-    >>> create_Python_expression([['F', '*', 'log'], ['N', '(', '7'], ['Z', ')*', '']], {})
-    u"quantities.log(Q('7'))"
+    >>> compile_expression([['F', '*', 'log'], ['N', '(', '7'], ['Z', ')*', '']], set()).source
+    u'quantities.log(c0)'
 
     '''
 
     result = []
-    complaint = '__tutor__' in state.flags and any(x[0]=='I' for x in paired_tokens) and any(x[0]=='U' for x in paired_tokens)
+    symbols = []
+    placeholders = {}
+    constants = {}
+    complaint = '__tutor__' in flags and any(x[0]=='I' for x in paired_tokens) and any(x[0]=='U' for x in paired_tokens)
+    k = 0
     while True:  # consume "Z", "I", "F", "U", "N" in paired_tokens
-        ttype, operator, ttext = paired_tokens.pop(0)
+        ttype, operator, ttext = paired_tokens[k]
+        k += 1
         if ttype in "ZIF":
             result.append(operator)
             if ttype == "Z":
@@ -534,30 +881,34 @@ def create_Python_expression(paired_tokens, state):
             if ttype == "F":
                 result.append("quantities." + ttext)
             else:  # ttype == "I"
-                if ttext in state:
-                    result.append(state[ttext].__repr__())
-                else:
-                    raise CalcError("unknown symbol |%s| encountered" % ttext)
+                if ttext not in placeholders:
+                    placeholders[ttext] = "s%d" % len(symbols)
+                    symbols.append((placeholders[ttext], ttext))
+                result.append(placeholders[ttext])
             continue
         # ttype in "UN", i.e. either unit or number
-        quant = ["Q('%s')" % ttext]
         if ttype == "N" and "." in ttext:
-            if magic(ttext if "(" not in ttext else ttext.split("(")[0]) and not "__showuncert__" in state.flags:
+            if magic(ttext if "(" not in ttext else ttext.split("(")[0]) and not "__showuncert__" in flags:
                 raise CalcError(
                     "If you always use powerful tools, your basic skills might get rusty. Do this calculation using a method other than PQCalc, please")
-        if ttype == "N" and paired_tokens[0][0] != "U":
+        placeholder = "c%d" % len(constants)
+        if ttype == "N" and paired_tokens[k][0] != "U":
+            q = Q.literal(ttext)
+            if any(c is q for c in constants.values()):  # a number written twice was measured twice
+                q = Q._make(q.number, q.name, q.units, q.uncert, q.prefu, q.provenance)
+            constants[placeholder] = q
             result.append(operator)
-            result.append(quant[0])
+            result.append(placeholder)
             continue
-        quant_text, paired_tokens = interpret_N_U_cluster(quant, paired_tokens, complaint)
-        result.append('%s%s' % (operator, quant_text))
+        constants[placeholder], k = interpret_N_U_cluster(ttext, paired_tokens, complaint, k)
+        result.append('%s%s' % (operator, placeholder))
     expression = "".join(result)[:-1]
     if expression.startswith("*"):
-        return expression[1:]
-    return expression
+        expression = expression[1:]
+    return CompiledExpression(expression, symbols, constants)
 
 
-def interpret_N_U_cluster(quant, orig_paired, complaint):
+def interpret_N_U_cluster(first, paired, complaint, start=0):
     '''
     Find quantity introduced on the fly and evaluate as Q(). This is done to avoid cluttering the output with
     trivial calculations such as 2 * mol / L = 2 mol/L. This step also has consequences for order of operation, as
@@ -569,24 +920,28 @@ def interpret_N_U_cluster(quant, orig_paired, complaint):
     Complications arise with exponents in the units, e.g. 5 m ** 2 / J
     or parentheses, e.g. 8.314 J/(K mol) vs 8.314 J /(K 2 kg)
 
-    :param quant: a list containing the first quantity in the cluster, e.g. "Q('2')" or "Q('kg')
-    :param orig_paired: the paired list containing items on the right of the first quantity in the cluster
-    :return: repr() of the quantity, and the paired tokens that have not been used
+    The units following the first number or unit, e.g. J/(K mol), are turned into a factor once (see unit_factor()),
+    so that the quantity is the first number or unit times the factor.
+
+    :param first: the text of the first number or unit in the cluster, e.g. "2" or "kg"
+    :param paired: the paired list, with the items on the right of the first quantity in the cluster from start on
+    :param complaint: whether to complain about quantities without a name (tutor mode)
+    :param start: index in paired of the item following the first quantity
+    :return: the quantity Q(), and the index of the first paired token that has not been used
 
     user input: '3 mol / L'
-    >>>interpret_N_U_cluster(["Q('3')"],[['U', '*', 'mol'], ['U', '/', 'L'], ['Z', '*', '']])
-    ("Q(3000.0, '', Units(m=-3,mol=1), 0.0, set(['L', 'mol']))", [['Z', '*', '']])
+    >>>interpret_N_U_cluster("3",[['U', '*', 'mol'], ['U', '/', 'L'], ['Z', '*', '']], False)
+    (Q(3000.0, '', Units(m=-3,mol=1), 0.0, set(['L', 'mol'])), 2)
 
     user input: '30 s + 1 min'
-    >>>interpret_N_U_cluster(["Q('30')"],[['U', '*', 's'], ['N', '+', '1'], ['U', '*', 'min'], ['Z', '*', '']])
-    ("Q(30.0, '', Units(s=1), 0.0, set(['s']))", [['N', '+', '1'], ['U', '*', 'min'], ['Z', '*', '']])
+    >>>interpret_N_U_cluster("30",[['U', '*', 's'], ['N', '+', '1'], ['U', '*', 'min'], ['Z', '*', '']], False)
+    (Q(30.0, '', Units(s=1), 0.0, set(['s'])), 1)
     '''
 
-    paired = orig_paired[:]
-    complaint = complaint and any('U' in x for x in orig_paired)
+    complaint = complaint and any('U' in x for x in islice(paired, start, None))
     notyetclosed = None
     openp = 0
-    for i, (ttype, op, ttext) in enumerate(paired):
+    for i, (ttype, op, ttext) in enumerate(islice(paired, start, None)):
         o = op.count("(")
         c = op.count(")")
         if o:
@@ -598,13 +953,11 @@ def interpret_N_U_cluster(quant, orig_paired, complaint):
             if openp < 0:
                 break
             notyetclosed = None
-        if not (paired[i][0] == "U" or (paired[i][0] == "N" and "**" in paired[i][1])):
+        if not (ttype == "U" or (ttype == "N" and "**" in op)):
             break  # we're done if we encounter anything but a unit (with the exception of an exponent on a unit)
-    end = notyetclosed if notyetclosed else i  # take up to open parenthesis that wasn't closed, or to end of N-U cluster
-    for j in range(end):
-        quant.append(paired[j][1] + "Q('%s')" % paired[j][2])
-    quantstr = "".join(quant)
-    openparentheses = quantstr.count("(") - quantstr.count(")")
+    end = start + (notyetclosed if notyetclosed else i)  # up to open parenthesis that wasn't closed, or end of cluster
+    unitstr = "".join(paired[j][1] + "Q('%s')" % paired[j][2] for j in range(start, end))
+    openparentheses = unitstr.count("(") - unitstr.count(")")
     if openparentheses > 0:
         for i, c in enumerate(paired[end][1]):
             if c == ")":
@@ -612,23 +965,47 @@ def interpret_N_U_cluster(quant, orig_paired, complaint):
             if not openparentheses:
                 break
         else:
-            raise CalcError("parentheses count off %s %s" % (quant, paired[end][1]))
-        quantstr = quantstr + paired[end][1][:i + 1]
+            raise CalcError("parentheses count off %s %s" % (["Q('%s')" % first, unitstr], paired[end][1]))
+        unitstr = unitstr + paired[end][1][:i + 1]
         paired[end][1] = paired[end][1][i + 1:]
-    try:
-        q = eval(quantstr)
-    except SyntaxError:
-        raise CalcError('<br>%s<br><br><div style="color: red;">Mangled math</div><br>' % quantstr)
-    except OverflowError as duh:
-        raise CalcError('<br>%s<br><br><div style="color: red;">Math overflow: %s</div><br>' % (quantstr, duh))
-    except AttributeError as duh:
-        raise CalcError('<br>%s<br><br><div style="color: red;">Bad comma?: %s</div><br>' % (quantstr, duh))
+    quantstr = "Q('%s')" % first + unitstr
+    if unitstr.startswith("**"):  # the exponent belongs to the first unit, e.g. m**2/s
+        q = unit_factor(quantstr, quantstr)
+    else:
+        q = unitquant[first] if first in unitquant else Q.literal(first)
+        if unitstr:
+            q = q * unit_factor("Q(1)" + unitstr, quantstr)
     if complaint:
         raise CalcError('<br>%s<br><br><div style="color: red;">Please give all quantities a name before using them in a calculation</div><br>' % q)
 
-    q.name = ""
-    q.provenance = []
-    return repr(q), paired[end:]
+    return Q(q.number, "", q.units, q.uncert, q.prefu), end
+
+
+def unit_factor(unitstr, quantstr):
+    """
+    Evaluates a product of units such as Q(1)*Q('J')/(Q('K')*Q('mol')) once, keeping the result in unit_clusters
+
+    :param unitstr: the product of units
+    :param quantstr: the whole cluster, to show in error messages
+    :return: the quantity Q() with the conversion factor, units and preferred units
+    """
+    factor = unit_clusters.get(unitstr)
+    if factor is None:
+        try:
+            q = eval(unitstr)
+        except SyntaxError:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Mangled math</div><br>' % quantstr)
+        except OverflowError as duh:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Math overflow: %s</div><br>' % (quantstr, duh))
+        except AttributeError as duh:
+            raise CalcError('<br>%s<br><br><div style="color: red;">Bad comma?: %s</div><br>' % (quantstr, duh))
+        factor = Q._make(q.number, "", q.units, q.uncert, q.prefu, None)
+        unit_clusters.put(unitstr, factor)
+    return factor
+
+
+unit_clusters = LRUCache(4096)
+unitquant.caches.extend([line_cache, expression_cache, unit_clusters])
 
 
 endings = {"9351", "1736", "2271", "0261", "3589", "4259", "5257", "8637", "6264", "7126"}
@@ -655,8 +1032,8 @@ def register_result(result0, sym, state):
     :param sym: name of the quantity
     :param state: contains known quantities as ordered dict, along with flags and output
     """
-    result0.provenance = []
-    result0.name = sym[:]
+    result0 = Q(result0.number, sym, result0.units, result0.uncert, result0.prefu,
+                sensitivity=quantities.fold_sensitivity(result0, definition(sym, state)))
     if sym in state:
         state.printit('<div style="color: green;">Warning: Updated value of %s</div><br>' % (format_identifier(sym)))
     state[sym] = result0
@@ -684,6 +1061,7 @@ typicalunits = dict(
 typicalunits["["] = typicalunits["c"]
 
 
+@metrics.timed("show_work")
 def show_work(result, sym, flags, error=False, addon="", skipsteps=False):
     """
     Shows the steps in getting from formula to calculated value. This function is called not only by calc(),
@@ -725,6 +1103,7 @@ def show_work(result, sym, flags, error=False, addon="", skipsteps=False):
             "absolute(%s": "\\mathrm{absolute(%s",
             "moredigits(%s)": "\\mathrm{moredigits}(%s)",
             "uncertainty(%s)": "\\mathrm{uncertainty}(%s)",
+            "budget(%s)": "\\mathrm{budget}(%s)",
     } if math else None
     d = result.setdepth()
     if math:
@@ -735,7 +1114,8 @@ def show_work(result, sym, flags, error=False, addon="", skipsteps=False):
         template2 = "   = %s%s"
     flaugs = dict(uncert=("__showuncert__" in flags), hideunits=("__hideunits__" in flags),
                   hidenumbers=("__hidenumbers__" in flags))
-    task = result.steps(-1, writer, subs, flaugs)  # task
+    steps = result.allsteps(writer, subs, flaugs)
+    task = steps[-1]  # task
     if flaugs['hidenumbers']:
         task = result.steps(-1, quantities.latex_writer, subs)
     name = latex_name(sym) if math else sym
@@ -744,14 +1124,14 @@ def show_work(result, sym, flags, error=False, addon="", skipsteps=False):
     if not skipsteps:
         for dd in range(1, d + 1):
             if dd == 1:
-                first = result.steps(dd, writer, subs, flaugs)
+                first = steps[dd]
                 if flaugs['hidenumbers']:
                     first = result.steps(dd, quantities.latex_writer, subs, dict(hidenumbers=True))
                 if first != task:
                     output.append(template2 % (first, addon))
             else:
-                output.append(template2 % (result.steps(dd, writer, subs, flaugs), addon))  # intermediate steps
-    result_str = result.steps(0, writer, subs, flaugs)  # result
+                output.append(template2 % (steps[dd], addon))  # intermediate steps
+    result_str = steps[0]  # result
     if result_str != task and not error and not (flaugs['hidenumbers'] and d == 0):
         logput.append(template2 % (result_str, addon))
         output.append(template2 % (result_str, addon))
@@ -761,6 +1141,57 @@ def show_work(result, sym, flags, error=False, addon="", skipsteps=False):
     return output, logput
 
 
+def show_montecarlo(result, state):
+    """
+    Shows mean and standard deviation of a result from Monte Carlo propagation of uncertainty (see montecarlo.py),
+    next to the first-order estimate.
+
+    :param result: value and provenance of the quantity Q()
+    :param state: contains known quantities as ordered dict, along with flags and output
+    """
+    if not result.provenance or isinstance(result.number, Fraction) or not result.uncert:
+        return
+    if quantities.numpy is None:
+        state.printit('<div style="color: green;">Warning: Monte Carlo needs NumPy, which is not installed</div><br>')
+        return
+    mean, std, count, invalid = montecarlo.propagate(result)
+    texts = []
+    for number, uncert in [(mean, std), (result.number, result.uncert)]:
+        value, poslist, neglist = quantities.unit_string(number, result.units, result.prefu)
+        uc = uncert * value / number if number else uncert
+        numbertext = quantities.ascii_number(value, quantities.sigfig(value, uc), uc)
+        units = quantities.unit_text(poslist, neglist)
+        texts.append(numbertext + " " + units if units else numbertext)
+    text = "Monte Carlo (%d samples): %s, first order: %s" % (count, texts[0], texts[1])
+    if invalid:
+        text += " (%d samples outside the domain of a function were left out)" % invalid
+    linearized = montecarlo.linearized(result)
+    if linearized:
+        text += " (first order used for %s)" % ", ".join("%s()" % name for name in linearized)
+    if 'plain math' in state.flags:
+        state.printit("   " + text)
+    else:
+        state.printit('<div style="color: gray;">%s</div>' % text)
+
+
+def show_budget(q, state):
+    """
+    Shows how much each input contributes to the variance of a quantity, for budget() (see quantities.sensitivities)
+
+    :param q: the argument of budget(), a quantity Q()
+    :param state: contains known quantities as ordered dict, along with flags and output
+    """
+    budget = quantities.contributions(q)
+    if not budget:
+        text = "Uncertainty budget: no inputs with uncertainty"
+    else:
+        text = "Uncertainty budget: " + ", ".join("%s %.0f%%" % (name, 100 * share) for name, share in budget)
+    if 'plain math' in state.flags:
+        state.printit("   " + text)
+    else:
+        state.printit('<div style="color: gray;">%s</div>' % text)
+
+
 def convert_units(input_type, command, quant, units, state):
     """
     Shows the quantity in different units, either once only ('in') or from now on ('using')
@@ -779,15 +1210,15 @@ def convert_units(input_type, command, quant, units, state):
                 raise CalcError(
                     "PQCalc does not recognize the unit '%s', so 'using' does not work. Try 'in' instead." % p)
         try:
-            q = state[quant.strip()] + Q(0.0)
+            q = state[quant.strip()] + Q.from_float(0.0)
         except KeyError:
             raise CalcError("The quantity '%s' is not defined yet. Check for typos." % quant.strip())
-        q.name = ""
-        q.provenance = None
+        q = Q(q.number, "", q.units, q.uncert, q.prefu)
         outp, _ = show_work(q, quant, state.flags)
         output = (outp[:-1])
-        state[quant.strip()].prefu = set(prefu)
-        q = state[quant.strip()] + Q(0.0)
+        old = state[quant.strip()]
+        state[quant.strip()] = Q(old.number, old.name, old.units, old.uncert, prefu, sensitivity=old.sensitivity)
+        q = state[quant.strip()] + Q.from_float(0.0)
         outp, _ = show_work(q, quant, state.flags)
         output.extend(outp[-2 if not 'plain math' in state.flags else -1:])
     else:
@@ -928,6 +1359,8 @@ task = '''for i in range(100000): calc("","dd = exp(45.34) / log(6.9654) \\n yy
 
 
 def test_examples():
+    from form import example_dict
+    exdict = example_dict()
     for ex in exdict:
         print('########################################################################')
         print('#          %-60s#' % ex)
@@ -940,6 +1373,19 @@ def test_examples():
         for line in output[1:]:
             print(line)
 
+lexer_inputs = ['3 mol/L', '30 s + 1 min', '2a', '4 7 #comment', '4 mol/L / 2 mol/L', '3.5 J/mol/K', '3.5 J/(mol K)',
+                '5.6 mmol', 'sqrt(5.0 cm^2 / (2 Pi))', ' + '.join(['2.0 kg m/s^2'] * 100)]
+
+
+def benchmark_lexer(number=2000):
+    """Times lex() against scan() followed by make_paired_tokens() on the inputs of the doctests (and a long sum)"""
+    import timeit
+    for t in lexer_inputs:
+        old = timeit.timeit(lambda: make_paired_tokens(scan(t)), number=number) / number
+        new = timeit.timeit(lambda: lex(t), number=number) / number
+        print("%-25s %9.1f us %9.1f us  %4.1fx" % (t[:25], old * 1e6, new * 1e6, old / new))
+
+
 def profile_program():
     import cProfile
 
@@ -4,6 +4,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 from quantities import functions, known_units
+import metrics
 
 selector = '''
 <select %s onchange="insertAtCaret('commands',this.options[this.selectedIndex].value, %s);">
@@ -19,19 +20,23 @@ def fill_selector(header, choices, backup=0):
         html.append(selectoroption % (term, term))
     return selector % ("", backup, "".join(html))
 
-# unit selectors, pre-baked
-unit_list = known_units.keys()
-unit_list.sort(key=lambda x: x.lower())
-unit_selector = fill_selector("units", unit_list)
+# special symbols for the symbol selector
+symbol_list = ["μ", "π","ν％ℳ","ΔᵣG°′","αβγδεζησχ","∞∡ℏ","äöüßø", "ΓΘΛΦΨ"]
 
-# function selectors, pre-baked
-function_list = [f + "()" for f in functions]
-function_list.extend(["using  ", "in  "])
-function_selector = fill_selector("functions", function_list, backup=1)
+static_html = None
 
-# special symbol selector, pre-baked
-symbol_list = ["μ", "π","ν％ℳ","ΔᵣG°′","αβγδεζησχ","∞∡ℏ","äöüßø", "ΓΘΛΦΨ"]
-symbol_selector = fill_selector("symbols", symbol_list)
+def static_selectors():
+    """ Make the selectors for units, functions and special symbols on first use, so that starting the server
+    does not have to wait for them
+    """
+    global static_html
+    if static_html is None:
+        unit_list = sorted(known_units.keys(), key=lambda x: x.lower())
+        function_list = [f + "()" for f in functions]
+        function_list.extend(["using  ", "in  "])
+        static_html = (fill_selector("units", unit_list) + fill_selector("functions", function_list, backup=1) +
+                       fill_selector("symbols", symbol_list))
+    return static_html
 
 def quant_selectors(known):
     """ Make the selector for known quantities
@@ -50,9 +55,10 @@ the program is  <a href="http://www.bioinformatics.org/pqcalc/manual">here</a>.
 
 
 def helpform(mob):
-    return example_template % exhtml
+    return example_template % example_html()
 
-def newform(outp, logp, mem, known, log, mob, oneline, inputlog, prefill="", linespace="100%", logo=""):
+@metrics.timed("newform")
+def newform(outp, logp, mem, known, log, mob, oneline, inputlog, prefill="", linespace="100%", logo="", session=""):
     mem = "\n".join(mem)
     known = "\n".join(known)
     if not outp:
@@ -61,15 +67,18 @@ def newform(outp, logp, mem, known, log, mob, oneline, inputlog, prefill="", lin
     inputlog = inputlog.replace('"', '&quot;')
     logbook = log.replace('"', '&quot;') + "\n" + ("\n".join(logp)).replace('"', '&quot;')
     out = log.replace('&quot;', '"') + "\n".join(outp)
+    if session:  # memory and logs are kept on the server
+        mem = inputlog = logbook = ""
     keyb = "" if mob else 'class="keyboardInput"'
     selectors = quant_selectors(known)
-    selectors = selectors + unit_selector + function_selector + symbol_selector
+    selectors = selectors + static_selectors()
     rows = 3
     if prefill:
-        prefill = exdict[prefill][:-2]
+        prefill = example_dict()[prefill][:-2]
         rows =len(prefill.split("\n"))
     data = dict(output=out, memory=mem, rows=rows, selectors=selectors, logbook=logbook, keyboard=keyb,
-                prefill=prefill, head=head, buttons=buttons, linespacing=linespace, logo=logo, inputlog=inputlog)
+                prefill=prefill, head=head, buttons=buttons, linespacing=linespace, logo=logo, inputlog=inputlog,
+                session=session)
     if oneline and not prefill:
         return template_oneline % data
     return template % data
@@ -204,6 +213,7 @@ template = '''<html>
             <input type="hidden" name="memory" value = "%(memory)s"/>
             <input type="hidden" name="inputlog" value = "%(inputlog)s"/>
             <input type="hidden" name="logbook" value = "%(logbook)s"/>
+            <input type="hidden" name="session" value = "%(session)s"/>
     </div>
 </body>
 </html>
@@ -236,6 +246,7 @@ template_oneline = '''<html>
             <input type="hidden" name="memory" value = "%(memory)s"/>
             <input type="hidden" name="inputlog" value = "%(inputlog)s"/>
             <input type="hidden" name="logbook" value = "%(logbook)s"/>
+            <input type="hidden" name="session" value = "%(session)s"/>
 
 </body>
 </html>
@@ -698,18 +709,29 @@ problem = integrate images
 
 '''
 
-examples = example.split('problem = ')
 from collections import OrderedDict
 
+exdict = None
+exhtml = None
 
-exdict = OrderedDict()
-exhtml = []
-for ex in examples:
-    if "\n" not in ex:
-        continue
-    head2, prob = ex.split("\n", 1)
-    exhtml.append('<a href="/example%s">Example %s</a><br>' % (head2, head2))
-    exhtml.append("<pre>%s</pre>" % prob)
-    exdict[head2] = prob
-
-exhtml = "".join(exhtml)
+def example_dict():
+    """ Split the examples into a dictionary of problems (by name) and the html listing them, on first use
+    """
+    global exdict, exhtml
+    if exdict is None:
+        problems = OrderedDict()
+        html = []
+        for ex in example.split('problem = '):
+            if "\n" not in ex:
+                continue
+            head2, prob = ex.split("\n", 1)
+            html.append('<a href="/example%s">Example %s</a><br>' % (head2, head2))
+            html.append("<pre>%s</pre>" % prob)
+            problems[head2] = prob
+        exhtml = "".join(html)
+        exdict = problems
+    return exdict
+
+def example_html():
+    example_dict()
+    return exhtml
@@ -0,0 +1,72 @@
+# coding=utf-8
+"""
+A bounded least-recently-used cache with hit and miss counters.
+
+Caches are shared between the requests served by one process, possibly from several threads. The counters are
+there so a cache can be sized from real traffic.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """A dictionary-like cache holding at most maxsize items, discarding the least recently used one first.
+
+    Attributes:
+      maxsize(int): the number of items kept
+      hits(int): number of successful calls to get()
+      misses(int): number of calls to get() that did not find the key
+
+    Example:
+      cache = LRUCache(2)
+      cache.put("a", 1)
+      cache.get("a") is 1, cache.get("b") is None
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Returns hits, misses and the current and maximum size as a dictionary"""
+        return dict(hits=self.hits, misses=self.misses, size=len(self.data), maxsize=self.maxsize)
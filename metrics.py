@@ -0,0 +1,167 @@
+# coding=utf-8
+"""
+Timing of the stages of a request (decoding the memory, lexing, compiling, evaluating, showing the work, exporting,
+making the form), collected in histograms and written in the Prometheus text format for the /metrics page of the
+server.
+
+Timing is switched on by setting the environment variable PQCALC_METRICS before the server starts, or with enable()
+before the timed modules are imported (as the benchmark does). Otherwise timed() returns the function it decorates, so
+there is no cost at all. Each server process keeps its own histograms; those of a worker process that calculates for a
+server (see workers.py) are sent to the server with each result and added to its histograms (see snapshot and merge).
+
+Example:
+  @timed("lex")
+  def lex(t): ...
+
+  exposition(dict(expressions=calculator.expression_cache))
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+from functools import wraps
+from threading import Lock
+from timeit import default_timer
+
+enabled = bool(os.environ.get('PQCALC_METRICS'))
+
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Counts of durations (in seconds) at most each of the bucket bounds, with their number and sum.
+
+    Attributes:
+      counts(list): number of durations in each bucket (not cumulative), the last one for those above all bounds
+      total(float): sum of all durations
+      count(int): number of durations
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(buckets) and seconds > buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.total += seconds
+            self.count += 1
+
+    def add(self, counts, total, count):
+        """Adds the durations counted by another histogram, e.g. in another process"""
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.total += total
+            self.count += count
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(buckets) + 1)
+            self.total = 0.0
+            self.count = 0
+
+    def cumulative(self):
+        """The Prometheus buckets: pairs of upper bound (as text) and number of durations at most that long"""
+        result = []
+        running = 0
+        for bound, n in zip(["%g" % b for b in buckets] + ["+Inf"], self.counts):
+            running += n
+            result.append((bound, running))
+        return result
+
+
+stages = {}
+stages_lock = Lock()
+
+
+def histogram(stage):
+    """The histogram of a stage, made on first use"""
+    h = stages.get(stage)
+    if h is None:
+        with stages_lock:
+            h = stages.setdefault(stage, Histogram())
+    return h
+
+
+def reset():
+    """Starts all histograms over (the timed functions keep writing to the same ones)"""
+    for h in list(stages.values()):
+        h.reset()
+
+
+def snapshot():
+    """The histograms of the stages that were timed at all, as a list of (stage, counts, total, count)"""
+    return [(stage, list(h.counts), h.total, h.count) for stage, h in sorted(stages.items()) if h.count]
+
+
+def merge(timings):
+    """Adds the histograms in the result of snapshot() (e.g. from another process) to the ones of this process"""
+    for stage, counts, total, count in timings:
+        histogram(stage).add(counts, total, count)
+
+
+def enable(on=True):
+    """Switches timing on (or off) for the functions decorated with timed() from now on, i.e. in modules imported
+    afterwards"""
+    global enabled
+    enabled = on
+
+
+def timed(stage):
+    """
+    Decorator adding the time spent in a function to the histogram of a stage, if timing is enabled
+
+    :param stage: name of the stage, e.g. "lex"
+    :return: the decorator
+    """
+    if not enabled:
+        return lambda function: function
+
+    def decorate(function):
+        h = histogram(stage)
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                h.observe(default_timer() - start)
+        return timed_function
+    return decorate
+
+
+def exposition(caches=None):
+    """
+    The histograms of all stages, and the statistics of caches, in the Prometheus text format
+
+    :param caches: dictionary of LRUCache by name
+    :return: the text of the metrics page
+    """
+    lines = ["# HELP pqcalc_stage_seconds Time spent in each stage of a request",
+             "# TYPE pqcalc_stage_seconds histogram"]
+    for stage in sorted(stages):
+        h = stages[stage]
+        for bound, n in h.cumulative():
+            lines.append('pqcalc_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, n))
+        lines.append('pqcalc_stage_seconds_sum{stage="%s"} %r' % (stage, h.total))
+        lines.append('pqcalc_stage_seconds_count{stage="%s"} %d' % (stage, h.count))
+    caches = sorted((caches or {}).items())
+    for field, kind, text in [("hits", "counter", "Lookups that found their key"),
+                              ("misses", "counter", "Lookups that did not find their key"),
+                              ("size", "gauge", "Number of items kept"),
+                              ("maxsize", "gauge", "Most items kept")]:
+        name = "pqcalc_cache_%s%s" % (field, "_total" if kind == "counter" else "")
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for cache, c in caches:
+            lines.append('%s{cache="%s"} %d' % (name, cache, c.info()[field]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""
+Monte Carlo propagation of uncertainty, as a check on the first-order estimate that every Q carries along.
+
+With the switch __montecarlo__ on, the calculator draws normally distributed samples of the quantities a result was
+calculated from (with their uncertainties as standard deviation), repeats the calculation on the samples, and shows
+mean and standard deviation of the result next to the usual estimate. This shows where the first-order formulas break
+down, e.g. for powers or quad() of quantities with large uncertainties.
+
+The calculation is taken from the provenance of the result, so only quantities defined in the same line are
+correlated (a quantity used twice gets the same samples both times). Steps that have no NumPy counterpart here, e.g.
+stdev() or slope(), whose uncertainty is estimated from the scatter of the values, are sampled with their first-order
+uncertainty instead; linearized() names them, and the calculator shows them next to the result.
+
+The number of samples is taken from the environment variable PQCALC_MC_SAMPLES (default 10000, never more than
+max_samples). Samples are evaluated in chunks, small enough for the samples of all steps of the calculation to fit
+into memory_limit bytes, and with PQCALC_MC_PROCESSES set to more than 1, the chunks of large sample counts go to a pool
+of worker processes (at most one per CPU, closed when the program ends).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import atexit
+import os
+import re
+
+from quantities import numpy
+
+samples = int(os.environ.get('PQCALC_MC_SAMPLES', 10000))
+processes = int(os.environ.get('PQCALC_MC_PROCESSES', 0))
+max_samples = 10000000
+chunk = 100000
+memory_limit = 64 * 2**20  # bytes of samples of one chunk
+
+binary = {"%s + %s": "add", "%s - %s": "subtract", "%s * %s": "multiply", "%s / %s": "divide", "%s ^ %s": "power"}
+unary = {"-%s": "negative", "exp(%s)": "exp", "log(%s)": "log10", "ln(%s)": "log", "sin(%s)": "sin", "cos(%s)": "cos",
+         "tan(%s)": "tan", "sqrt(%s)": "sqrt", "\\mathrm{absolute}(%s)": "absolute", "moredigits(%s)": "positive"}
+aggregates = {"\\mathrm{sumover}(": "sum", "\\mathrm{average}(": "mean", "\\mathrm{minimum}(": "amin",
+              "\\mathrm{maximum}(": "amax", "\\mathrm{median}(": "median"}
+function_name = re.compile(r"\(?(?:\\mathrm\{)?(\w+)")
+
+
+def program(q):
+    """
+    Flattens the provenance tree of a quantity into a list of steps, children first. A step is either
+    ("leaf", number, uncertainty, function) or (name of numpy function, [indexes of the arguments]). The function of a
+    leaf is None for an input, or the name of the function whose result is sampled in place of its arguments.
+
+    :param q: quantity Q()
+    :return: the list of steps, the last of which gives q
+    """
+    steps = []
+    index = {}
+
+    def visit(q):
+        if id(q) in index:
+            return index[id(q)]
+        operation = None
+        if q.provenance:
+            if q.name in binary and len(q.provenance) == 2:
+                operation = binary[q.name]
+            elif q.name in unary and len(q.provenance) == 1:
+                operation = unary[q.name]
+            elif len(q.provenance) > 1:
+                for prefix in aggregates:
+                    if q.name.startswith(prefix):
+                        operation = aggregates[prefix]
+        if operation:
+            step = (operation, [visit(child) for child in q.provenance])
+        else:
+            function = None
+            if q.provenance:
+                match = function_name.match(q.name)
+                function = match.group(1) if match else q.name
+            step = ("leaf", float(q.number), float(q.uncert), function)
+        index[id(q)] = len(steps)
+        steps.append(step)
+        return index[id(q)]
+
+    visit(q)
+    return steps
+
+
+def linearized(q):
+    """
+    :param q: quantity Q() with provenance
+    :return: sorted names of the functions whose results are sampled with their first-order uncertainty
+    """
+    return sorted(set(step[3] for step in program(q) if step[0] == "leaf" and step[3]))
+
+
+def run(args):
+    """
+    Evaluates a program on one chunk of samples.
+
+    :param args: tuple (program, number of samples, random seed)
+    :return: number of valid samples, their mean and sum of squared deviations, number of invalid samples
+    """
+    steps, n, seed = args
+    rng = numpy.random.RandomState(seed)
+    last_use = {}
+    for j, step in enumerate(steps):
+        if step[0] != "leaf":
+            for i in step[1]:
+                last_use[i] = j
+    values = []
+    with numpy.errstate(all='ignore'):
+        for j, step in enumerate(steps):
+            if step[0] == "leaf":
+                number, uncert = step[1:3]
+                values.append(number + uncert * rng.standard_normal(n) if uncert else numpy.full(n, number))
+                continue
+            if step[0] in aggregates.values():
+                values.append(getattr(numpy, step[0])([values[i] for i in step[1]], axis=0))
+            else:
+                values.append(getattr(numpy, step[0])(*[values[i] for i in step[1]]))
+            for i in step[1]:
+                if last_use[i] == j:
+                    values[i] = None  # no longer needed
+    result = values[-1]
+    valid = result[numpy.isfinite(result)]
+    if not valid.size:
+        return 0, 0.0, 0.0, n
+    mean = valid.mean()
+    return valid.size, mean, ((valid - mean)**2).sum(), n - valid.size
+
+
+def combine(parts):
+    """Combines the results of run() for several chunks (Chan et al.'s pairwise update)"""
+    count, mean, m2, invalid = 0, 0.0, 0.0, 0
+    for n, m, s, bad in parts:
+        invalid += bad
+        if not n:
+            continue
+        delta = m - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += s + delta**2 * count * n / total
+        count = total
+    return count, mean, m2, invalid
+
+
+def chunk_size(steps):
+    """
+    :param steps: the result of program()
+    :return: number of samples per chunk, so that the samples of all steps (and the stacked arguments of an aggregate
+             such as sumover()) take at most memory_limit bytes
+    """
+    return max(1, min(chunk, memory_limit // (16 * len(steps))))
+
+
+def propagate(q, n=None, workers=None, seed=0):
+    """
+    :param q: quantity Q() with provenance
+    :param n: number of samples (default: samples)
+    :param workers: number of processes (default: processes)
+    :param seed: random seed, so that the same calculation gives the same result
+    :return: mean, standard deviation, number of valid samples and number of invalid samples
+             (e.g. negative arguments of sqrt)
+    """
+    n = min(n or samples, max_samples)
+    workers = processes if workers is None else workers
+    steps = program(q)
+    size = chunk_size(steps)
+    tasks = [(steps, min(size, n - start), seed + i) for i, start in enumerate(range(0, n, size))]
+    if workers > 1 and len(tasks) > 1:
+        parts = get_pool(workers).map(run, tasks)
+    else:
+        parts = [run(task) for task in tasks]
+    count, mean, m2, invalid = combine(parts)
+    std = (m2 / (count - 1)) ** 0.5 if count > 1 else 0.0
+    return mean, std, count, invalid
+
+
+pool = None
+pool_size = 0
+
+
+def get_pool(workers):
+    """The pool of worker processes, made on first use (again if a different number of workers is asked for)"""
+    global pool, pool_size
+    import multiprocessing
+    workers = min(workers, multiprocessing.cpu_count())
+    if pool is not None and pool_size != workers:
+        close_pool()
+    if pool is None:
+        pool = multiprocessing.Pool(workers)
+        pool_size = workers
+    return pool
+
+
+@atexit.register
+def close_pool():
+    """Stops the worker processes, if there are any"""
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+        pool = None
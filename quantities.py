@@ -20,7 +20,13 @@ Author: Karsten Theis (ktheis@westfield.ma.edu)
 """
 from __future__ import division
 
+import importlib
+import io
 import math
+import os
+import pkgutil
+import re
+import sys
 from math import log10 as math_log10
 from math import log as math_log
 from math import exp as math_exp
@@ -30,6 +36,24 @@ from math import tan as math_tan
 from math import floor
 from math import sqrt as math_sqrt
 from fractions import Fraction
+from weakref import WeakValueDictionary
+
+from lrucache import LRUCache
+
+
+class LazyModule(object):
+    """A module that is only imported when one of its attributes is used (NumPy alone doubles the startup time)"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+numpy = LazyModule("numpy") if pkgutil.find_loader("numpy") else None
 
 SIunit_symbols = ["A", "kg", "m", "s", "mol", "K", "Cd", "$"]
 
@@ -40,18 +64,87 @@ class Units(tuple):
     The base units are the SI units plus the dollar. Units are expressed as tuple containing
     the exponents of the units.
 
+    There is only one instance for each dimension (see Units.intern), so that dimensions can be compared with "is",
+    and the results of times(), divided() and power() are remembered. The instances are kept for good (clearing them
+    would give a second instance for dimensions still in use), so there are at most max_interned_units of them, and
+    units can only be raised to powers with a denominator up to max_unit_denominator, e.g. m^(1/3).
+
     Example:
       cubic meters is Units(m=3)
       kilogram per cubic meters is Units(m=-3, kg=1)
     """
 
+    __slots__ = ()
+
     def __new__(cls, A=0, kg=0, m=0, s=0, mol=0, K=0, Cd=0, dollar=0):
-        return tuple.__new__(cls, (A, kg, m, s, mol, K, Cd, dollar))
+        return Units.intern((A, kg, m, s, mol, K, Cd, dollar))
+
+    @staticmethod
+    def intern(exponents):
+        """
+        Returns the instance of Units for a tuple of 8 exponents
+
+        :raise OverflowError: for a new dimension once there are max_interned_units of them
+        """
+        units = interned_units.get(exponents)
+        if units is None:
+            exponents = tuple(normal_exponent(x) for x in exponents)
+            if exponents not in interned_units and len(interned_units) >= max_interned_units:
+                raise OverflowError("too many different units")
+            units = interned_units.setdefault(exponents, tuple.__new__(Units, exponents))
+        return units
+
+    def __reduce__(self):
+        return Units, tuple(self)
 
     def __repr__(self):
         symbols = ["A", "kg", "m", "s", "mol", "K", "Cd", "dollar"]
         return "Units(" + ",".join("%s=%s" % (x[0],repr(x[1])) for x in zip(symbols, self) if x[1]) + ")"
 
+    def times(self, other):
+        key = (id(self), id(other))
+        units = units_products.get(key)
+        if units is None:
+            units = remember(units_products, key, Units.intern(tuple([x[0] + x[1] for x in zip(self, other)])))
+        return units
+
+    def divided(self, other):
+        key = (id(self), id(other))
+        units = units_quotients.get(key)
+        if units is None:
+            units = remember(units_quotients, key, Units.intern(tuple([x[0] - x[1] for x in zip(self, other)])))
+        return units
+
+    def power(self, exponent):
+        """:param exponent: an int or Fraction"""
+        key = (id(self), exponent)
+        units = units_powers.get(key)
+        if units is None:
+            units = remember(units_powers, key, Units.intern(tuple([fraction_or_int(u * exponent) for u in self])))
+        return units
+
+
+def normal_exponent(x):
+    """Whole exponents are stored as int, so that Units(m=2) and Units(m=Fraction(2, 1)) look the same"""
+    if (type(x) is Fraction and x.denominator == 1) or (type(x) is float and x.is_integer()):
+        return int(x)
+    return x
+
+
+def remember(memo, key, units):
+    """Stores units in one of the memos of Units arithmetic, which are keyed by id() of interned Units"""
+    if len(memo) > 100000:
+        memo.clear()
+    memo[key] = units
+    return units
+
+
+interned_units = {}
+max_interned_units = 100000
+max_unit_denominator = 12
+units_products = {}
+units_quotients = {}
+units_powers = {}
 
 unity = Units()
 
@@ -61,10 +154,61 @@ class QuantError(ArithmeticError):
     pass
 
 
+try:
+    string_types = basestring
+    exact_types = (int, long, Fraction)
+except NameError:
+    string_types = str
+    exact_types = (int, Fraction)
+
+max_exact_digits = 1000  # most digits of an exact power (Python would take long to calculate huge ones)
+
+
+def frozen_prefu(prefu):
+    """Returns the frozenset of preferred units equal to prefu that is shared by all quantities using it"""
+    if type(prefu) is not frozenset:
+        prefu = frozenset(prefu)
+    shared = prefu_sets.get(prefu)
+    if shared is None:
+        if len(prefu_sets) > 10000:
+            prefu_sets.clear()
+        shared = prefu_sets[prefu] = prefu
+    return shared
+
+
+prefu_sets = {}
+no_prefu = frozen_prefu(())
+
+
 def raise_QuantError(complaint, name, provenance):
     raise QuantError((complaint, Q(0, name, provenance=provenance)))
 
 
+def hash_consed(name):
+    """
+    Decorates an operation on quantities so that applying it again to the same operands (the same objects, e.g. the
+    same known quantity referenced twice) gives the quantity made the first time, as long as it is still in use.
+    Identical parts of an expression are thus calculated and stored once, and provenance is a DAG rather than a tree.
+
+    :param name: the name of the operation, e.g. "%s * %s", as part of the key in nodes
+    """
+    def decorate(operation):
+        def shared(*operands):
+            key = (name,) + tuple(id(q) for q in operands)
+            q = nodes.get(key)
+            if q is None:
+                q = operation(*operands)
+                nodes[key] = q
+            return q
+        shared.__name__ = operation.__name__
+        shared.__doc__ = operation.__doc__
+        return shared
+    return decorate
+
+
+nodes = WeakValueDictionary()  # results of operations keyed by operation and id() of operands, see hash_consed
+
+
 class Q(object):
     """A class for arithmetic with physical quantities having units and significant figures
 
@@ -78,8 +222,10 @@ class Q(object):
       name(str): The name of the quantity
       sigfig(int): The number of significant figures. 100 refers to an exact integer
       uncert(float): An estimate of the uncertainty of the quantity
-      prefu(list(str)): the preferred units for the quantity, given as str in unitquant
+      prefu(frozenset(str)): the preferred units for the quantity, given as str in unitquant (see frozen_prefu)
       provenance: quantities from which it was derived
+      sensitivity(dict): the contribution of each input to the uncertainty (derivative times uncertainty of the
+        input), keyed by the inputs, or None for an input (see sensitivities())
 
     Examples:
       Q(2) is the dimensionless number 2
@@ -88,46 +234,74 @@ class Q(object):
 
     """
 
-    def __init__(self, number=0.0, name="", units=unity, uncert=0.0, prefu=[], provenance=None):
-        """
+    __slots__ = ('number', 'name', 'units', 'uncert', 'prefu', 'provenance', 'sensitivity', 'depth', '__weakref__')
 
+    def __init__(self, number=0.0, name="", units=unity, uncert=0.0, prefu=(), provenance=None, sensitivity=None):
+        """
+        A string as number is either the name of a unit or a number written as text, see Q.unit() and Q.literal()
         """
 
-        try:
-            number + 1.0
-            self.number = number
-            self.units = Units(*units)
-            self.name = name[:]
-            self.prefu = set(prefu)
-            self.uncert = uncert
-            self.provenance = provenance
-        except TypeError:
-            if number in unitquant:
-                q = unitquant[number]
-            else:
-                q = number2quantity(number)
-            self.__dict__ = q.__dict__
+        if isinstance(number, string_types):
+            q = unitquant[number] if number in unitquant else Q.literal(number)
+            number, name, units, uncert, prefu, provenance = q.number, q.name, q.units, q.uncert, q.prefu, q.provenance
+        self.number = number
+        self.units = units if type(units) is Units else Units(*units)
+        self.name = name
+        self.prefu = frozen_prefu(prefu)
+        self.uncert = uncert
+        self.provenance = provenance
+        self.sensitivity = sensitivity
+
+    @staticmethod
+    def _make(number, name, units, uncert, prefu, provenance, sensitivity=None):
+        """Makes a Q from parts that are known to be right: units of type Units, prefu from frozen_prefu()"""
+        q = object.__new__(Q)
+        q.number = number
+        q.name = name
+        q.units = units
+        q.uncert = uncert
+        q.prefu = prefu
+        q.provenance = provenance
+        q.sensitivity = sensitivity
+        return q
+
+    @staticmethod
+    def from_float(number, uncert=0.0):
+        """A dimensionless number without name, e.g. Q.from_float(2.0)"""
+        return Q._make(number, "", unity, uncert, no_prefu, None)
+
+    @staticmethod
+    def unit(name):
+        """The quantity 1 unit, e.g. Q.unit("kg"), shared by all users of the unit"""
+        return unitquant[name]
+
+    @staticmethod
+    def literal(text):
+        """A number written as text, with the uncertainty given by its digits, e.g. Q.literal("2.50"). The same text
+        gives the same (shared, never modified) quantity, kept in the LRU cache literals."""
+        q = literals.get(text)
+        if q is None:
+            q = parse_literal(text)
+            literals.put(text, q)
+        return q
 
     def __repr__(self):
-        if self.name:
-            self.fakename = 'somename'
-        else:
-            self.fakename = ''
-        if self.name in unitquant and self.__dict__ == unitquant[self.name].__dict__:
+        u = unitquant.get(self.name)
+        if u is not None and (self.number, self.units, self.uncert, self.prefu, self.provenance) == (
+                u.number, u.units, u.uncert, u.prefu, u.provenance):
             return u"Q('%s')" % self.name
-        self.rnumber = repr(self.number)
-        if self.rnumber.startswith("inf"):
-            raise OverflowError(self.rnumber)
-        self.runcert = repr(self.uncert)
-        self.rname = repr(self.name)
+        rnumber = repr(self.number)
+        if rnumber.startswith("inf"):
+            raise OverflowError(rnumber)
+        fields = dict(rnumber=rnumber, name=self.name, units=self.units, runcert=repr(self.uncert),
+                      prefu="set(%s)" % list(self.prefu), provenance=self.provenance)
         if self.provenance:
-            return u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s, %(prefu)s, %(provenance)s)" % self.__dict__
+            return u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s, %(prefu)s, %(provenance)s)" % fields
         if self.prefu:
-            return u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s, %(prefu)s)" % self.__dict__
+            return u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s, %(prefu)s)" % fields
         if self.name:
-            rr =  u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s)" % self.__dict__
-            return rr
-        return u"Q(%(rnumber)s, units=%(units)s, uncert=%(runcert)s)" % self.__dict__
+            return u"Q(%(rnumber)s, '%(name)s', %(units)s, %(runcert)s)" % fields
+        return u"Q(%(rnumber)s, units=%(units)s, uncert=%(runcert)s)" % fields
 
     def __str__(self):
         return ascii_qvalue(self)
@@ -156,22 +330,59 @@ class Q(object):
         children = []
         name = self.name
         for index, q in enumerate(self.provenance):
-            child = q.steps(level, writer, subs)
-            if ((q.provenance and level <= q.depth and opprio[name] > opprio[q.name] and opprio[name] and opprio[q.name] and not (subs and "/" in name)) or
-                (name.startswith("-") and child.startswith("-")) or
-                ("*" in name and index == 1 and child.startswith("-")) or
-                ("^" in name and q.units != unity and level >= 0) or
-                ("^" in name and child.startswith("-") and index == 0) or
-                ("^" in name and ("times" in child or "frac" in child))):
-                child = "(" + child + ")"
-            children.append(child)
+            children.append(parenthesize(name, index, q, q.steps(level, writer, subs), level, subs))
         if subs and name in subs:
             name = subs[name]
         return name % tuple(children)
 
+    def allsteps(self, writer, subs=None, flaigs=dict()):
+        '''
+        Returns what steps() returns for every level from -1 to self.setdepth(), walking the provenance tree once.
+        The strings for each quantity in the tree are made once per level, and its value is formatted at most twice.
 
+        :param writer: either ascii or latex
+        :param subs: modify q.name for latex output
+        :return: dictionary of strings describing the expression, with the levels as keys
+        '''
+        depth = self.setdepth()
+        memo = {}
+        values = {}
+
+        def value(q, guard):
+            key = (id(q), guard)
+            if key not in values:
+                values[key] = writer(q, showvalue=False) if guard is None else writer(q, guard=guard)
+            return values[key]
+
+        def step(q, level):
+            if level < 0 and not q.provenance:
+                return value(q, None)
+            if not level or level > q.depth:
+                return value(q, 0 if (level <= 1 or not q.provenance) else 1)
+            key = (id(q), level)
+            if key not in memo:
+                memo[key] = compose(q, level)
+            return memo[key]
+
+        def compose(q, level):
+            children = []
+            name = q.name
+            for index, p in enumerate(q.provenance):
+                children.append(parenthesize(name, index, p, step(p, level), level, subs))
+            if subs and name in subs:
+                name = subs[name]
+            return name % tuple(children)
+
+        result = {0: writer(self, flags=flaigs, guard=0)}
+        result[-1] = compose(self, -1) if self.provenance else writer(self, showvalue=False)
+        for level in range(1, depth + 1):
+            result[level] = compose(self, level)
+        return result
+
+
+    @hash_consed("%s * %s")
     def __mul__(self, other):
-        units = tuple([x[0] + x[1] for x in zip(self.units, other.units)])
+        units = self.units.times(other.units)
         number = self.number * other.number
         if number:
             uncert = math_sqrt((self.uncert / self.number)**2 + (other.uncert / other.number)**2) * abs(number)
@@ -181,10 +392,16 @@ class Q(object):
         if hasattr(number,'denominator') and number.denominator == 1:
             number = int(number)
         prefu, provenance = inherit_binary(self, other)
-        return Q(number, name, units, uncert, prefu, provenance)
+        sa, sb = sensitivities(self), sensitivities(other)
+        if sa or sb:
+            sensitivity = linear(sa, float(other.number), sb, float(self.number))
+        else:
+            sensitivity = no_sensitivity
+        return Q._make(number, name, units, uncert, prefu, provenance, sensitivity)
 
+    @hash_consed("%s / %s")
     def __truediv__(self, other):
-        units = tuple([x[0] - x[1] for x in zip(self.units, other.units)])
+        units = self.units.divided(other.units)
         try:
             number = self.number / other.number
         except ZeroDivisionError:
@@ -202,18 +419,26 @@ class Q(object):
             except TypeError:
                 pass
         prefu, provenance = inherit_binary(self, other)
-        return Q(number, name, units, uncert, prefu, provenance)
+        sa, sb = sensitivities(self), sensitivities(other)
+        if sa or sb:
+            sensitivity = linear(sa, 1.0 / float(other.number), sb, -float(number) / float(other.number))
+        else:
+            sensitivity = no_sensitivity
+        return Q._make(number, name, units, uncert, prefu, provenance, sensitivity)
 
     def __div__(self, other): return self.__truediv__(other)
 
+    @hash_consed("-%s")
     def __neg__(self):
-        return Q(-self.number, "-%s", self.units, self.uncert, self.prefu, (self,))
+        return Q._make(-self.number, "-%s", self.units, self.uncert, self.prefu, (self,),
+                       linear(sensitivities(self), -1.0))
 
     def __pos__(self):
         return self
 
+    @hash_consed("%s + %s")
     def __add__(self, other):
-        if self.units != other.units and self.number and other.number:
+        if self.units is not other.units and self.number and other.number:
             for s, o in zip(self.units, other.units):
                 if s == o:
                     continue
@@ -225,32 +450,45 @@ class Q(object):
         name = "%s + %s"
         prefu, provenance = inherit_binary(self, other)
         units, uncert = uncert_sum(number, self, other)
-        return Q(number, name, units, uncert, prefu, provenance)
+        return Q._make(number, name, units, uncert, prefu, provenance,
+                       linear(sensitivities(self), 1.0, sensitivities(other), 1.0))
 
+    @hash_consed("%s - %s")
     def __sub__(self, other):
-        if self.units != other.units and self.number and other.number:
+        if self.units is not other.units and self.number and other.number:
             raise_QuantError("Units in sum not compatible", "%s + %s", (self, other))
         number = self.number - other.number
         name = "%s - %s"
         prefu, provenance = inherit_binary(self, other)
         units, uncert = uncert_sum(number, self, other)
-        return Q(number, name, units, uncert, prefu, provenance)
+        return Q._make(number, name, units, uncert, prefu, provenance,
+                       linear(sensitivities(self), 1.0, sensitivities(other), -1.0))
 
+    @hash_consed("%s ^ %s")
     def __pow__(self, other):
-        if other.units != unity:
+        if other.units is not unity:
             raise_QuantError("the exponent can't have units", "%s ^ %s", (self, other))
-        if self.units == unity:
+        if self.units is unity:
             units = self.units
         else:
             if not hasattr(other.number, 'denominator'):
                 raise_QuantError("can't raise units to irrational exponent", "%s ^ %s", (self, other))
             if self.number < 0:
                 raise_QuantError("can't raise negative number to non-integral power", "%s ^ %s", (self, other))
-            units = tuple([fraction_or_int(u * other.number) for u in self.units])
+            if other.number.denominator > max_unit_denominator:
+                raise_QuantError("can't raise units to a power with a denominator above %d" % max_unit_denominator,
+                                 "%s ^ %s", (self, other))
+            units = self.units.power(other.number)
         try:
             if hasattr(self.number, 'denominator') and hasattr(other.number, 'denominator') and other.number>10:
                 number = self.number ** float(other.number)
             else:
+                if type(self.number) in exact_types and type(other.number) in exact_types and (
+                        other.number.denominator == 1 and (other.number > 0 or type(self.number) is Fraction)):
+                    # estimate the size of an exact power from logarithms before taking it, which may take long
+                    digits = abs(other.number) * math_log10(max(abs(self.number.numerator), self.number.denominator))
+                    if digits > max_exact_digits:
+                        raise_QuantError("exact result too large (about %d digits)" % digits, "%s ^ %s", (self, other))
                 number = self.number ** other.number
         except ValueError:
             raise_QuantError("arithmetic problem", "%s ^ %s", (self, other))
@@ -258,7 +496,14 @@ class Q(object):
             raise_QuantError("overflow: value too high", "%s ^ %s", (self, other))
         name = "%s ^ %s"
         uncert = abs(self.uncert/self.number * number * other.number) + abs(other.uncert * math_log(abs(self.number)) * number)
-        return Q(number, name, units, uncert, self.prefu, (self, other))
+        sa, sb = sensitivities(self), sensitivities(other)
+        if sa or sb:
+            base = float(self.number)
+            sensitivity = linear(sa, float(other.number) * float(number) / base if base else 0.0,
+                                 sb, float(number) * math_log(abs(base)) if base else 0.0)
+        else:
+            sensitivity = no_sensitivity
+        return Q._make(number, name, units, uncert, self.prefu, (self, other), sensitivity)
 
 def fraction_or_int(number):
     if number.denominator == 1:
@@ -291,7 +536,16 @@ def latex_units(list1):
 def ascii_qvalue (q, guard=0):
     """Formats quantities as number times a fraction of units, all with positive exponents"""
     value, poslist, neglist = unit_string(q.number, q.units, q.prefu)
-    numbertext = ascii_number(value, sigfig(q.number,q.uncert) + guard)
+    if is_array(value):
+        numbertext = elementwise(lambda v, n, u: ascii_number(v, sigfig(n, u) + guard), value, q.number, q.uncert)
+    else:
+        numbertext = ascii_number(value, sigfig(q.number,q.uncert) + guard)
+    units = unit_text(poslist, neglist)
+    return numbertext + " " + units if units else numbertext
+
+
+def unit_text(poslist, neglist):
+    """Formats units as a fraction with positive exponents, e.g. J/(K mol)"""
     if len(neglist) == 1 and neglist[0][1] == 1:
         negtext = "/" + neglist[0][0]
     elif neglist:
@@ -300,24 +554,30 @@ def ascii_qvalue (q, guard=0):
         negtext = ""
     if not poslist:
         if not neglist:
-            return numbertext
-        return numbertext + " 1" + negtext
-    return numbertext + " " +  ascii_units(poslist) + negtext
+            return ""
+        return "1" + negtext
+    return ascii_units(poslist) + negtext
 
 
 def latex_qvalue (q, guard=0, uncert=False, hideunits=False, hidenumbers=False):
     value, poslist, neglist = unit_string(q.number, q.units, q.prefu)
-    try:
-        uc = q.uncert * value/q.number
-    except:
-        uc = 0
-    sf = sigfig(value, uc)
-    if uncert:
-        numbertext = latex_number(ascii_number(value, sf, uc))
-    elif hidenumbers:
-        numbertext = "\_\_\_\_\_\_\_\_\_\_\_\_"
+
+    def number_text(value, number, uncertainty):
+        try:
+            uc = uncertainty * value/number
+        except:
+            uc = 0
+        sf = sigfig(value, uc)
+        if uncert:
+            return latex_number(ascii_number(value, sf, uc))
+        elif hidenumbers:
+            return "\_\_\_\_\_\_\_\_\_\_\_\_"
+        return latex_number(ascii_number(value, sf + guard))
+
+    if is_array(value):
+        numbertext = elementwise(number_text, value, q.number, q.uncert)
     else:
-        numbertext = latex_number(ascii_number(value, sf + guard))
+        numbertext = number_text(value, q.number, q.uncert)
     if hideunits:
         return numbertext + ("\\phantom{\\frac{km mol}{kg mol}}" if q.units != unity else "")
     if neglist:
@@ -364,11 +624,64 @@ def try_all_derived(SIunits, derived):
 def unit_string(value, units, prefu={'M', 'L', 'J', 'C', 'V', 'N', 'W', 'Pa'}):
     """Determine the most compact set of units for a quantity given in SI units.
 
+    Which derived units replace the SI units only depends on the units and the preferred units, and is looked up in
+    unit_layouts (see unit_layout()). Only the choice between units that differ by a prefix (e.g. mL or L) depends on
+    the value and is made here.
+
+    For an array of values, the units are chosen for the value of largest magnitude.
+
     Returns: (the number(float) and the units(str)) of the quantity
 
     """
+    if is_array(value):
+        magnitude = float(abs(value).max()) if value.size else 0.0
+        scaled, poslist, neglist = unit_string(magnitude, units, prefu)
+        if not magnitude:
+            return value, "", ""
+        return value * (scaled / magnitude), poslist, neglist
     if units == unity or not value:
         return value, "", ""
+    key = (units, tuple(prefu))  # in iteration order of prefu, which decides the order of units in the output
+    layout = unit_layouts.get(key)
+    if layout is None:
+        layout = unit_layout(units, prefu)
+        unit_layouts.put(key, layout)
+    divisors, allunits, DUS, SIchoices, leftover = layout
+    for divisor in divisors:
+        value /= divisor
+    allunits = dict(allunits)
+    for DU, choices in DUS:
+        quality = [(abs(math_log10(abs(value) / (unitquant[c].number/unitquant[DU].number) ** allunits[DU])-1.0), c) for c in choices]
+        best = min(quality)[1]
+        if best != DU:
+            allunits[best] = allunits[DU]
+            value /= (unitquant[best].number/unitquant[DU].number) ** allunits[best]
+            allunits[DU] = 0
+    for i, SIU, choices in SIchoices:
+        quality = [(abs(math_log10(abs(value) / unitquant[c].number ** (SIU / unitquant[c].units[i]))-1.0), c) for c in choices]
+        best = min(quality)[1]
+        allunits[best] = Fraction(SIU,unitquant[best].units[i])
+        if allunits[best].denominator == 1:
+            allunits[best] = int(allunits[best])
+        value /= unitquant[best].number ** allunits[best]
+    for u, d in leftover:
+        allunits[u] = d
+    poslist = [(u,exp) for u, exp in allunits.items() if exp > 0]
+    neglist = [(u,-exp) for u, exp in allunits.items() if exp < 0]
+    return value, poslist, neglist
+
+
+def unit_layout(units, prefu):
+    """Replaces SI units by preferred derived units as long as that makes the units more compact (greedy search).
+
+    Returns: a tuple of
+      the numbers to divide the value by, in order,
+      the derived units used, as list of (unit, exponent),
+      the derived units used, each with the preferred units it could be exchanged with,
+      (index, exponent, preferred units) for each SI unit that is left and can be expressed in a preferred unit,
+      the remaining SI units, as list of (unit, exponent)
+    """
+    divisors = []
     SIunits = list(units)
     derived = dict((pu, 0) for pu in prefu if sum(abs(t) for t in unitquant[pu].units) > 1)
     while (1 and derived):
@@ -378,44 +691,34 @@ def unit_string(value, units, prefu={'M', 'L', 'J', 'C', 'V', 'N', 'W', 'Pa'}):
         derived[d] += sign
         for i, used_in_derived in enumerate(unitquant[d].units):
             SIunits[i] -= used_in_derived * sign
-        value /= unitquant[d].number ** sign
+        divisors.append(unitquant[d].number ** sign)
     if derived.get('V') == 0 and derived.get('kJ') == 0 and SIunits[0] == 1 and SIunits[3] == 1:
         derived['V'] -= 1
         derived['kJ'] += 1
         SIunits[0] = 0
         SIunits[3] = 0
-        value /= 1000
-    allunits = dict([(x,derived[x]) for x in derived if derived[x]])
-    DUS = [du for du in allunits if du in derived]
-    for DU in DUS:
+        divisors.append(1000)
+    allunits = [(x,derived[x]) for x in derived if derived[x]]
+    DUS = []
+    for DU in dict(allunits):
         choices = [pu for pu in derived if unitquant[pu].units == unitquant[DU].units]
         if not choices:
             break
-        quality = [(abs(math_log10(abs(value) / (unitquant[c].number/unitquant[DU].number) ** allunits[DU])-1.0), c) for c in choices]
-        best = min(quality)[1]
-        if best != DU:
-            allunits[best] = allunits[DU]
-            value /= (unitquant[best].number/unitquant[DU].number) ** allunits[best]
-            allunits[DU] = 0
+        DUS.append((DU, choices))
+    SIchoices = []
     for i, SIU in enumerate(SIunit_symbols):
         if not SIunits[i]:
             continue
         choices = [pu for pu in prefu if (pu not in derived) and unitquant[pu].units[i]]
         if not choices:
             break
-        quality = [(abs(math_log10(abs(value) / unitquant[c].number ** (SIunits[i] / unitquant[c].units[i]))-1.0), c) for c in choices]
-        best = min(quality)[1]
-        allunits[best] = Fraction(SIunits[i],unitquant[best].units[i])
-        if allunits[best].denominator == 1:
-            allunits[best] = int(allunits[best])
+        SIchoices.append((i, SIunits[i], choices))
         SIunits[i] = 0
-        value /= unitquant[best].number ** allunits[best]
-    for u, d in zip(SIunit_symbols, SIunits):
-        if d:
-            allunits[u] = d
-    poslist = [(u,exp) for u, exp in allunits.items() if exp > 0]
-    neglist = [(u,-exp) for u, exp in allunits.items() if exp < 0]
-    return value, poslist, neglist
+    leftover = [(u, d) for u, d in zip(SIunit_symbols, SIunits) if d]
+    return divisors, allunits, DUS, SIchoices, leftover
+
+
+unit_layouts = LRUCache(4096)
 
 
 def mostsig(number, ope=1.00000000001): return int(floor(math_log10(abs(number) * ope)))
@@ -499,7 +802,7 @@ def number2quantity(text):
         mult = float(uncert)
     if '/' in text:
         numerator, denominator = text.split('/')
-        return Q(Fraction(int(numerator),int(denominator)), "", uncert=0) # pure fraction such as 1/2
+        return Q._make(Fraction(int(numerator),int(denominator)), "", unity, 0, no_prefu, None) # pure fraction such as 1/2
     try:
         f = int(text)
     except:
@@ -524,7 +827,32 @@ def number2quantity(text):
         uncert = 0.0
     else:
         uncert = float("1e%s" % expo)
-    return Q(f, "", uncert=uncert*mult)
+    return Q._make(f, "", unity, uncert*mult, no_prefu, None)
+
+
+literal_pattern = re.compile(r"\s*([+-]?)(\d*)(?:\.(\d*))?(?:\((\d+)\))?(?:[eE]([+-]?\d+))?\s*$")
+
+
+def parse_literal(text):
+    """Same as number2quantity(), but reads sign, digits, uncertainty in parentheses and exponent with one match
+    instead of trying int() and float() in turn. Anything else (e.g. the fraction 1/2) goes to number2quantity().
+    """
+    m = literal_pattern.match(text)
+    if m is None or not (m.group(2) or m.group(3)):
+        return number2quantity(text)
+    sign, whole, fraction, paren, expo = m.groups()
+    mult = float(paren) if paren else 1
+    if fraction is None and expo is None:
+        number = int(sign + whole)
+    else:
+        number = float(sign + whole + ("." + fraction if fraction is not None else "") + ("e" + expo if expo else ""))
+    if fraction is None and mult == 1:
+        return Q._make(number, "", unity, 0.0, no_prefu, None)
+    least = (int(expo) if expo else 0) - len(fraction or "")
+    return Q._make(number, "", unity, float("1e%d" % least) * mult, no_prefu, None)
+
+
+literals = LRUCache(4096)
 
 
 def latex_name(name):
@@ -564,9 +892,189 @@ def latex_name(name):
     return mathname[0]
 
 def inherit_binary(q1, q2):
-    prefu = q1.prefu | q2.prefu
-    provenance = (q1, q2)
-    return prefu, provenance
+    return merged_prefu(q1.prefu, q2.prefu), (q1, q2)
+
+
+def merged_prefu(p1, p2):
+    """The preferred units of both p1 and p2, reusing p1 or p2 if one contains the other"""
+    if p1 is p2 or p2 <= p1:
+        return p1
+    elif p1 <= p2:
+        return p2
+    return frozen_prefu(p1 | p2)
+
+
+def add_up(a, complaint, name):
+    """
+    The sum of quantities with the same units, without making (and keeping in the provenance) a quantity for each
+    partial sum. The numbers and the squared uncertainties are added up with math.fsum, so that the result does not
+    depend on the order of the quantities. Arrays among the quantities are added up as QArray.
+
+    :param a: sequence of quantities Q()
+    :param complaint: the message of the QuantError raised for quantities with different units
+    :param name: name of the operation, shown with the error
+    :return: quantity Q() without provenance
+    """
+    units = a[0].units
+    if any(isinstance(q, QArray) for q in a):
+        for q in a:
+            if units != q.units:
+                raise_QuantError(complaint, name, (a[0], q))
+        return sum(a, Q.from_float(0.0))
+    prefu = no_prefu
+    sensitivity = {}
+    for q in a:
+        if q.units is not units:
+            raise_QuantError(complaint, name, (a[0], q))
+        prefu = merged_prefu(prefu, q.prefu)
+        for key, c in sensitivities(q).items():
+            sensitivity[key] = sensitivity.get(key, 0.0) + c
+    number = math.fsum(q.number for q in a)
+    uncert = math_sqrt(math.fsum(q.uncert * q.uncert for q in a))
+    return Q._make(number, "", units, uncert, prefu, None, sensitivity or no_sensitivity)
+
+
+def sample(a, complaint, name):
+    """
+    The numbers of the arguments of a statistical function (stdev, median, linfit), given either as quantities with
+    the same units or as a single QArray
+
+    :param a: sequence of quantities Q()
+    :param complaint: the message of the QuantError raised for quantities with different units
+    :param name: name of the operation, shown with the error
+    :return: the numbers (as float), their units and preferred units
+    """
+    if len(a) == 1 and isinstance(a[0], QArray):
+        return [float(x) for x in a[0].number.flat], a[0].units, a[0].prefu
+    units = a[0].units
+    prefu = no_prefu
+    for q in a:
+        if q.units is not units or is_array(q.number):
+            raise_QuantError(complaint, name, (a[0], q))
+        prefu = merged_prefu(prefu, q.prefu)
+    return [float(q.number) for q in a], units, prefu
+
+
+def provenance_size(q, limit=None):
+    """The number of distinct quantities q was calculated from, counting q itself (or limit + 1, if it is larger)"""
+    seen = set()
+    stack = [q]
+    while stack:
+        if limit is not None and len(seen) > limit:
+            break
+        p = stack.pop()
+        if id(p) not in seen:
+            seen.add(id(p))
+            stack.extend(p.provenance or ())
+    return len(seen)
+
+
+def provenance_depth(q):
+    """The number of operations in a row leading to q. Unlike setdepth(), this does not recurse, so it can tell
+    whether the provenance of q is too deep to be shown."""
+    depth = {}
+    stack = [q]
+    while stack:
+        p = stack[-1]
+        if id(p) in depth:
+            stack.pop()
+            continue
+        pending = [child for child in p.provenance or () if id(child) not in depth]
+        if pending:
+            stack.extend(pending)
+        else:
+            depth[id(p)] = 1 + max(depth[id(child)] for child in p.provenance) if p.provenance else 0
+            stack.pop()
+    return depth[id(q)]
+
+
+no_sensitivity = {}
+
+
+def sensitivities(q):
+    """
+    The contributions of the inputs of q to its uncertainty, i.e. the derivatives of q with respect to its inputs
+    times their uncertainties. Each operation combines the contributions of its operands (forward mode), so the
+    entries only cover the inputs that q depends on. Unlike the uncertainty q.uncert, which adds the uncertainties
+    of the operands in quadrature, the contributions keep track of inputs that are used more than once, e.g. in
+    a - a or x / x.
+
+    An input is a quantity without sensitivity of its own: a known quantity, which is keyed by its name and the number
+    of its definition (name, version), or a number typed into a calculation, which is keyed by itself (see
+    fold_sensitivity). A known quantity defined for the first time has version 0; when its name is defined again, the
+    new quantity gets a version of its own, so it is not taken for the old one in results calculated from both. Exact
+    numbers and arrays have none.
+
+    :param q: quantity Q()
+    :return: dictionary of contributions, which must not be changed
+    """
+    sensitivity = q.sensitivity
+    if sensitivity is not None:
+        return sensitivity
+    if is_array(q.uncert) or not q.uncert:
+        return no_sensitivity
+    return {q if q.provenance or not q.name else (q.name, 0): q.uncert}
+
+
+def linear(sa, fa, sb=no_sensitivity, fb=0.0):
+    """The contributions fa * sa + fb * sb, for a result that depends on operands with contributions sa and sb"""
+    if not sb:
+        if fa == 1.0 or not sa:
+            return sa
+        return dict((key, fa * c) for key, c in sa.items())
+    if not sa and fb == 1.0:
+        return sb
+    sensitivity = dict((key, fa * c) for key, c in sa.items())
+    for key, c in sb.items():
+        sensitivity[key] = sensitivity.get(key, 0.0) + fb * c
+    return sensitivity
+
+
+def correlated_uncert(q):
+    """The uncertainty of q from the contributions of its inputs, which cancel where inputs are used repeatedly"""
+    return math_sqrt(sum(c * c for c in sensitivities(q).values()))
+
+
+def fold_sensitivity(q, definition):
+    """
+    The contributions to the uncertainty of a quantity that is about to be known by a name, with the numbers typed into
+    its calculation combined into one input for this definition of the name (so e.g. m = 2.0(1) g becomes an input m).
+
+    :param q: quantity Q()
+    :param definition: (name of the quantity, version), see sensitivities()
+    :return: dictionary of contributions keyed by the (name, version) of inputs
+    """
+    folded = {}
+    typed = 0.0
+    for key, c in sensitivities(q).items():
+        if isinstance(key, tuple):
+            folded[key] = c
+        else:
+            typed += c * c
+    if typed:
+        folded[definition] = math_sqrt(folded.get(definition, 0.0)**2 + typed)
+    return folded
+
+
+def contributions(q):
+    """
+    The uncertainty budget of q: each input with its share of the variance, largest first. Inputs of a name that was
+    defined more than once are told apart by the number of the definition, e.g. "a (definition 2)".
+
+    :param q: quantity Q()
+    :return: list of (name of the input, fraction of the variance)
+    """
+    sensitivity = sensitivities(q)
+    variance = sum(c * c for c in sensitivity.values())
+    definitions = collections.Counter(key[0] for key in sensitivity if isinstance(key, tuple))
+
+    def label(key):
+        if not isinstance(key, tuple):
+            return ascii_qvalue(key)
+        return key[0] if definitions[key[0]] == 1 else "%s (definition %d)" % (key[0], key[1] + 1)
+
+    budget = [(label(key), c * c / variance if variance else 0.0) for key, c in sensitivity.items()]
+    return sorted(budget, key=lambda item: (-item[1], item[0]))
 
 
 def uncert_sum(n, q1, q2):
@@ -588,6 +1096,189 @@ opprio["-%s"] = 3
 opprio["%s - %s"] = 2
 
 
+def parenthesize(name, index, q, child, level, subs):
+    """Puts parentheses around the string for a child q of an expression if needed (see Q.steps)"""
+    if ((q.provenance and level <= q.depth and opprio[name] > opprio[q.name] and opprio[name] and opprio[q.name] and not (subs and "/" in name)) or
+        (name.startswith("-") and child.startswith("-")) or
+        ("*" in name and index == 1 and child.startswith("-")) or
+        ("^" in name and q.units != unity and level >= 0) or
+        ("^" in name and child.startswith("-") and index == 0) or
+        ("^" in name and ("times" in child or "frac" in child))):
+        return "(" + child + ")"
+    return child
+
+
+
+def is_array(number):
+    module = sys.modules.get("numpy")  # no arrays can exist before NumPy is imported
+    return module is not None and isinstance(number, module.ndarray)
+
+
+def elementwise(number_text, value, number, uncert):
+    """Formats an array of values as [1.0, 2.0, 3.0], showing only the first and last three of long arrays
+
+    :param number_text: function formatting one element, given its (scaled) value, number and uncertainty
+    """
+    value, number, uncert = numpy.broadcast_arrays(value, number, uncert)
+    indexes = range(value.size) if value.size <= 8 else [0, 1, 2, None, value.size - 3, value.size - 2, value.size - 1]
+    texts = [number_text(value.flat[i], number.flat[i], uncert.flat[i]) if i is not None else "..." for i in indexes]
+    return "[%s]" % ", ".join(texts)
+
+
+def array_parts(q):
+    """The number and uncertainty of a Q or QArray as float arrays"""
+    return numpy.asarray(q.number, dtype=float), numpy.asarray(q.uncert, dtype=float)
+
+
+class QArray(Q):
+    """Many values of one kind of quantity (e.g. the readings of a titration) that share units and preferred units.
+
+    The number and the uncertainty are NumPy arrays of the same shape. Arithmetic with another QArray or with a Q
+    works element by element, and propagates the uncertainty with the same first-order formulas as Q.
+    The functions exp, log, ln, sqrt, sin, cos and tan accept a QArray, and sumover and average of a single QArray
+    add up its elements.
+
+    Example:
+      QArray([20.1, 20.4, 19.9], "", Units(m=3), 0.1e-6, ["mL"]) are three volumes of about 20 mL
+    """
+
+    __slots__ = ()
+
+    def __init__(self, numbers, name="", units=unity, uncert=0.0, prefu=(), provenance=None):
+        if numpy is None:
+            raise ImportError("QArray needs NumPy")
+        numbers, uncert = numpy.broadcast_arrays(numpy.asarray(numbers, dtype=float),
+                                                 numpy.asarray(uncert, dtype=float))
+        Q.__init__(self, numbers, name, units, uncert.copy(), prefu, provenance)
+
+    @staticmethod
+    def _make(number, name, units, uncert, prefu, provenance, sensitivity=None):
+        """Like Q._make(); arrays don't keep track of sensitivities"""
+        q = object.__new__(QArray)
+        q.number, uncert = numpy.broadcast_arrays(number, uncert)
+        q.name = name
+        q.units = units
+        q.uncert = uncert
+        q.prefu = prefu
+        q.provenance = provenance
+        q.sensitivity = None
+        return q
+
+    @staticmethod
+    def linspace(start, stop, points):
+        """Evenly spaced values from one Q to another, e.g. QArray.linspace(Q(273.15, units=Units(K=1)), ...)"""
+        if start.units is not stop.units:
+            raise_QuantError("Start and end of a range need the same units", "%s ... %s", (start, stop))
+        return QArray(numpy.linspace(float(start.number), float(stop.number), points), "", start.units,
+                      numpy.linspace(start.uncert, stop.uncert, points), inherit_binary(start, stop)[0])
+
+    def __getitem__(self, index):
+        """The element at index as Q, or a QArray for a slice"""
+        if isinstance(index, slice):
+            return QArray._make(self.number[index], self.name, self.units, self.uncert[index], self.prefu, None)
+        return Q._make(float(self.number[index]), self.name, self.units, float(self.uncert[index]), self.prefu, None)
+
+    @staticmethod
+    def _sum(q1, q2, sign):
+        a, ua = array_parts(q1)
+        b, ub = array_parts(q2)
+        if q1.units is not q2.units and numpy.any(a) and numpy.any(b):
+            raise_QuantError("Units in sum not compatible", "%s + %s" if sign > 0 else "%s - %s", (q1, q2))
+        number = a + b if sign > 0 else a - b
+        units = q1.units if numpy.any(a) else q2.units
+        prefu, provenance = inherit_binary(q1, q2)
+        return QArray._make(number, "%s + %s" if sign > 0 else "%s - %s", units, numpy.sqrt(ua**2 + ub**2), prefu,
+                            provenance)
+
+    @staticmethod
+    def _product(q1, q2):
+        a, ua = array_parts(q1)
+        b, ub = array_parts(q2)
+        number = a * b
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            uncert = numpy.where(number != 0, numpy.sqrt((ua / a)**2 + (ub / b)**2) * abs(number), 0.0)
+        prefu, provenance = inherit_binary(q1, q2)
+        return QArray._make(number, "%s * %s", q1.units.times(q2.units), uncert, prefu, provenance)
+
+    @staticmethod
+    def _quotient(q1, q2):
+        a, ua = array_parts(q1)
+        b, ub = array_parts(q2)
+        if not numpy.all(b):
+            raise_QuantError("denominator is zero", "%s / %s", (q1, q2))
+        number = a / b
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            uncert = numpy.where(a != 0, numpy.sqrt((ua / a)**2 + (ub / b)**2) * abs(number), 0.0)
+        prefu, provenance = inherit_binary(q1, q2)
+        return QArray._make(number, "%s / %s", q1.units.divided(q2.units), uncert, prefu, provenance)
+
+    @staticmethod
+    def _power(q1, q2):
+        a, ua = array_parts(q1)
+        b, ub = array_parts(q2)
+        if q2.units is not unity:
+            raise_QuantError("the exponent can't have units", "%s ^ %s", (q1, q2))
+        if q1.units is unity:
+            units = unity
+        else:
+            if isinstance(q2, QArray) or not hasattr(q2.number, 'denominator'):
+                raise_QuantError("can't raise units to irrational exponent", "%s ^ %s", (q1, q2))
+            if numpy.any(a < 0):
+                raise_QuantError("can't raise negative number to non-integral power", "%s ^ %s", (q1, q2))
+            if q2.number.denominator > max_unit_denominator:
+                raise_QuantError("can't raise units to a power with a denominator above %d" % max_unit_denominator,
+                                 "%s ^ %s", (q1, q2))
+            units = q1.units.power(q2.number)
+        with numpy.errstate(all='ignore'):
+            number = a ** b
+            if not numpy.all(numpy.isfinite(number)):
+                raise_QuantError("arithmetic problem", "%s ^ %s", (q1, q2))
+            uncert = numpy.where(a != 0, abs(ua / a * number * b) + abs(ub * numpy.log(abs(a)) * number), 0.0)
+        return QArray._make(number, "%s ^ %s", units, uncert, q1.prefu, (q1, q2))
+
+    def __add__(self, other): return QArray._sum(self, other, 1)
+
+    def __radd__(self, other): return QArray._sum(other, self, 1)
+
+    def __sub__(self, other): return QArray._sum(self, other, -1)
+
+    def __rsub__(self, other): return QArray._sum(other, self, -1)
+
+    def __mul__(self, other): return QArray._product(self, other)
+
+    def __rmul__(self, other): return QArray._product(other, self)
+
+    def __truediv__(self, other): return QArray._quotient(self, other)
+
+    def __rtruediv__(self, other): return QArray._quotient(other, self)
+
+    def __div__(self, other): return QArray._quotient(self, other)
+
+    def __rdiv__(self, other): return QArray._quotient(other, self)
+
+    def __pow__(self, other): return QArray._power(self, other)
+
+    def __rpow__(self, other): return QArray._power(other, self)
+
+    def __neg__(self):
+        return QArray._make(-self.number, "-%s", self.units, self.uncert, self.prefu, (self,))
+
+    def function(self, name, number, uncert):
+        """The result of applying a function (e.g. exp) to the elements, with the name of the function"""
+        return QArray._make(number, name, self.units, uncert, self.prefu, (self,))
+
+    def sumover(self):
+        """The sum of the elements as Q"""
+        return Q._make(float(self.number.sum()), "\\mathrm{sumover}(%s)", self.units,
+                       float(numpy.sqrt((self.uncert**2).sum())), self.prefu, (self,))
+
+    def average(self):
+        """The mean of the elements as Q"""
+        n = self.number.size
+        return Q._make(float(self.number.sum()) / n, "\\mathrm{average}(%s)", self.units,
+                       float(numpy.sqrt((self.uncert**2).sum())) / n, self.prefu, (self,))
+
+
 known_units = dict(
     A=(1, Units(A=1)),
     g=(Fraction(1,1000), Units(kg=1)),
@@ -629,124 +1320,347 @@ metric_prefices = dict(
 
 metric_prefices['μ']= Fraction(1,1000000)
 
-unitquant = {}
-for unit in known_units:
-    unitquant[unit] = Q(known_units[unit][0], unit, known_units[unit][1], prefu=[unit])
-    if unit in ["cm", "h", "d", "atm", "kg", "min", "mmHg", "$"]:
-        continue
-    for prefix in metric_prefices:
-        unitquant[prefix + unit] = Q(known_units[unit][0] * metric_prefices[prefix], prefix + unit,
-                                     known_units[unit][1], prefu=[prefix + unit])
 
+class UnitRegistry(dict):
+    """The quantity 1 unit for each unit known by name, e.g. unitquant["mL"]
+
+    Units with a metric prefix are made when they are first looked up (with [], get() or in), and kept from then on,
+    so iterating over the registry only gives the units used so far. More units can be added from a table (see load),
+    e.g. from the file named in the environment variable PQCALC_UNITS.
+
+    Attributes:
+      units(dict): value in SI units and Units() for each unit without prefix, e.g. known_units
+      prefixes(dict): factor for each metric prefix, e.g. metric_prefices
+      unprefixed(set): units that don't take a prefix, e.g. "min"
+      caches(list): caches holding results of earlier lookups (e.g. unit_layouts), cleared whenever a unit is added
+    """
+
+    def __init__(self, units, prefixes, unprefixed):
+        dict.__init__(self)
+        self.units = units
+        self.prefixes = prefixes
+        self.unprefixed = set(unprefixed)
+        self.caches = []
+
+    def resolve(self, name):
+        """The quantity for the unit called name, made on first use, or None for names that are not units"""
+        q = dict.get(self, name)
+        if q is None:
+            if name in self.units:
+                number, units = self.units[name]
+            elif name[:1] in self.prefixes and name[1:] in self.units and name[1:] not in self.unprefixed:
+                number, units = self.units[name[1:]]
+                number = number * self.prefixes[name[:1]]
+            else:
+                return None
+            q = Q(number, name, units, prefu=[name])
+            dict.__setitem__(self, name, q)
+        return q
+
+    def __missing__(self, name):
+        q = self.resolve(name)
+        if q is None:
+            raise KeyError(name)
+        return q
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or self.resolve(name) is not None
+
+    def get(self, name, default=None):
+        q = self.resolve(name)
+        return default if q is None else q
+
+    def add(self, name, number, units, prefixable=True):
+        """Adds (or redefines) the unit called name, with its value in SI units as number and units as Units()"""
+        self.units[name] = (number, units)
+        if prefixable:
+            self.unprefixed.discard(name)
+        else:
+            self.unprefixed.add(name)
+        for key in [name] + [prefix + name for prefix in self.prefixes]:
+            dict.pop(self, key, None)
+        for cache in self.caches:
+            cache.clear()
+
+    def load(self, table):
+        """
+        Adds the units of a table with one unit per line: its name, its value in SI units, the SI units and
+        optionally "noprefix", e.g. "bar 100000 kg m^-1 s^-2" or "Torr 101325/760 kg m^-1 s^-2 noprefix".
+        Anything after # is a comment.
+
+        :param table: the text of the table
+        :raise ValueError: for lines that can't be read
+        """
+        for line in table.splitlines():
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            if len(fields) < 2:
+                raise ValueError("unit %s needs a value" % fields[0])
+            name, value, rest = fields[0], fields[1], fields[2:]
+            prefixable = not (rest and rest[-1] == "noprefix")
+            exponents = [0] * len(SIunit_symbols)
+            for factor in rest[:None if prefixable else -1]:
+                symbol, _, power = factor.partition("^")
+                if symbol not in SIunit_symbols:
+                    raise ValueError("%s is not an SI unit (in the line for %s)" % (symbol, name))
+                exponents[SIunit_symbols.index(symbol)] += Fraction(power) if power else 1
+            number = Fraction(value) if "/" in value else float(value) if "." in value or "e" in value else int(value)
+            self.add(name, number, Units(*exponents), prefixable)
+
+
+unitquant = UnitRegistry(known_units, metric_prefices, ["cm", "h", "d", "atm", "kg", "min", "mmHg", "$"])
+unitquant.caches.extend([unit_layouts, literals])
+if os.environ.get('PQCALC_UNITS'):
+    with io.open(os.environ['PQCALC_UNITS'], encoding='utf-8') as table:
+        unitquant.load(table.read())
+
+@hash_consed("absolute(%s)")
 def absolute(m):
-    return Q(abs(m.number), "\\mathrm{absolute}(%s)", m.units, m.uncert, m.prefu, (m,))
+    return Q._make(abs(m.number), "\\mathrm{absolute}(%s)", m.units, m.uncert, m.prefu, (m,),
+                   linear(sensitivities(m), -1.0 if m.number < 0 else 1.0))
 
 
+@hash_consed("minimum(%s)")
 def minimum(*a):
     units = a[0].units
     for q in a:
         if units != q.units:
             raise_QuantError("Can't compare quantities with different dimensions", "minimum(%s, ... %s)", (a[0],q))
     m = min(*a, key=lambda x: x.number)
-    return Q(m.number, "\\mathrm{minimum}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a))
+    return Q._make(m.number, "\\mathrm{minimum}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a),
+                   sensitivities(m))
 
 
+@hash_consed("maximum(%s)")
 def maximum(*a):
     units = a[0].units
     for q in a:
         if units != q.units:
             raise_QuantError("Can't compare quantities with different dimensions", "maximum(%s, ... %s)", (a[0],q))
     m = max(*a, key=lambda x: x.number)
-    return Q(m.number, "\\mathrm{minimum}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a))
+    return Q._make(m.number, "\\mathrm{maximum}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a),
+                   sensitivities(m))
 
 
+@hash_consed("average(%s)")
 def average(*a):
-    units = a[0].units
-    for q in a:
-        if units != q.units:
-            raise_QuantError("Can't average quantities with different dimensions", "average(%s, ... %s)", (a[0],q))
-    m = sum(a,Q(0.0))/Q(len(a))
-    return Q(m.number, "\\mathrm{average}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a))
+    if len(a) == 1 and isinstance(a[0], QArray):
+        return a[0].average()
+    m = add_up(a, "Can't average quantities with different dimensions", "average(%s, ... %s)")
+    if isinstance(m, QArray):
+        m = m / Q.from_float(len(a))
+    else:
+        m = Q._make(m.number / len(a), "", m.units, m.uncert / len(a), m.prefu, None, linear(m.sensitivity, 1.0 / len(a)))
+    return type(m)._make(m.number, "\\mathrm{average}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a),
+                         m.sensitivity)
 
 
+@hash_consed("sumover(%s)")
 def sumover(*a):
-    units = a[0].units
-    for q in a:
-        if units != q.units:
-            raise_QuantError("Can't add quantities with different dimensions", "sumover(%s, ... %s)", (a[0],q))
-    m = sum(a,Q(0.0))
-    return Q(m.number, "\\mathrm{sumover}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a))
+    if len(a) == 1 and isinstance(a[0], QArray):
+        return a[0].sumover()
+    m = add_up(a, "Can't add quantities with different dimensions", "sumover(%s, ... %s)")
+    return type(m)._make(m.number, "\\mathrm{sumover}(%s)" % ", ".join(["%s"] * len(a)), m.units, m.uncert, m.prefu, tuple(a),
+                         m.sensitivity)
+
+
+@hash_consed("stdev(%s)")
+def stdev(*a):
+    """
+    The sample standard deviation of the values, with the uncertainty of a standard deviation estimated from n values,
+    s / sqrt(2 (n - 1)) (the uncertainties of the values themselves are not part of it)
+    """
+    numbers, units, prefu = sample(a, "Can't take stdev() of quantities with different dimensions",
+                                   "stdev(%s, ... %s)")
+    n = len(numbers)
+    if n < 2:
+        raise_QuantError("stdev() needs at least two values", "\\mathrm{stdev}(%s)", tuple(a))
+    mean = math.fsum(numbers) / n
+    s = math_sqrt(math.fsum((x - mean)**2 for x in numbers) / (n - 1))
+    return Q._make(s, "\\mathrm{stdev}(%s)" % ", ".join(["%s"] * len(a)), units, s / math_sqrt(2 * (n - 1)), prefu,
+                   tuple(a))
+
+
+@hash_consed("median(%s)")
+def median(*a):
+    """The middle value (or the mean of the two middle values), with its uncertainty"""
+    numbers, units, prefu = sample(a, "Can't take median() of quantities with different dimensions",
+                                   "median(%s, ... %s)")
+    n = len(numbers)
+    order = sorted(range(n), key=numbers.__getitem__)
+    middle = order[(n - 1) // 2], order[n // 2]
+    if len(a) == 1:
+        uncerts = [float(u) for u in a[0].uncert.flat]
+        sa = sb = no_sensitivity
+    else:
+        uncerts = [q.uncert for q in a]
+        sa, sb = sensitivities(a[middle[0]]), sensitivities(a[middle[1]])
+    if middle[0] == middle[1]:
+        number, uncert, sensitivity = numbers[middle[0]], uncerts[middle[0]], sa
+    else:
+        number = (numbers[middle[0]] + numbers[middle[1]]) / 2
+        uncert = math_sqrt(uncerts[middle[0]]**2 + uncerts[middle[1]]**2) / 2
+        sensitivity = linear(sa, 0.5, sb, 0.5)
+    return Q._make(number, "\\mathrm{median}(%s)" % ", ".join(["%s"] * len(a)), units, uncert, prefu, tuple(a),
+                   sensitivity)
+
 
+def linfit(*a):
+    """
+    The least-squares straight line through points (x, y), given as the x values followed by as many y values, or as
+    two QArrays. The uncertainties of slope and intercept are estimated from the scatter of the points around the line
+    (the uncertainties of the values themselves are not part of it).
 
+    :return: slope and intercept as Q()
+    """
+    name = "(%s)" % ", ".join(["%s"] * len(a))
+    if len(a) % 2:
+        raise_QuantError("linfit() needs as many y values as x values", "\\mathrm{linfit}" + name, tuple(a))
+    half = len(a) // 2
+    complaint = "The %s values of linfit() have different dimensions"
+    xs, xunits, xprefu = sample(a[:half], complaint % "x", "linfit(%s, ... %s)")
+    ys, yunits, yprefu = sample(a[half:], complaint % "y", "linfit(%s, ... %s)")
+    n = len(xs)
+    if n < 3 or len(ys) != n:
+        raise_QuantError("linfit() needs at least three points (x, y)", "\\mathrm{linfit}" + name, tuple(a))
+    xmean, ymean = math.fsum(xs) / n, math.fsum(ys) / n
+    sxx = math.fsum((x - xmean)**2 for x in xs)
+    if not sxx:
+        raise_QuantError("the x values of linfit() are all the same", "\\mathrm{linfit}" + name, tuple(a))
+    slope = math.fsum((x - xmean) * (y - ymean) for x, y in zip(xs, ys)) / sxx
+    intercept = ymean - slope * xmean
+    scatter = math.fsum((y - intercept - slope * x)**2 for x, y in zip(xs, ys)) / (n - 2)
+    prefu = merged_prefu(xprefu, yprefu)
+    return (Q._make(slope, "\\mathrm{slope}" + name, yunits.divided(xunits), math_sqrt(scatter / sxx), prefu, tuple(a)),
+            Q._make(intercept, "\\mathrm{intercept}" + name, yunits, math_sqrt(scatter * (1 / n + xmean**2 / sxx)),
+                    prefu, tuple(a)))
+
+
+@hash_consed("slope(%s)")
+def slope(*a):
+    return linfit(*a)[0]
+
+
+@hash_consed("intercept(%s)")
+def intercept(*a):
+    return linfit(*a)[1]
+
+
+@hash_consed("exp(%s)")
 def exp(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take e to the power of quantity with units", "exp(%s)", (a,))
+        with numpy.errstate(over='ignore'):
+            number = numpy.exp(a.number)
+        if not numpy.all(numpy.isfinite(number)):
+            raise_QuantError("The exponent is too large for this calculator", "exp(%s)", (a,))
+        return a.function("exp(%s)", number, abs(a.uncert * number))
     try:
         if a.units == unity:
             number = math_exp(a.number)
-            return Q(number, "exp(%s)", a.units, abs(a.uncert * number), a.prefu, (a,))
+            return Q._make(number, "exp(%s)", a.units, abs(a.uncert * number), a.prefu, (a,),
+                           linear(sensitivities(a), number))
         else:
             raise_QuantError("Can't take e to the power of quantity with units", "exp(%s)", (a,))
     except OverflowError:
         raise_QuantError("The exponent is too large for this calculator", "exp(%s)", (a,))
 
 
+@hash_consed("sqrt(%s)")
 def sqrt(a):
-    if a.number < 0.0:
+    if numpy.any(a.number < 0.0) if isinstance(a, QArray) else a.number < 0.0:
         raise_QuantError("Won't take square root of negative number", "sqrt(%s)", (a,))
-    answer = a ** Q('1/2')
-    answer.name = "sqrt(%s)"
-    answer.provenance = (a,)
-    return answer
+    answer = a ** Q.literal('1/2')
+    return type(answer)._make(answer.number, "sqrt(%s)", answer.units, answer.uncert, answer.prefu, (a,),
+                              answer.sensitivity)
 
 
+@hash_consed("log(%s)")
 def log(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take log() of quantity with units", "log(%s)", (a,))
+        if numpy.any(a.number <= 0):
+            raise_QuantError("The argument of log() can't be zero or negative", "log(%s)", (a,))
+        return a.function("log(%s)", numpy.log10(a.number), abs(a.uncert / a.number))
     try:
         if a.units == unity:
             number = math_log10(a.number)
-            return Q(number, "log(%s)", a.units, abs(a.uncert / a.number), a.prefu, (a,))
+            return Q._make(number, "log(%s)", a.units, abs(a.uncert / a.number), a.prefu, (a,),
+                           linear(sensitivities(a), 1.0 / (a.number * math_log(10.0))))
         else:
             raise_QuantError("Can't take log() of quantity with units", "log(%s)", (a,))
     except ValueError:
         raise_QuantError("The argument of log() can't be zero or negative", "log(%s)", (a,))
 
 
+@hash_consed("ln(%s)")
 def ln(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take ln() of quantity with units", "ln(%s)", (a,))
+        if numpy.any(a.number <= 0):
+            raise_QuantError("The argument of ln() can't be zero or negative", "ln(%s)", (a,))
+        return a.function("ln(%s)", numpy.log(a.number), abs(a.uncert / a.number))
     try:
         if a.units == unity:
             number = math_log(a.number)
-            return Q(number, "ln(%s)", a.units, abs(a.uncert / a.number), a.prefu, (a,))
+            return Q._make(number, "ln(%s)", a.units, abs(a.uncert / a.number), a.prefu, (a,),
+                           linear(sensitivities(a), 1.0 / a.number))
         else:
             raise_QuantError("Can't take ln() of quantity with units", "ln(%s)", (a,))
     except ValueError:
         raise_QuantError("The argument of ln() can't be zero or negative", "ln(%s)", (a,))
 
 
+@hash_consed("sin(%s)")
 def sin(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take sin() of quantity with units", "sin(%s)", (a,))
+        return a.function("sin(%s)", numpy.sin(a.number), abs(a.uncert * numpy.cos(a.number)))
     try:
         if a.units == unity:
             number = math_sin(a.number)
-            return Q(number, "sin(%s)", a.units, abs(a.uncert * math_cos(a.number)), a.prefu, (a,))
+            return Q._make(number, "sin(%s)", a.units, abs(a.uncert * math_cos(a.number)), a.prefu, (a,),
+                           linear(sensitivities(a), math_cos(a.number)))
         else:
             raise_QuantError("Can't take sin() of quantity with units", "sin(%s)", (a,))
     except ValueError:
         raise_QuantError("argument of sin()?", "sin(%s)", (a,))
 
 
+@hash_consed("cos(%s)")
 def cos(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take cos() of quantity with units", "cos(%s)", (a,))
+        return a.function("cos(%s)", numpy.cos(a.number), abs(a.uncert * numpy.sin(a.number)))
     try:
         if a.units == unity:
             number = math_cos(a.number)
-            return Q(number, "cos(%s)", a.units, abs(a.uncert * math_sin(a.number)), a.prefu, (a,))
+            return Q._make(number, "cos(%s)", a.units, abs(a.uncert * math_sin(a.number)), a.prefu, (a,),
+                           linear(sensitivities(a), -math_sin(a.number)))
         else:
             raise_QuantError("Can't take cos() of quantity with units", "cos(%s)", (a,))
     except ValueError:
         raise_QuantError("argument of cos()?", "cos(%s)", (a,))
 
 
+@hash_consed("tan(%s)")
 def tan(a):
+    if isinstance(a, QArray):
+        if a.units is not unity:
+            raise_QuantError("Can't take tan() of quantity with units", "tan(%s)", (a,))
+        number = numpy.tan(a.number)
+        return a.function("tan(%s)", number, a.uncert * (1 + number**2))
     try:
         if a.units == unity:
             number = math_tan(a.number)
-            return Q(number, "tan(%s)", a.units, a.uncert * (1 + number**2), a.prefu, (a,))
+            return Q._make(number, "tan(%s)", a.units, a.uncert * (1 + number**2), a.prefu, (a,),
+                           linear(sensitivities(a), 1 + number**2))
         else:
             raise_QuantError("Can't take tan() of quantity with units", "tan(%s)", (a,))
     except ValueError:
@@ -754,8 +1668,8 @@ def tan(a):
 
 
 def quad(A, B, C):
-    BB = B ** Q(2)
-    AC4 = Q(4) * A * C
+    BB = B ** Q.from_float(2)
+    AC4 = Q.from_float(4) * A * C
     if BB.units != AC4.units:
         raise_QuantError("B * B has to have the same units as 4 * A * C ", "quad(%s, %s, %s)", (A, B, C))
     discriminant = BB - AC4
@@ -763,13 +1677,12 @@ def quad(A, B, C):
         raise_QuantError("discriminant %f is negative, can't take its root" % discriminant.number, "quad(%s, %s, %s)",
                          (A, B, C))
     root = sqrt(discriminant)
-    sol_big, sol_small = (-B + root) / (Q(2) * A), (-B - root) / (Q(2) * A)
+    sol_big, sol_small = (-B + root) / (Q.from_float(2) * A), (-B - root) / (Q.from_float(2) * A)
     if B.number > 0:
         sol_big, sol_small = sol_small, sol_big
     if abs(abs(B.number) - root.number) < 0.000001:
-        sol_big_temp = Q(sol_big.number, uncert=sol_big.uncert, units=sol_big.units, prefu=sol_big.prefu)
-        sol_big_temp.provenance = (A, B, C)
-        sol_big_temp.name = "(quadp(%s, %s, %s))"
+        sol_big_temp = Q._make(sol_big.number, "(quadp(%s, %s, %s))", sol_big.units, sol_big.uncert, sol_big.prefu,
+                               (A, B, C), sol_big.sensitivity)
         sol_small = C / A / sol_big_temp
     return sol_big, sol_small
 
@@ -782,20 +1695,29 @@ def quadn(A, B, C):
     return quad(A, B, C)[1]
 
 
+@hash_consed("moredigits(%s)")
 def moredigits(a):
-    return Q(a.number, "moredigits(%s)", a.units, a.uncert / 100000., a.prefu, [a])
+    return Q._make(a.number, "moredigits(%s)", a.units, a.uncert / 100000., a.prefu, [a],
+                   linear(sensitivities(a), 1 / 100000.))
 
+@hash_consed("uncertainty(%s)")
 def uncertainty(a):
-    return Q(a.uncert, "uncertainty(%s)", a.units, a.uncert / 100000., a.prefu, [a])
+    return Q._make(a.uncert, "uncertainty(%s)", a.units, a.uncert / 100000., a.prefu, [a])
+
+@hash_consed("budget(%s)")
+def budget(a):
+    """The uncertainty of a, with inputs that were used repeatedly correlated (see sensitivities)"""
+    uncert = correlated_uncert(a)
+    return Q._make(uncert, "budget(%s)", a.units, uncert / 100000., a.prefu, [a])
 
 
-Kelvin = Q("K")
-Kelvinshift = Q(273.15) * Kelvin
+Kelvin = Q.unit("K")
+Kelvinshift = Q.from_float(273.15) * Kelvin
 
 
 def FtoKscale(a):
     if a.units == unity and not a.provenance:
-        Kscale = (a - Q(32)) * Q(5) / Q(9) * Kelvin + Kelvinshift
+        Kscale = (a - Q.from_float(32)) * Q.from_float(5) / Q.from_float(9) * Kelvin + Kelvinshift
         if Kscale.number < 0:
             raise_QuantError("Input temperature is lower than absolute zero", "text{FtoKscale}(%s)", (a,))
         return Kscale
@@ -813,7 +1735,7 @@ def CtoKscale(a):
         raise_QuantError("Input temperature has to be a unit-less number", "text{CtoKscale}(%s)", (a,))
 
 
-functions = '''sin cos tan exp sqrt log ln quadp quadn minimum maximum absolute CtoKscale FtoKscale moredigits uncertainty average sumover'''.split(" ")
+functions = '''sin cos tan exp sqrt log ln quadp quadn minimum maximum absolute CtoKscale FtoKscale moredigits uncertainty budget average sumover stdev median slope intercept'''.split(" ")
 unit_list = []
 
 if __name__ == "__main__":
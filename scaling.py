@@ -0,0 +1,236 @@
+# coding=utf-8
+"""
+Synthetic worksheets for finding out how the calculator scales, and a report of calc() time and memory against the
+size of the worksheet.
+
+The examples of the help page (see benchmark.py) are small. worksheet() writes inputs with any number of lines,
+symbols, depth of the expressions, units per number-unit cluster and arguments to sumover(), in one of three notations
+for the uncertainty. Each line may use the result of the line before it, so that the inputs each result depends on
+(its sensitivities) grow with the worksheet.
+
+The report varies one parameter at a time (doubling it), keeping the others at their defaults, and fits a line through
+the log-log points: a slope near 1 is linear, near 2 quadratic. Slopes above 1.5 are flagged.
+
+Usage:
+  python scaling.py
+  python scaling.py --parameter lines --parameter depth --csv scaling.csv
+
+Example:
+  >>> print(worksheet(lines=2, symbols=3, depth=1, units=2, terms=2))
+  x1 = 8.59 kg m
+  ...
+  r1 = sumover((r0 + x2) * x2 / x3, x2)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import io
+import math
+import random
+import sys
+from timeit import default_timer
+
+import calculator
+from benchmark import clear_caches, show
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+unit_names = ["kg", "m", "s", "mol", "K", "A", "J", "N", "Pa", "W", "C", "V", "L", "g", "Hz"]
+
+notations = ["digits", "parentheses", "exact"]
+
+defaults = dict(lines=20, symbols=20, depth=3, units=2, terms=4, notation="digits", chain=True)
+
+sweeps = dict(lines=[10, 20, 40, 80, 160],
+              symbols=[10, 20, 40, 80, 160, 320],
+              depth=[1, 2, 4, 8, 16],
+              units=[1, 2, 4, 8, 15],
+              terms=[2, 4, 8, 16, 32, 64])
+
+
+def number(rng, notation):
+    """A random number between 1 and 10, written with its uncertainty given by the digits (2.50), in parentheses
+    (2.503(4)), or as an exact integer (3)"""
+    if notation == "digits":
+        return "%.2f" % rng.uniform(1, 9.99)
+    if notation == "parentheses":
+        return "%.3f(%d)" % (rng.uniform(1, 9.99), rng.randint(1, 9))
+    if notation == "exact":
+        return "%d" % rng.randint(1, 9)
+    raise ValueError("notation is one of %s" % ", ".join(notations))
+
+
+def worksheet(lines=20, symbols=20, depth=3, units=2, terms=4, notation="digits", chain=True, seed=0):
+    """
+    Input for calc() defining symbols with the same units, then lines computing results from them. Each expression has
+    the units of the symbols, so all of them can be added up.
+
+    :param lines: number of results r0, r1, ...
+    :param symbols: number of quantities x1, x2, ... defined at the top
+    :param depth: nesting of each expression, e.g. ((a + b) * c / d + e) * f / g for depth 2
+    :param units: number of units in each cluster, e.g. "kg m s" for 3 (at most len(unit_names))
+    :param terms: number of arguments to sumover() on each line (1 for no sumover)
+    :param notation: one of notations, for the numbers of the symbols
+    :param chain: start the expression of each result with the result before it, so each depends on more inputs
+    :param seed: seed of the random choice of numbers and symbols
+    :return: the worksheet, one command per line
+    """
+    if not 1 <= units <= len(unit_names):
+        raise ValueError("units is between 1 and %d" % len(unit_names))
+    rng = random.Random(seed)
+    cluster = " ".join(unit_names[:units])
+    names = ["x%d" % (i + 1) for i in range(symbols)]
+    commands = ["__showuncert__ = 1"] if notation == "parentheses" else []
+    for name in names:
+        commands.append("%s = %s %s" % (name, number(rng, notation), cluster))
+    for i in range(lines):
+        expression = "r%d" % (i - 1) if chain and i else rng.choice(names)
+        for d in range(depth):
+            expression = "(%s + %s) * %s / %s" % (expression, rng.choice(names), rng.choice(names), rng.choice(names))
+        if terms > 1:
+            expression = "sumover(%s)" % ", ".join([expression] + [rng.choice(names) for t in range(terms - 1)])
+        commands.append("r%d = %s" % (i, expression))
+    return "\n".join(commands)
+
+
+def measure(commands, repeat=3, mob='ipud'):
+    """
+    Times calc() with cold caches, and counts what a State holds after the calculation (not what the calculation
+    left in the caches)
+
+    :param commands: a worksheet
+    :param repeat: number of timed calculations, of which the fastest counts
+    :return: seconds, number of objects kept in the State, KiB kept in the State (None on Python 2)
+    :raise calculator.CalcError: if the worksheet does not calculate without errors
+    """
+    seconds = []
+    for i in range(repeat):
+        clear_caches()
+        start = default_timer()
+        outp, logp, mem, known, oneline, good_input, linespace = calculator.calc("", commands, mob)
+        seconds.append(default_timer() - start)
+        if good_input != commands:
+            raise calculator.CalcError("worksheet failed after %d lines" % len(good_input.split("\n")))
+    clear_caches()
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        if tracemalloc is not None:
+            tracemalloc.start()
+        state = calculator.State(None, mob)
+        calculator.calc(state, commands, mob)
+        clear_caches()  # what is left is held by the State
+        gc.collect()
+        kib = None
+        if tracemalloc is not None:
+            kib = tracemalloc.get_traced_memory()[0] / 1024
+            tracemalloc.stop()
+        objects = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    return min(seconds), objects, kib
+
+
+def slope(xs, ys):
+    """Slope of the least-squares line through the points (log x, log y), i.e. the exponent of a power law"""
+    points = [(math.log(x), math.log(y)) for x, y in zip(xs, ys) if x > 0 and y > 0]
+    if len(points) < 2:
+        return None
+    mx = sum(p[0] for p in points) / len(points)
+    my = sum(p[1] for p in points) / len(points)
+    sxx = sum((p[0] - mx) ** 2 for p in points)
+    return sum((p[0] - mx) * (p[1] - my) for p in points) / sxx if sxx else None
+
+
+def vary(parameter, values=None, repeat=3, **settings):
+    """
+    :param parameter: the parameter of worksheet() to vary
+    :param values: the values it takes (default: sweeps[parameter])
+    :param settings: the other parameters of worksheet(), instead of the defaults
+    :return: dictionary with the parameter, its values, the seconds, objects and KiB for each (None for those that
+             failed, with the error in "errors"), and the log-log slopes of seconds and objects
+    """
+    fixed = dict(defaults, **settings)
+    values = values or sweeps[parameter]
+    result = dict(parameter=parameter, values=values, seconds=[], objects=[], kib=[], errors=[])
+    for value in values:
+        fixed[parameter] = value
+        try:
+            seconds, objects, kib = measure(worksheet(**fixed), repeat)
+            error = None
+        except (calculator.CalcError, RuntimeError) as err:
+            seconds, objects, kib, error = None, None, None, "%s" % err
+        for key, v in [("seconds", seconds), ("objects", objects), ("kib", kib), ("errors", error)]:
+            result[key].append(v)
+    ok = [i for i, s in enumerate(result["seconds"]) if s is not None]
+    result["time_slope"] = slope([values[i] for i in ok], [result["seconds"][i] for i in ok])
+    result["memory_slope"] = slope([values[i] for i in ok], [result["objects"][i] for i in ok])
+    return result
+
+
+def report(results, width=40):
+    """The results of vary() as tables, with a bar for the time on a log scale so that the shape of the curve shows"""
+    lines = []
+    for r in results:
+        time_slope = "-" if r["time_slope"] is None else "%.2f" % r["time_slope"]
+        memory_slope = "-" if r["memory_slope"] is None else "%.2f" % r["memory_slope"]
+        flag = "  SUPERLINEAR" if (r["time_slope"] or 0) > 1.5 or (r["memory_slope"] or 0) > 1.5 else ""
+        lines.append("%s: time ~ n^%s, memory ~ n^%s%s" % (r["parameter"], time_slope, memory_slope, flag))
+        lines.append("%8s %10s %9s %9s" % (r["parameter"], "ms", "objects", "KiB"))
+        finished = [s for s in r["seconds"] if s is not None]
+        low, high = (math.log(min(finished)), math.log(max(finished))) if finished else (0, 0)
+        for value, seconds, objects, kib, error in zip(r["values"], r["seconds"], r["objects"], r["kib"],
+                                                       r["errors"]):
+            if error:
+                lines.append("%8s %s" % (value, error))
+                continue
+            bar = 1 + int((width - 1) * (math.log(seconds) - low) / (high - low)) if high > low else 1
+            lines.append("%8s %10.2f %9d %9s %s" % (value, seconds * 1000, objects,
+                                                   "-" if kib is None else "%.0f" % kib, "#" * bar))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def csv(results):
+    """The results of vary() as comma-separated values, for plotting elsewhere"""
+    lines = ["parameter,value,seconds,objects,kib"]
+    for r in results:
+        for value, seconds, objects, kib in zip(r["values"], r["seconds"], r["objects"], r["kib"]):
+            lines.append(",".join("" if v is None else "%s" % v for v in [r["parameter"], value, seconds, objects, kib]))
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="How calc() time and memory grow with the size of a worksheet")
+    parser.add_argument("--parameter", action="append", choices=sorted(sweeps),
+                        help="vary only this parameter (may be given several times)")
+    parser.add_argument("--notation", choices=notations, default=defaults["notation"],
+                        help="how the uncertainty of the numbers is written")
+    parser.add_argument("--no-chain", action="store_true", help="don't use the result of the line before")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calculations per point (the fastest counts)")
+    parser.add_argument("--csv", help="also write the points to this file")
+    parser.add_argument("--show", action="store_true", help="print the worksheet with the default parameters")
+    args = parser.parse_args(argv)
+    settings = dict(notation=args.notation, chain=not args.no_chain)
+    if args.show:
+        show(worksheet(**dict(defaults, **settings)))
+        return 0
+    results = [vary(p, repeat=args.repeat, **settings) for p in (args.parameter or sorted(sweeps))]
+    show(report(results))
+    if args.csv:
+        with io.open(args.csv, "w", encoding="utf-8") as f:
+            f.write(csv(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -30,22 +30,54 @@ urls = (
     '/custom', 'preload',
     '/homework/(.*)', 'homework',
     '/(js|css|png|ico)/(.*)', 'static',
-    '/example(.*)', 'example'
+    '/example(.*)', 'example',
+    '/metrics', 'metrics_page'
 )
 
+import os
+import signal
 import sys
 
 sys.path.append("/var/www")
 
 from calculator import calc, State, markup_comments
-from form import newform, printableLog, helpform
+from form import newform, printableLog, helpform, example_dict, static_selectors
 from ChemEq import talk_to_student
+from sessions import SessionStore
+import calculator
+import metrics
+import quantities
+import workers
+
+# Memory sent to the browser is signed with the key in PQCALC_SECRET. Without it, a key is made once and kept in the file
+# PQCALC_SECRET_FILE (default: .pqcalc_secret next to statecodec.py); servers on several hosts need the same PQCALC_SECRET
+# Unsigned memory of older versions is only read with PQCALC_LEGACY_MEMORY set (e.g. for a while after an upgrade)
+# Set PQCALC_SESSIONS to the path of a SQLite file to keep sessions on the server instead of in hidden form fields
+sessions = SessionStore(os.environ['PQCALC_SESSIONS']) if os.environ.get('PQCALC_SESSIONS') else None
+
+# Set PQCALC_POOL to the number of worker processes to run calculations in (see workers.py), with PQCALC_QUEUE
+# requests waiting for a free worker at most, and PQCALC_TIMEOUT seconds for each request
+pool = None
+
+
+def run_calc(memory, commands, mob):
+    """calc() in the pool of worker processes, if there is one, otherwise in the thread of the request"""
+    if pool is None:
+        return calc(memory, commands, mob)
+    try:
+        return pool.calc(memory, commands, mob)
+    except workers.PoolError as err:
+        state = memory if isinstance(memory, State) else State(memory, mob)
+        state.start_request()
+        state.printit('<div style="color: red;">%s</div><br>' % err)
+        return state.export(with_memory=(state is not memory))
 
 class index:
     """
     Defines the home page of the PQCalc server.
 
     """
+    @metrics.timed("get")
     def GET(self):
         web.header('Content-Type', 'text/html; charset=utf-8', unique=True)
         known = [" -- nothing yet -- "]
@@ -56,6 +88,7 @@ class index:
         return newform("", "", "", known, "", mobile, False, "")
 
 
+    @metrics.timed("post")
     def POST(self):
         """
         Load quantities defined previously by the user, process current commands and output results.
@@ -73,18 +106,34 @@ class index:
         except:
             return newform("", "", "", "", "", mobile, False, "")
 
-        oldsymbols = state['memory']
-        logbook = state['logbook']
-        inputlog = state['inputlog']
+        if sessions is None:
+            return self.respond(state, mobile, "", state['memory'], state['logbook'], state['inputlog'])
+        session = sessions.valid_id(state.get('session', ''))
+        with sessions.locked(session):  # the State of the session is changed until it is saved
+            oldsymbols = sessions.load(session, mobile)
+            logbook, inputlog = sessions.logs(session)
+            return self.respond(state, mobile, session, oldsymbols, logbook, inputlog)
+
+    def respond(self, state, mobile, session, oldsymbols, logbook, inputlog):
+        """
+        Process current commands (or export the log, or show help) with the quantities defined previously
+
+        :param state: the input of the form
+        :param session: id of the session kept on the server, or "" if the memory comes from the form
+        :param oldsymbols: the State of the session, or the memory from the form
+        """
         if state['sub'] == "export":
-            allsymbols = State(oldsymbols, mobile)
+            allsymbols = oldsymbols if session else State(oldsymbols, mobile)
             return printableLog(allsymbols, logbook, inputlog)
         if state['sub'] == "help":
             return helpform(mobile)
         commands = state['commands']
-        outp, logp, mem, known, oneline, good_input,linespace = calc(oldsymbols, commands, mobile)
+        outp, logp, mem, known, oneline, good_input,linespace = run_calc(oldsymbols, commands, mobile)
         inputlog = inputlog + "\n" + good_input
-        return newform(outp, logp, mem, known, logbook, mobile, oneline, inputlog, linespace=linespace)
+        if session:
+            sessions.save(session, oldsymbols, logbook + "\n" + "\n".join(logp), inputlog)
+        return newform(outp, logp, mem, known, logbook, mobile, oneline, inputlog, linespace=linespace,
+                       session=session)
 
 from quantities import Units as Units
 
@@ -102,6 +151,7 @@ class example:
     """
     Shows the PQCalc form pre-filled with example calculation commands.
     """
+    @metrics.timed("example")
     def GET(self, examplenr):
         web.header('Content-Type', 'text/html; charset=utf-8', unique=True)
         browser = web.ctx.env['HTTP_USER_AGENT'].lower()
@@ -118,6 +168,7 @@ class preload:
     Defines the home page of the PQCalc server with switches loaded.
 
     """
+    @metrics.timed("preload")
     def GET(self):
         web.header('Content-Type', 'text/html; charset=utf-8', unique=True)
         browser = web.ctx.env['HTTP_USER_AGENT'].lower()
@@ -134,10 +185,70 @@ class preload:
         oldsymbols = ""
         logbook = ""
         commands = "\n".join(["__%s__ = 1" % switch for switch in state['switch'].split("*")])
-        outp, logp, mem, known, oneline, good_input,linespace = calc(oldsymbols, commands, mobile)
+        outp, logp, mem, known, oneline, good_input,linespace = run_calc(oldsymbols, commands, mobile)
         return newform(outp, logp, mem, known, logbook, mobile, oneline, "", linespace=linespace)
 
-# comment out these two lines if you want to use another framework
+class metrics_page:
+    """
+    Shows the stage timings and cache statistics of this process in the Prometheus text format (see metrics.py), only
+    if PQCALC_METRICS is set and only to requests from the same machine. With PQCALC_POOL, the timings include the
+    stages of the calculations done by the workers, but the cache statistics are those of this process only.
+    """
+    def GET(self):
+        if not metrics.enabled or web.ctx.ip not in ("127.0.0.1", "::1"):
+            raise web.notfound()
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8', unique=True)
+        caches = dict(expressions=calculator.expression_cache, lines=calculator.line_cache,
+                      unit_clusters=calculator.unit_clusters, literals=quantities.literals,
+                      unit_layouts=quantities.unit_layouts)
+        if sessions is not None:
+            caches['sessions'] = sessions.cache
+        return metrics.exposition(caches)
+
+
+def serve_preforked(port, processes):
+    """
+    Serves the calculator from several processes. The parent imports everything, builds the examples and selectors,
+    runs one calculation to warm up the caches, opens the port and then forks the workers, which take turns accepting
+    connections. The workers start without any import or warm-up cost and share the secret of the state codec.
+    Sessions kept on the server are cached by each worker separately, and checked against the database before use
+    (see sessions.py).
+
+    :param port: TCP port to listen on
+    :param processes: number of worker processes
+    """
+    global sessions
+    from wsgiref.simple_server import make_server
+    server = make_server('', port, web.application(urls, globals()).wsgifunc())
+    example_dict()
+    static_selectors()
+    calc("", "x = 1.0 m\ny = x^2", False)
+    children = []
+    for i in range(processes):
+        pid = os.fork()
+        if not pid:
+            if sessions is not None:  # a SQLite connection must not be used across fork
+                sessions = SessionStore(os.environ['PQCALC_SESSIONS'])
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+# comment out these lines if you want to use another framework
+# Set PQCALC_WORKERS to serve from several forked processes (port as first argument, default 8080)
 if __name__ == "__main__":
-    app = web.application(urls, globals())
-    app.run()
+    if int(os.environ.get('PQCALC_WORKERS', 1)) > 1:
+        serve_preforked(int(sys.argv[1]) if len(sys.argv) > 1 else 8080, int(os.environ['PQCALC_WORKERS']))
+    else:
+        if int(os.environ.get('PQCALC_POOL', 0)) > 0:
+            pool = workers.Pool(int(os.environ['PQCALC_POOL']), int(os.environ.get('PQCALC_QUEUE', 4)),
+                                float(os.environ.get('PQCALC_TIMEOUT', 10)))
+        app = web.application(urls, globals())
+        app.run()
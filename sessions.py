@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+Server-side storage of calculator sessions, as an alternative to sending the memory, logbook and input log back and
+forth in hidden form fields.
+
+A session is identified by an opaque id that is the only thing the browser keeps. The State of recently used sessions
+stays in memory (least recently used ones are dropped), and every quantity is also written to a SQLite file, so that
+sessions survive being dropped from memory and restarts of the server. Only quantities that changed during a request
+are written.
+
+Several processes may serve sessions from the same file (see server.serve_preforked). Each keeps its own cache, so a
+cached State is only used if no other process saved the session since, and requests of the same session take turns
+across processes with a lock on a byte of the file named like the database plus ".lock" (where fcntl is available).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import binascii
+import os
+import sqlite3
+import time
+from re import match
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import metrics
+import statecodec
+from calculator import State
+from lrucache import LRUCache
+
+schema = '''
+CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, flags TEXT, logbook TEXT, inputlog TEXT, touched REAL);
+CREATE TABLE IF NOT EXISTS symbols (session TEXT, name TEXT, position INTEGER, data TEXT,
+                                    PRIMARY KEY (session, name));
+'''
+
+
+class SessionLock(object):
+    """A lock held by one thread of one process at a time: a thread lock, and a lock on one byte of a file shared by
+    the processes (None for a store that only one process uses)"""
+
+    def __init__(self, lockfile, offset):
+        self.lock = Lock()
+        self.lockfile = lockfile
+        self.offset = offset
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.lockfile is not None:
+            try:
+                fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 1, self.offset)
+            except (IOError, OSError):
+                self.lock.release()
+                raise
+
+    def __exit__(self, *exc_info):
+        if self.lockfile is not None:
+            fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 1, self.offset)
+        self.lock.release()
+
+
+class SessionStore(object):
+    """Keeps the State of each session in a LRU cache in memory, backed by a SQLite database.
+
+    Example:
+      store = SessionStore("sessions.sqlite")
+      sid = store.valid_id(sid_from_the_browser)
+      with store.locked(sid):
+          state = store.load(sid, mob)
+          ... calc(state, commands, mob) ...
+          store.save(sid, state, logbook, inputlog)
+    """
+
+    def __init__(self, path=":memory:", capacity=500):
+        self.lock = Lock()
+        lockfile = open(path + ".lock", "a") if fcntl is not None and path != ":memory:" else None
+        self.session_locks = [SessionLock(lockfile, i) for i in range(64)]
+        self.cache = LRUCache(capacity)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(schema)
+
+    def new_id(self):
+        return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+    def valid_id(self, sid):
+        """Returns sid if it is the id of a session in the store, otherwise a new id (clients can't choose their id)"""
+        if sid and match(r"^[0-9a-f]{32}$", sid):
+            with self.lock:
+                if sid in self.cache or self.db.execute("SELECT 1 FROM sessions WHERE id = ?", (sid,)).fetchone():
+                    return sid
+        return self.new_id()
+
+    def locked(self, sid):
+        """
+        The lock to hold from load() to save(), so that requests of the same session take turns with its State, also
+        in other processes using the same file
+
+        :param sid: the session id
+        :return: a lock shared with a few other sessions
+        """
+        return self.session_locks[int(sid[:8], 16) % len(self.session_locks)]
+
+    @metrics.timed("session_load")
+    def load(self, sid, mob):
+        """
+        :param sid: the session id
+        :param mob: device the output will be sent to
+        :return: the State of the session (an empty one for a new session)
+        """
+        with self.lock:
+            cached = self.cache.get(sid)
+            row = self.db.execute("SELECT flags, logbook, inputlog, touched FROM sessions WHERE id = ?",
+                                  (sid,)).fetchone()
+            if cached is not None and row is not None and cached[2] == row[3]:  # no other process saved it since
+                cached[0].mob = mob
+                return cached[0]
+            state = State(None, mob)
+            logs = ("", "")
+            touched = None
+            if row:
+                touched = row[3]
+                state.flags.update(f for f in row[0].split("\n") if f)
+                logs = (row[1], row[2])
+                for name, data in self.db.execute(
+                        "SELECT name, data FROM symbols WHERE session = ? ORDER BY position", (sid,)):
+                    state[name] = statecodec.loads(name, data)
+            state.changed.clear()
+            self.cache.put(sid, (state, logs, touched))
+            return state
+
+    def logs(self, sid):
+        """Returns the logbook and input log of a session that was loaded with load()"""
+        cached = self.cache.get(sid)
+        return cached[1] if cached is not None else ("", "")
+
+    @metrics.timed("session_save")
+    def save(self, sid, state, logbook, inputlog):
+        """
+        Writes the quantities that changed since the session was loaded, along with flags and logs.
+
+        :param sid: the session id
+        :param state: the State returned by load(), after calc()
+        :param logbook: the complete logbook of the session
+        :param inputlog: the complete input log of the session
+        """
+        with self.lock:
+            row = self.db.execute("SELECT touched FROM sessions WHERE id = ?", (sid,)).fetchone()
+            touched = max(time.time(), row[0] + 1e-6) if row else time.time()  # differs from the one load() saw
+            if state.changed:
+                positions = dict((sym, i) for i, sym in enumerate(state))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO symbols (session, name, position, data) VALUES (?, ?, ?, ?)",
+                    [(sid, sym, positions[sym], statecodec.dumps(state[sym])) for sym in state.changed if sym in state])
+            self.db.execute("INSERT OR REPLACE INTO sessions (id, flags, logbook, inputlog, touched) VALUES (?, ?, ?, ?, ?)",
+                            (sid, "\n".join(sorted(state.flags)), logbook, inputlog, touched))
+            self.db.commit()
+            state.changed.clear()
+            self.cache.put(sid, (state, (logbook, inputlog), touched))
+
+    def purge(self, max_age=7 * 24 * 3600.):
+        """Removes sessions that have not been used for max_age seconds"""
+        with self.lock:
+            cutoff = time.time() - max_age
+            self.db.execute("DELETE FROM symbols WHERE session IN (SELECT id FROM sessions WHERE touched < ?)", (cutoff,))
+            self.db.execute("DELETE FROM sessions WHERE touched < ?", (cutoff,))
+            self.db.commit()
+            self.cache.clear()
@@ -0,0 +1,267 @@
+# coding=utf-8
+"""
+Compact, signed encoding of the quantities a user has defined, for the "memory" sent back and forth with each request.
+
+The memory used to be the repr() of every quantity, one per line, rebuilt with eval(). Such memory is unsigned, so it
+is only read (by a parser that only accepts literals, see decode_legacy) if the environment variable
+PQCALC_LEGACY_MEMORY is set, e.g. for a while after upgrading a server. This module packs the symbols
+into a versioned JSON structure (units as exponent vectors, preferred units as indexes into a table of unit names),
+compresses it, and signs it with an HMAC so that the server only ever decodes memory it has written itself.
+
+Encoded memory looks like "PQ3.<payload>.<signature>", both parts in URL-safe base64. Version 2 adds the
+sensitivities of calculated quantities (see quantities.sensitivities), version 3 the number of the definition of each
+input they refer to; memory written as version 1 or 2 is still read.
+
+The HMAC key is taken from the environment variable PQCALC_SECRET. Without it, a random key is made once and kept in
+the file named by PQCALC_SECRET_FILE (by default .pqcalc_secret next to this module), so that memory written before a
+restart is still read. Servers on several hosts sharing users need the same PQCALC_SECRET.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import ast
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+import zlib
+from fractions import Fraction
+from quantities import Q, Units
+
+version = 3
+magic = "PQ%d." % version
+readable = ("PQ1.", "PQ2.", magic)
+
+
+def load_secret(path):
+    """
+    :param path: file keeping the key
+    :return: the key in the file, which is made (by whichever process comes first) if it doesn't exist yet
+    """
+    if not os.path.exists(path):
+        temporary = "%s.%d" % (path, os.getpid())
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, binascii.hexlify(os.urandom(32)))
+        finally:
+            os.close(fd)
+        try:
+            os.link(temporary, path)  # fails if another process made the file in the meantime
+        except OSError:
+            pass
+        finally:
+            os.remove(temporary)
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+
+secret = os.environ.get('PQCALC_SECRET', '').encode('utf-8')
+if not secret:
+    secret_file = os.environ.get('PQCALC_SECRET_FILE') or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                       '.pqcalc_secret')
+    try:
+        secret = load_secret(secret_file)
+    except (IOError, OSError) as err:
+        print("Warning: can't keep the key for memory in %s (%s), memory won't survive a restart" % (secret_file, err),
+              file=sys.stderr)
+        secret = os.urandom(32)
+
+
+legacy = bool(os.environ.get('PQCALC_LEGACY_MEMORY'))
+
+
+class CodecError(ValueError):
+    """Raised for memory that is damaged, tampered with, or was written by an unknown version"""
+    pass
+
+
+def is_encoded(text):
+    return text.lstrip().startswith("PQ")
+
+
+def encode(symbols, flags):
+    """
+    :param symbols: ordered mapping of names to quantities Q()
+    :param flags: set of switches
+    :return: the signed text representation
+
+    Payload: [version, [unit names], [flags], [[name, number, units, uncert, [unit name indexes]], ...]], where
+    a calculated quantity has [[input name, version, contribution], ...] as sixth entry
+    """
+    unitnames = []
+    index = {}
+    packed = []
+    for sym in symbols:
+        q = symbols[sym]
+        prefu = []
+        for u in sorted(q.prefu):
+            if u not in index:
+                index[u] = len(unitnames)
+                unitnames.append(u)
+            prefu.append(index[u])
+        entry = [sym, encode_number(q.number), encode_units(q.units), q.uncert, prefu]
+        sensitivity = encode_sensitivity(sym, q)
+        if sensitivity is not None:
+            entry.append(sensitivity)
+        packed.append(entry)
+    payload = [version, unitnames, sorted(flags), packed]
+    body = zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 9)
+    return magic + b64encode(body) + "." + b64encode(sign(body))
+
+
+def decode(text):
+    """
+    :param text: memory written by encode()
+    :return: a list of (name, quantity) in the original order, and a set of flags
+    :raise CodecError: if the text can't be decoded
+    """
+    try:
+        head, body, signature = text.strip().split(".")
+    except ValueError:
+        raise CodecError("not encoded memory")
+    if head + "." not in readable:
+        raise CodecError("unknown version %s" % head)
+    try:
+        body = b64decode(body)
+        signature = b64decode(signature)
+    except (TypeError, ValueError):
+        raise CodecError("damaged memory")
+    if not hmac.compare_digest(sign(body), signature):
+        raise CodecError("memory signature does not match")
+    try:
+        payload = json.loads(zlib.decompress(body).decode('utf-8'))
+        v, unitnames, flags, packed = payload
+        symbols = []
+        for entry in packed:
+            sym, number, units, uncert, prefu = entry[:5]
+            symbols.append((sym, Q(decode_number(number), sym, decode_units(units), uncert,
+                                   [unitnames[i] for i in prefu], sensitivity=decode_sensitivity(entry[5:]))))
+    except (ValueError, TypeError, IndexError, zlib.error):
+        raise CodecError("damaged memory")
+    return symbols, set(flags)
+
+
+legacy_calls = dict(Q=Q, Units=Units, Fraction=Fraction, set=set)
+
+
+def decode_legacy(text):
+    """
+    Reads memory in the old format, the repr() of a quantity per line (and switches such as __tutor__), without
+    eval(): only literals and calls of Q, Units, Fraction and set are accepted.
+
+    :param text: memory as written by older versions
+    :return: a list of (name, quantity) in the original order, and a set of flags
+    :raise CodecError: if a line is anything else, or reading old memory is not switched on (see legacy)
+    """
+    if not legacy:
+        raise CodecError("memory from an older version is not accepted")
+    symbols = []
+    flags = set()
+    for line in text.replace('\r', '').split('\n'):
+        line = line.strip()
+        if re.match(r"^__\w+__$", line):
+            flags.add(line)
+        elif line:
+            try:
+                q = legacy_literal(ast.parse(line, mode='eval').body)
+            except (SyntaxError, ValueError, TypeError, KeyError, ArithmeticError):
+                raise CodecError("damaged memory")
+            if not isinstance(q, Q) or not q.name:
+                raise CodecError("damaged memory")
+            symbols.append((q.name, q))
+    return symbols, flags
+
+
+def legacy_literal(node):
+    """The value of a node of the syntax tree of a repr(), built from literals and the calls in legacy_calls"""
+    if isinstance(node, ast.Call):
+        if (not isinstance(node.func, ast.Name) or node.func.id not in legacy_calls or
+                getattr(node, 'starargs', None) or getattr(node, 'kwargs', None)):
+            raise ValueError("not a quantity")
+        args = [legacy_literal(a) for a in node.args]
+        kwargs = dict((str(k.arg), legacy_literal(k.value)) for k in node.keywords)
+        return legacy_calls[node.func.id](*args, **kwargs)
+    if isinstance(node, ast.Tuple):
+        return tuple(legacy_literal(e) for e in node.elts)
+    if isinstance(node, ast.List):
+        return [legacy_literal(e) for e in node.elts]
+    return ast.literal_eval(node)
+
+
+def dumps(q):
+    """Encodes a single quantity as (unsigned) JSON text, e.g. for server-side storage"""
+    packed = [encode_number(q.number), encode_units(q.units), q.uncert, sorted(q.prefu)]
+    sensitivity = encode_sensitivity(q.name, q)
+    if sensitivity is not None:
+        packed.append(sensitivity)
+    return json.dumps(packed, separators=(',', ':'))
+
+
+def loads(sym, text):
+    """Decodes a quantity written by dumps() and gives it the name sym"""
+    packed = json.loads(text)
+    number, units, uncert, prefu = packed[:4]
+    return Q(decode_number(number), sym, decode_units(units), uncert, prefu,
+             sensitivity=decode_sensitivity(packed[4:]))
+
+
+def encode_sensitivity(sym, q):
+    """The contributions to the uncertainty as [[input name, version, contribution], ...], or None for an input"""
+    if q.sensitivity is None or q.sensitivity == {(sym, 0): q.uncert}:
+        return None
+    return sorted([name, v, c] for (name, v), c in q.sensitivity.items())
+
+
+def decode_sensitivity(rest):
+    """
+    :param rest: what follows the preferred units in a packed quantity, [] or [sensitivity]
+    :return: the contributions keyed by (input name, version), version 0 for memory written as version 2
+    """
+    if not rest:
+        return None
+    return dict(((entry[0], entry[1] if len(entry) == 3 else 0), entry[-1]) for entry in rest[0])
+
+
+def encode_units(units):
+    """Exponents of the base units, without trailing zeros"""
+    units = [encode_number(x) for x in units]
+    while units and not units[-1]:
+        units.pop()
+    return units
+
+
+def decode_units(units):
+    return Units(*[decode_number(x) for x in units])
+
+
+def encode_number(number):
+    """Floats and integers go into JSON as they are, fractions as [numerator, denominator]"""
+    if isinstance(number, Fraction):
+        return [number.numerator, number.denominator]
+    return number
+
+
+def decode_number(number):
+    if isinstance(number, list):
+        return Fraction(*number)
+    return number
+
+
+def sign(body):
+    return hmac.new(secret, body, hashlib.sha256).digest()
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip("=")
+
+
+def b64decode(text):
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b"=" * (-len(text) % 4))
@@ -0,0 +1,32 @@
+__author__ = 'Karsten Theis'
+
+import unittest
+import benchmark
+
+
+class Benchmark_TestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile([3.0, 1.0, 2.0], 50), 2.0)
+        self.assertEqual(benchmark.percentile([1.0, 2.0], 90), 1.9)
+        self.assertEqual(benchmark.percentile([5.0], 99), 5.0)
+
+    def test_run(self):
+        results = benchmark.run(["tutorial"], repeat=2)
+        self.assertEqual(sorted(results["examples"]), ["tutorial/latex", "tutorial/plain"])
+        r = results["examples"]["tutorial/plain"]
+        self.assertTrue(0 < r["p50"] <= r["p90"] <= r["p99"])
+        self.assertIn("tutorial", benchmark.report(results))
+        if results["stages"]:  # the calculator was imported with timing on
+            self.assertIn("lex", results["stages"])
+        else:
+            self.assertIn("stages not timed", benchmark.report(results))
+
+    def test_regressions(self):
+        baseline = dict(examples={"a/plain": dict(p50=1.0), "b/plain": dict(p50=1.0)})
+        results = dict(examples={"a/plain": dict(p50=1.2), "b/plain": dict(p50=1.3), "c/plain": dict(p50=9.0)})
+        self.assertEqual(benchmark.regressions(results, baseline, 0.25), [("b/plain", 1.0, 1.3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
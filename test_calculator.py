@@ -2,7 +2,10 @@ __author__ = 'Karsten Theis'
 
 import unittest
 import calculator
-from calculator import scan, make_paired_tokens, fixoperator
+import quantities
+import statecodec
+from calculator import scan, lex, make_paired_tokens, fixoperator, compile_expression, State
+from quantities import Units
 
 
 class Classify_TestCase(unittest.TestCase):
@@ -71,6 +74,22 @@ class Paired_Tokens_TestCase(unittest.TestCase):
         s = [['N', '*', '5'], ['N', '+', '6'], ['Z', '*', '']]
         self.assertEqual(t, s, 'problem with comments')
 
+class Lex_TestCase(unittest.TestCase):
+
+    def test_same_as_scan(self):
+        for t in calculator.lexer_inputs + ["5 + 6 # + 56", "2 (1/2) kOhm", "uL^2 #x^", "log(7)", "(3/4)(1/2)"]:
+            self.assertEqual(lex(t), make_paired_tokens(scan(t)), t)
+
+    def test_errors(self):
+        with self.assertRaises(calculator.CalcError) as cm:
+            lex("5 + [[")
+        self.assertIn("character 5", cm.exception.args[0])
+        with self.assertRaises(calculator.CalcError) as cm:
+            lex("(5 + 6))")
+        self.assertIn("character 8", cm.exception.args[0])
+        with self.assertRaises(calculator.CalcError):
+            lex("((5 + 6)")
+
 class Fixoperator_TestCase(unittest.TestCase):
 
     def test_implicit_multiplication(self):
@@ -88,11 +107,181 @@ class Fixoperator_TestCase(unittest.TestCase):
         s = '('
         self.assertEqual(t, s, 'problem with function call')
 
+class Compile_Expression_TestCase(unittest.TestCase):
+
+    def test_symbols_are_placeholders(self):
+        e = compile_expression(make_paired_tokens(scan("2 a + a / b")), set())
+        self.assertEqual(e.source, 'c0*s0+s0/s1')
+        self.assertEqual(e.symbols, [('s0', 'a'), ('s1', 'b')])
+
+    def test_binds_live_quantities(self):
+        state = State()
+        state['a'] = quantities.Q(2.5, 'a', Units(), 0.1)
+        q = compile_expression(make_paired_tokens(scan("a * a")), state.flags).evaluate(state)
+        self.assertIs(q.provenance[0], state['a'])
+        self.assertEqual(q.number, 6.25)
+
+    def test_repeated_literal(self):
+        e = compile_expression(make_paired_tokens(scan("2.0 a + 2.0")), set())
+        self.assertEqual(repr(e.constants['c0']), repr(e.constants['c1']))
+        self.assertIsNot(e.constants['c0'], e.constants['c1'])
+
+    def test_unit_clusters(self):
+        calculator.unit_clusters.clear()
+        first = compile_expression(make_paired_tokens(scan("8.314 J/(K mol) * 298 K")), set())
+        second = compile_expression(make_paired_tokens(scan("0.08206 L atm/(K mol)")), set())
+        third = compile_expression(make_paired_tokens(scan("8.314 J/(K mol) + 2.0 m**2/s")), set())
+        self.assertEqual(first.source, 'c0 *c1')
+        R = first.constants['c0']
+        self.assertEqual((R.number, R.units, R.uncert, R.prefu), (8.314, Units(kg=1, m=2, s=-2, mol=-1, K=-1), 0.001,
+                                                                  frozenset(['J', 'K', 'mol'])))
+        self.assertEqual(repr(third.constants['c0']), repr(R))
+        self.assertEqual(third.constants['c1'].units, Units(m=2, s=-1))
+        self.assertAlmostEqual(second.constants['c0'].number, 0.08206 * 101.325)
+        self.assertEqual(calculator.unit_clusters.info()['hits'], 1)
+
+    def test_unknown_symbol(self):
+        e = compile_expression(make_paired_tokens(scan("2 b")), set())
+        with self.assertRaises(calculator.CalcError):
+            e.evaluate(State())
+
+    def test_cache(self):
+        calculator.expression_cache.clear()
+        state = State()
+        state['a'] = quantities.Q(2.5, 'a', Units(), 0.1)
+        first = calculator.compiled("a * 2", state.flags)
+        self.assertIs(calculator.compiled(" a * 2 ", state.flags), first)
+        self.assertIsNot(calculator.compiled("a * 2", {'__tutor__'}), first)
+        self.assertEqual(calculator.expression_cache.info()['hits'], 1)
+
+
+class Limits_TestCase(unittest.TestCase):
+
+    def assertRejected(self, t, complaint):
+        with self.assertRaises(calculator.CalcError) as cm:
+            calculator.interpret(t, State())
+        self.assertIn(complaint, cm.exception.args[0])
+
+    def test_tokens(self):
+        self.assertRejected(" + ".join(["2 m"] * 1100), "terms (at most 2000 in one line)")
+        self.assertRejected("1" + "0" * 2000, "Too long: 10000000000")
+
+    def test_nesting(self):
+        self.assertEqual(calculator.interpret("(" * 50 + "2" + ")" * 50, State()).number, 2)
+        self.assertRejected("(" * 120 + "2" + ")" * 120, "Too deeply nested: 120 parentheses")
+        self.assertRejected("sqrt(" * 60 + "2" + ")" * 60, "Too deeply nested: 60 parentheses")
+
+    def test_provenance(self):
+        self.assertRejected(" + ".join(["2"] * 300), "more than 200 operations in a row")
+        outp = calculator.calc("", "a = " + " + ".join(["2"] * 300) + "\nb = 3", 'ipud')[0]
+        self.assertIn("more than 200 operations in a row", "".join(outp))
+
+    def test_exact_power(self):
+        outp = calculator.calc("", "a = ((((10^10)^10)^10)^10)^10\nb = 7^10^2", 'ipud')[0]
+        self.assertIn("Math overflow", "".join(outp))
+        outp = calculator.calc("", "a = " + "1" + "0" * 200 + "^10", 'ipud')[0]
+        self.assertIn("exact result too large (about 2000 digits)", "".join(outp))
+
+
+class Recalculation_TestCase(unittest.TestCase):
+
+    worksheet = "T = 298 K\nn = 2 mol\nR = 8.314 J/(mol K)\nV = 3 L\nP = n R T / V\nm = n * 18 g/mol"
+
+    def test_only_downstream_lines_recalculated(self):
+        calculator.line_cache.clear()
+        first = calculator.calc("", self.worksheet, "ipud")
+        self.assertEqual(calculator.line_cache.info()['hits'], 0)
+        changed = self.worksheet.replace("298 K", "310 K")
+        second = calculator.calc("", changed, "ipud")
+        self.assertEqual(calculator.line_cache.info()['hits'], 4)
+        calculator.line_cache.clear()
+        fresh = calculator.calc("", changed, "ipud")
+        self.assertEqual(second[:2], fresh[:2])
+        self.assertNotEqual(second[3], first[3])
+        self.assertEqual(second[3], fresh[3])
+
+    def test_using_changes_dependent_output(self):
+        calculator.line_cache.clear()
+        out1 = calculator.calc("", "V = 3 L\nW = 2 V", "ipud")[0]
+        out2 = calculator.calc("", "V = 3 L\nV using mL\nW = 2 V", "ipud")[0]
+        self.assertNotEqual(out1[-1], out2[-1])
+        self.assertEqual(calculator.line_cache.info()['hits'], 1)
+
+    @staticmethod
+    def restore_units(units, unprefixed):
+        """Takes the units added by a test out of the registry again, along with the results made with them"""
+        registry = quantities.unitquant
+        registry.units.clear()
+        registry.units.update(units)
+        registry.unprefixed.clear()
+        registry.unprefixed.update(unprefixed)
+        registry.clear()
+        for cache in registry.caches:
+            cache.clear()
+
+    def test_new_unit(self):
+        self.assertEqual(calculator.calc("", "x = 2 furlong\ny = 2 m", "ipud")[5], "")
+        self.addCleanup(self.restore_units, dict(quantities.unitquant.units), set(quantities.unitquant.unprefixed))
+        quantities.unitquant.load("furlong 201.168 m")
+        output, logp, memory, known, oneline, good_input, linespace = calculator.calc("", "x = 2 furlong", "ipud")
+        self.assertEqual(good_input, "x = 2 furlong")
+        self.assertAlmostEqual(dict(statecodec.decode(memory[0])[0])['x'].number, 402.336)
+
+
+class Budget_TestCase(unittest.TestCase):
+    worksheet = "mass = 2.0(1) g\nvol = 1.00(5) mL\nd = mass / vol\n"
+
+    def test_across_lines_and_requests(self):
+        outp, logp, memory = calculator.calc("", self.worksheet, "ipud")[:3]
+        outp = calculator.calc(memory[0], "r = budget(d / mass)", "ipud")[0]
+        self.assertTrue("   = 0.0500000 1/mL" in outp)
+        self.assertTrue("   Uncertainty budget: vol 100%, mass 0%" in outp)
+
+    def test_correlated_switch(self):
+        memory = calculator.calc("", self.worksheet + "__correlated__ = 1\nr = d / mass", "ipud")[2][0]
+        r = dict(statecodec.decode(memory)[0])['r']
+        self.assertAlmostEqual(r.uncert, 0.05e6)  # 0.05 1/mL
+        self.assertAlmostEqual(r.sensitivity[('mass', 0)], 0.0)
+
+    def test_redefined_input(self):
+        outp, logp, memory = calculator.calc("", "a = 2.0(1) m\nb = 2 a\na = 3.0(2) m\nc = b - a", "ipud")[:3]
+        c = dict(statecodec.decode(memory[0])[0])['c']
+        self.assertEqual(sorted(c.sensitivity), [('a', 0), ('a', 1)])
+        self.assertAlmostEqual(quantities.correlated_uncert(c), c.uncert)
+        state = State(memory[0])
+        self.assertEqual(state.versions, {'a': 1})
+        calculator.calc(state, "a = 4.0(1) m\nb = 2 a", "ipud")
+        self.assertEqual((state.versions, sorted(state['b'].sensitivity)), ({'a': 2}, [('a', 2)]))
+        outp = calculator.calc(memory[0], "a = a * 1.0(1)\nr = budget(c + a)", "ipud")[0]
+        self.assertTrue("   Uncertainty budget: a (definition 3) 69%, a (definition 1) 31%, a (definition 2) 0%" in outp, outp)
+
+
+@unittest.skipIf(quantities.numpy is None, "NumPy is not installed")
+class Sweep_TestCase(unittest.TestCase):
+
+    worksheet = "T = 298 K\nn = 1.00 mol\nvol = 24.5 L\nR = 8.314 J/(mol K)\nP = n R T / vol\nP using kPa"
+
+    def test_same_as_calc(self):
+        K = quantities.Units(K=1)
+        T = quantities.QArray.linspace(quantities.Q(273.0, units=K), quantities.Q(373.0, units=K), 5)
+        columns = calculator.sweep(self.worksheet, {'T': T})
+        self.assertEqual([c[:2] for c in columns],
+                         [('T', 'K'), ('n', 'mol'), ('vol', 'L'), ('R', 'J/(K mol)'), ('P', 'kPa')])
+        for i, t in enumerate([273, 298, 323, 348, 373]):
+            memory = calculator.calc("", self.worksheet.replace("298", str(t)), "ipud")[2][0]
+            P = dict(statecodec.decode(memory)[0])['P']
+            self.assertAlmostEqual(columns[4][2][i], P.number / 1000)
+            self.assertAlmostEqual(columns[4][3][i], P.uncert / 1000)
+        lines = calculator.sweep_table(columns)
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1].split("\t")[4], "9.3(1)e1")
+
+
 '''
-interpret_N_U_cluster(["Q('8.314')"],make_paired_tokens(scan("8.314 J/(mol K) * 274 K"))[1:],[])
+interpret_N_U_cluster("8.314",make_paired_tokens(scan("8.314 J/(mol K) * 274 K"))[1:],False)
 
 a = make_paired_tokens(scan("8.314 J/(mol K) * 274 K"))
-interpret_N_U_cluster(["Q('8.314')"],a[1:],[])
+interpret_N_U_cluster("8.314",a[1:],False)
 
 >>> scan("5 + 7")
 [['N', '5'], ['O', '+'], ['N', '7'], ['O', ''], ['Z', '']]
@@ -0,0 +1,52 @@
+__author__ = 'Karsten Theis'
+
+import os
+import subprocess
+import sys
+import unittest
+import form
+from calculator import calc
+
+
+class Form_TestCase(unittest.TestCase):
+    def test_examples(self):
+        exdict = form.example_dict()
+        self.assertIs(form.example_dict(), exdict)
+        self.assertTrue(len(exdict) > 10)
+        for name in exdict:
+            self.assertIn('<a href="/example%s">' % name, form.example_html())
+        name = exdict.keys()[0]
+        self.assertIn(exdict[name][:-2], form.newform("", "", "", [], "", False, False, "", prefill=name))
+
+    def test_selectors(self):
+        html = form.static_selectors()
+        self.assertIs(form.static_selectors(), html)
+        for choice in ['value="mol"', 'value="sqrt()"', 'value="using  "', '>symbols<']:
+            self.assertIn(choice, html)
+
+    def test_calculation(self):
+        outp, logp, mem, known, oneline, good_input, linespace = calc("", "x = 2.0 m\ny = x^2", False)
+        self.assertIn('<option value="y ">', form.newform(outp, logp, mem, known, "", False, oneline, good_input))
+
+
+class Startup_TestCase(unittest.TestCase):
+    """Starting a server process has to import the calculator, which should not have to wait for NumPy,
+    the examples or the selectors"""
+    budget = 0.25  # seconds; about 0.03 on a laptop
+
+    def test_import_time(self):
+        script = ("import sys, time\n"
+                  "start = time.time()\n"
+                  "import calculator, form, sessions\n"
+                  "print(time.time() - start)\n"
+                  "print('numpy' in sys.modules)\n"
+                  "print((form.exdict, form.static_html))\n")
+        here = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=here).decode().split("\n")
+        self.assertLess(float(output[0]), self.budget)
+        self.assertEqual(output[1], "False")
+        self.assertEqual(output[2], "(None, None)")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+__author__ = 'Karsten Theis'
+
+import unittest
+from lrucache import LRUCache
+
+
+class LRUCache_TestCase(unittest.TestCase):
+
+    def test_counters(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_goes_first(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertEqual(len(cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
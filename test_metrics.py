@@ -0,0 +1,68 @@
+__author__ = 'Karsten Theis'
+
+import unittest
+import metrics
+from lrucache import LRUCache
+
+
+class Metrics_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.enabled = metrics.enabled
+        self.stages = dict(metrics.stages)
+        metrics.stages.clear()
+
+    def tearDown(self):
+        metrics.enabled = self.enabled
+        metrics.stages.clear()
+        metrics.stages.update(self.stages)
+
+    def test_disabled(self):
+        metrics.enable(False)
+        f = lambda x: x
+        self.assertIs(metrics.timed("nothing")(f), f)
+        self.assertNotIn("nothing", metrics.stages)
+
+    def test_timed(self):
+        metrics.enable()
+        double = metrics.timed("double")(lambda x: 2 * x)
+        self.assertEqual(double(3), 6)
+        with self.assertRaises(TypeError):
+            double(None)
+        self.assertEqual(metrics.stages["double"].count, 2)
+
+    def test_histogram(self):
+        h = metrics.histogram("stage")
+        for seconds in [0.00005, 0.003, 0.003, 20.0]:
+            h.observe(seconds)
+        buckets = dict(h.cumulative())
+        self.assertEqual((buckets["0.0001"], buckets["0.0025"], buckets["0.005"], buckets["10"], buckets["+Inf"]),
+                         (1, 1, 3, 3, 4))
+        self.assertAlmostEqual(h.total, 20.00605)
+
+    def test_merge(self):
+        h = metrics.histogram("lex")
+        h.observe(0.001)
+        h.observe(20.0)
+        timings = metrics.snapshot()
+        self.assertEqual(timings, [("lex", h.counts, h.total, 2)])
+        metrics.merge(timings)
+        metrics.merge([("compile", h.counts, h.total, 2)])
+        self.assertEqual((h.count, h.counts[-1], metrics.stages["compile"].count), (4, 2, 2))
+        self.assertAlmostEqual(h.total, 40.002)
+
+    def test_exposition(self):
+        metrics.histogram("lex").observe(0.001)
+        cache = LRUCache(10)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        text = metrics.exposition(dict(expressions=cache))
+        self.assertIn('pqcalc_stage_seconds_bucket{stage="lex",le="0.001"} 1\n', text)
+        self.assertIn('pqcalc_stage_seconds_count{stage="lex"} 1\n', text)
+        self.assertIn('# TYPE pqcalc_cache_hits_total counter\npqcalc_cache_hits_total{cache="expressions"} 1\n', text)
+        self.assertIn('pqcalc_cache_misses_total{cache="expressions"} 1\n', text)
+        self.assertIn('pqcalc_cache_size{cache="expressions"} 1\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
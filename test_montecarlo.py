@@ -0,0 +1,87 @@
+__author__ = 'Karsten Theis'
+
+import unittest
+import calculator
+import montecarlo
+import quantities
+from quantities import Q, Units
+
+
+@unittest.skipIf(quantities.numpy is None, "NumPy is not installed")
+class MonteCarlo_TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Q(2.0, 'a', Units(m=1), 0.01)
+        self.b = Q(3.0, 'b', Units(m=1), 0.02)
+
+    def test_linear_agrees_with_first_order(self):
+        q = self.a * Q(2) + self.b
+        mean, std, count, invalid = montecarlo.propagate(q, 20000)
+        self.assertAlmostEqual(mean, q.number, places=2)
+        self.assertAlmostEqual(std / q.uncert, 1.0, places=1)
+        self.assertEqual((count, invalid), (20000, 0))
+
+    def test_nonlinear(self):
+        x = Q(1.0, 'x', Units(), 0.5)
+        mean, std, count, invalid = montecarlo.propagate(x ** Q(2), 50000)
+        self.assertAlmostEqual(mean, 1.25, places=1)  # <x^2> = x^2 + u^2
+
+    def test_same_quantity_same_samples(self):
+        mean, std, count, invalid = montecarlo.propagate(self.a - self.a)
+        self.assertEqual((mean, std), (0.0, 0.0))
+
+    def test_invalid_samples(self):
+        q = quantities.sqrt(self.a - Q(1.99, '', Units(m=1)))
+        mean, std, count, invalid = montecarlo.propagate(q, 1000)
+        self.assertTrue(invalid > 0)
+        self.assertEqual(count + invalid, 1000)
+
+    def test_chunks_and_processes(self):
+        q = quantities.sumover(self.a, self.b, self.a * self.b / self.b)
+        single = montecarlo.propagate(q, 3000, workers=0)
+        old = montecarlo.chunk
+        montecarlo.chunk = 1000
+        try:
+            chunked = montecarlo.propagate(q, 3000, workers=0)
+            pooled = montecarlo.propagate(q, 3000, workers=2)
+        finally:
+            montecarlo.chunk = old
+        self.assertEqual(chunked, pooled)
+        self.assertAlmostEqual(chunked[0], single[0], places=2)
+        self.assertEqual(chunked[2], 3000)
+        self.assertIsNotNone(montecarlo.pool)
+        montecarlo.close_pool()
+        self.assertIsNone(montecarlo.pool)
+
+    def test_memory_limit(self):
+        q = quantities.sumover(*[Q(1.0, 'x%d' % i, Units(m=1), 0.1) for i in range(190)])
+        steps = montecarlo.program(q)
+        self.assertEqual(montecarlo.chunk_size(steps), montecarlo.memory_limit // (16 * 191))
+        old = montecarlo.memory_limit
+        montecarlo.memory_limit = 16 * 191 * 1000
+        try:
+            mean, std, count, invalid = montecarlo.propagate(q, 2500)
+        finally:
+            montecarlo.memory_limit = old
+        self.assertEqual((count, invalid), (2500, 0))
+        self.assertAlmostEqual(mean, 190.0, places=0)
+
+    def test_functions(self):
+        for f, value in [(quantities.minimum, 2.0), (quantities.maximum, 3.0), (quantities.median, 2.0)]:
+            q = f(self.a, self.b, self.a)
+            self.assertEqual(montecarlo.linearized(q), [])
+            self.assertAlmostEqual(montecarlo.propagate(q, 1000)[0], value, places=2)
+        q = quantities.stdev(self.a, self.b) + quantities.uncertainty(self.a)
+        self.assertEqual(montecarlo.linearized(q), ['stdev', 'uncertainty'])
+        output = calculator.calc("", "__montecarlo__ = 1\nx = 2.0(5) m\ny = stdev(x, 3 m) + x", "ipud")[0]
+        self.assertTrue(any("first order used for stdev()" in line for line in output))
+
+    def test_switch(self):
+        output = calculator.calc("", "__montecarlo__ = 1\nx = 2.0(5) m\ny = x^2", "ipud")[0]
+        self.assertTrue(any("Monte Carlo (10000 samples)" in line for line in output))
+        output = calculator.calc("", "x = 2.0(5) m\ny = x^2", "ipud")[0]
+        self.assertFalse(any("Monte Carlo" in line for line in output))
+
+
+if __name__ == '__main__':
+    unittest.main()
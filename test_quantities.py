@@ -1,8 +1,19 @@
+from __future__ import division
 __author__ = 'Karsten Theis'
 
+import gc
+import pickle
+import subprocess
+import sys
 import unittest
 import quantities
-from quantities import number2quantity, uncert_sum, Q, try_all_derived, Units
+from fractions import Fraction
+from math import log10 as math_log10
+try:
+    import resource
+except ImportError:
+    resource = None
+from quantities import number2quantity, uncert_sum, Q, try_all_derived, Units, unitquant, unity, SIunit_symbols
 
 class Number2quantity_TestCase(unittest.TestCase):
     def setUp(self):
@@ -27,6 +38,17 @@ class Number2quantity_TestCase(unittest.TestCase):
         q = number2quantity("50000")
         self.assertEqual(q.sigfig, 100,'incorrect sigfig')
 
+    def test_parse_literal(self):
+        for text in ["2.51e89", "4.513", "0.037", "1000.", "50000", ".5", "-3.2E-4", "5(2)", "5(1)", "8.314(12)e3",
+                     "2e5", "1/2", " 7.0 "]:
+            a, b = number2quantity(text), quantities.parse_literal(text)
+            self.assertEqual((repr(a.number), repr(a.uncert)), (repr(b.number), repr(b.uncert)), text)
+            self.assertIs(type(a.number), type(b.number))
+
+    def test_shared_literal(self):
+        self.assertIs(Q.literal("8.314"), Q.literal("8.314"))
+        self.assertEqual(repr(Q("8.314")), repr(Q.literal("8.314")))
+
 class uncert_sum_TestCase(unittest.TestCase):
     def setUp(self):
         self.q1 = number2quantity("5.1")
@@ -75,6 +97,371 @@ class try_all_derived_TestCase(unittest.TestCase):
         result = [(-13, 'J', -1), (-1, 'J', 1), (3, 'L', 1)]
         self.assertEqual(query, result)
 
+
+class Units_TestCase(unittest.TestCase):
+    def test_interned(self):
+        self.assertIs(Units(m=3), Units(0, 0, 3))
+        self.assertIs(Units(m=Fraction(2, 1)), Units(m=2))
+        self.assertIs(Units(), quantities.unity)
+        self.assertIs(pickle.loads(pickle.dumps(Units(kg=1, s=-2))), Units(kg=1, s=-2))
+
+    def test_arithmetic(self):
+        J = Units(kg=1, m=2, s=-2)
+        self.assertIs(J.times(Units(s=1)), Units(kg=1, m=2, s=-1))
+        self.assertIs(J.divided(J), quantities.unity)
+        self.assertIs(Units(m=2).power(Fraction(1, 2)), Units(m=1))
+        self.assertEqual(Units(m=1).power(Fraction(1, 3)), (0, 0, Fraction(1, 3), 0, 0, 0, 0, 0))
+        self.assertIs((Q('kg') * Q('m') / Q('s')).units, Units(kg=1, m=1, s=-1))
+
+    def test_bounded(self):
+        self.assertEqual((Q('m') ** Q(Fraction(1, 12))).units, Units(m=Fraction(1, 12)))
+        self.assertRaises(quantities.QuantError, Q('m').__pow__, Q(Fraction(1, 13)))
+        limit = quantities.max_interned_units
+        self.addCleanup(setattr, quantities, 'max_interned_units', limit)
+        quantities.max_interned_units = len(quantities.interned_units)
+        self.assertIs(Units(m=3), Units(0, 0, 3))
+        self.assertRaises(OverflowError, Units, m=12345)
+
+
+class constructors_TestCase(unittest.TestCase):
+    def test_slots(self):
+        q = Q(2.5, 'a', Units(m=1), 0.1, ['cm'])
+        self.assertFalse(hasattr(q, '__dict__'))
+        repr(q)
+        self.assertFalse(hasattr(q, 'rnumber'))
+
+    def test_shared_prefu(self):
+        a = Q(2.5, 'a', Units(m=1), 0.1, ['cm', 'mm'])
+        b = Q(1.5, 'b', Units(m=1), 0.1, {'mm', 'cm'})
+        self.assertIs(a.prefu, b.prefu)
+        self.assertIs((a + b).prefu, a.prefu)
+        self.assertIs((a * Q.from_float(2.0)).prefu, a.prefu)
+
+    def test_fast_constructors(self):
+        self.assertIs(Q.unit('kg'), quantities.unitquant['kg'])
+        self.assertEqual(repr(Q('kg')), "Q('kg')")
+        self.assertEqual(repr(Q.literal('2.50')), repr(Q('2.50')))
+        self.assertEqual(repr(Q.from_float(2.0)), repr(Q(2.0)))
+
+    def test_functions_leave_arguments_alone(self):
+        a = Q(4.0, 'a', Units(m=2), 0.1)
+        r = quantities.sqrt(a)
+        self.assertEqual((r.name, r.provenance), ("sqrt(%s)", (a,)))
+        self.assertEqual((a.name, a.provenance), ('a', None))
+        self.assertEqual(Q.unit('kg').name, 'kg')
+
+
+@unittest.skipIf(quantities.numpy is None, "NumPy is not installed")
+class QArray_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.values = [0.5, 2.0, 3.5]
+        self.a = quantities.QArray(self.values, 'a', Units(m=3), 0.1, ['L'])
+        self.b = Q(2.5, 'b', Units(m=3), 0.2, ['mL'])
+        self.x = quantities.QArray(self.values, 'x', Units(), [0.01, 0.02, 0.03])
+
+    def assertElementwise(self, array, scalars):
+        self.assertIsInstance(array, quantities.QArray)
+        for i, q in enumerate(scalars):
+            self.assertAlmostEqual(array.number[i], q.number)
+            self.assertAlmostEqual(array.uncert[i], q.uncert)
+            self.assertIs(array.units, q.units)
+            self.assertEqual(array.prefu, q.prefu)
+
+    def test_arithmetic(self):
+        for op in [lambda p, q: p + q, lambda p, q: p - q, lambda p, q: p * q, lambda p, q: p / q,
+                   lambda p, q: q / p, lambda p, q: q - p, lambda p, q: p ** Q(2), lambda p, q: -p]:
+            self.assertElementwise(op(self.a, self.b), [op(self.a[i], self.b) for i in range(3)])
+
+    def test_functions(self):
+        for f in [quantities.exp, quantities.log, quantities.ln, quantities.sqrt, quantities.sin, quantities.cos,
+                  quantities.tan]:
+            self.assertElementwise(f(self.x), [f(self.x[i]) for i in range(3)])
+        self.assertElementwise(quantities.sqrt(self.a), [quantities.sqrt(self.a[i]) for i in range(3)])
+
+    def test_errors(self):
+        with self.assertRaises(quantities.QuantError):
+            self.a + Q(1.0)
+        with self.assertRaises(quantities.QuantError):
+            self.a / quantities.QArray([1.0, 0.0, 2.0])
+        with self.assertRaises(quantities.QuantError):
+            quantities.log(-self.x)
+
+    def test_sumover_average(self):
+        elements = [self.a[i] for i in range(3)]
+        for f in [quantities.sumover, quantities.average]:
+            q, r = f(self.a), f(*elements)
+            self.assertNotIsInstance(q, quantities.QArray)
+            self.assertAlmostEqual(q.number, r.number)
+            self.assertAlmostEqual(q.uncert, r.uncert)
+        self.assertElementwise(quantities.average(self.a, self.b),
+                               [quantities.average(self.a[i], self.b) for i in range(3)])
+
+    def test_formatting(self):
+        self.assertEqual(str(self.a), "[5e2, 2.0e3, 3.5e3] L")
+        self.assertEqual(str(quantities.QArray(range(10), units=Units(m=1))),
+                         "[0, 1, 2, ..., 7, 8, 9] m")
+        value, poslist, neglist = quantities.unit_string(self.a.number, self.a.units, self.a.prefu)
+        self.assertEqual(list(value), [500.0, 2000.0, 3500.0])
+        self.assertEqual((poslist, neglist), ([('L', 1)], []))
+
+
+class allsteps_TestCase(unittest.TestCase):
+    def test_same_as_steps(self):
+        a = Q(2.5, 'a', Units(m=1), 0.1)
+        b = Q(1.5, 'b', Units(m=1), 0.1, ['cm'])
+        q = a
+        for i in range(6):
+            q = (q + b) * a / (Q(2.0, '', Units(m=1)) - -a)
+        q = quantities.sumover(q ** Q(2), (q * a / a) ** Q(2), -q * a)
+        for writer, subs in [(quantities.ascii_writer, None),
+                             (quantities.latex_writer, {"%s / %s": "\\dfrac{%s}{%s}", "%s * %s": "%s \\cdot %s"})]:
+            flags = dict(uncert=True)
+            steps = q.allsteps(writer, subs, flags)
+            self.assertEqual(sorted(steps), list(range(-1, q.setdepth() + 1)))
+            for level in steps:
+                self.assertEqual(steps[level], q.steps(level, writer, subs, flags))
+
+    def test_leaf(self):
+        a = Q(2.5, 'a', Units(m=1), 0.1)
+        self.assertEqual(a.allsteps(quantities.ascii_writer), {-1: 'a', 0: '2.5 m'})
+
+
+class sensitivity_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.a = Q(2.0, 'a', Units(m=1), 0.1)
+        self.b = Q(4.0, 'b', Units(m=1), 0.2)
+
+    def test_repeated_inputs_cancel(self):
+        a = self.a
+        self.assertEqual(quantities.sensitivities(a - a), {('a', 0): 0.0})
+        self.assertEqual(quantities.correlated_uncert(a / a), 0.0)
+        self.assertTrue((a - a).uncert > 0)  # the first-order estimate is left alone
+
+    def test_budget(self):
+        a, b = self.a, self.b
+        q = quantities.sqrt(a * b) + Q.literal("3.0") * a
+        s = quantities.sensitivities(q)
+        self.assertAlmostEqual(s[('a', 0)], (0.5 * (4.0 / 2.0) ** 0.5 + 3.0) * 0.1)
+        self.assertAlmostEqual(s[('b', 0)], 0.5 * (2.0 / 4.0) ** 0.5 * 0.2)
+        budget = quantities.budget(q)
+        self.assertAlmostEqual(budget.number, sum(c * c for c in s.values()) ** 0.5)
+        names = [name for name, share in quantities.contributions(q)]
+        self.assertEqual(names, ['a', '3.0', 'b'])
+        self.assertAlmostEqual(sum(share for name, share in quantities.contributions(q)), 1.0)
+
+    def test_fold(self):
+        q = Q.literal("3.0") * self.a + Q(1.0, '', Units(m=1), 0.1)
+        folded = quantities.fold_sensitivity(q, ('c', 0))
+        self.assertEqual(sorted(folded), [('a', 0), ('c', 0)])
+        self.assertAlmostEqual(folded[('c', 0)], ((2.0 * 0.1) ** 2 + 0.1 ** 2) ** 0.5)
+        self.assertEqual(quantities.fold_sensitivity(Q(2), ('c', 0)), {})
+
+class provenance_TestCase(unittest.TestCase):
+    def test_shared_nodes(self):
+        a = Q(2.0, 'a', Units(m=1), 0.1)
+        b = Q(3.0, 'b', Units(m=1), 0.2)
+        q = a * b + a * b
+        self.assertTrue(q.provenance[0] is q.provenance[1])
+        self.assertEqual(quantities.provenance_size(q), 4)
+        self.assertTrue(quantities.exp(a / b) is quantities.exp(a / b))
+        self.assertEqual(quantities.provenance_size(quantities.sumover(a, b, a, a * b / b)), 5)
+
+    def test_limits(self):
+        a = Q(2.0, 'a', Units(m=1), 0.1)
+        q = a
+        for i in range(1000):
+            q = q + Q(1.0, '', Units(m=1), 0.1)
+        self.assertEqual(quantities.provenance_size(q, 10), 11)
+        self.assertEqual(quantities.provenance_depth(q), 1000)
+        self.assertEqual(quantities.provenance_depth(a * a * a), 2)
+
+    def test_exact_power(self):
+        self.assertEqual(((Q(10) ** Q(10)) ** Q(2)).number, 10 ** 20)
+        with self.assertRaises(quantities.QuantError) as cm:
+            Q(10 ** 200) ** Q(10)
+        self.assertIn("about 2000 digits", cm.exception.args[0][0])
+        with self.assertRaises(quantities.QuantError):
+            Q(Fraction(1, 10 ** 200)) ** Q(-10)
+        self.assertEqual((Q(10 ** 200) ** Q(-10)).number, 0.0)
+
+    def test_sumover_like_sum(self):
+        a = [Q(0.1 * i, 'q%d' % i, Units(m=1), 0.01 * i, ['cm'] if i % 2 else ['mm']) for i in range(1, 30)]
+        total = sum(a, Q.from_float(0.0))
+        for q in [quantities.sumover(*a), quantities.average(*a)]:
+            if q.name.startswith("\\mathrm{average}"):
+                total = total / Q.from_float(len(a))
+            self.assertEqual((q.units, q.prefu), (total.units, total.prefu))
+            self.assertAlmostEqual(q.number, total.number)
+            self.assertAlmostEqual(q.uncert, total.uncert)
+            for key, c in quantities.sensitivities(total).items():
+                self.assertAlmostEqual(quantities.sensitivities(q)[key], c)
+
+    @unittest.skipIf(resource is None, "no resource module")
+    def test_sumover_memory_ceiling(self):
+        """Adding up 10000 known quantities needs less than 20 MB (measured in a fresh process)"""
+        script = ("import resource; from quantities import Q, Units, sumover;"
+                  "a = [Q(1.0, 'q%d' % i, Units(m=1), 0.1) for i in range(10000)];"
+                  "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;"
+                  "s = sumover(*a);"
+                  "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)")
+        growth = int(subprocess.check_output([sys.executable, "-c", script]))  # kilobytes on Linux
+        self.assertTrue(growth < 20000, growth)
+        a = [Q(1.0, 'q%d' % i, Units(m=1), 0.1) for i in range(1000)]
+        gc.collect()
+        before = len(gc.get_objects())
+        s = quantities.sumover(*a)
+        gc.collect()
+        self.assertTrue(len(gc.get_objects()) - before <= 4)  # s, its provenance and sensitivity
+
+
+class aggregates_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.x = [Q(float(i), 'x%d' % i, Units(s=1), 0.1) for i in range(1, 6)]
+        self.y = [Q(2.0 * i + 1.0 + (0.1 if i % 2 else -0.1), 'y%d' % i, Units(m=1), 0.1) for i in range(1, 6)]
+
+    def test_compensated_sum(self):
+        a = [Q(1e16, 'a'), Q(1.0, 'b'), Q(-1e16, 'c')]
+        self.assertEqual(quantities.sumover(*a).number, 1.0)
+        self.assertEqual(quantities.average(*a).number, 1.0 / 3)
+
+    def test_stdev_median(self):
+        s = quantities.stdev(*self.x)
+        self.assertAlmostEqual(s.number, 2.5 ** 0.5)
+        self.assertAlmostEqual(s.uncert, s.number / 8 ** 0.5)
+        self.assertTrue(s.units is Units(s=1))
+        self.assertEqual(quantities.median(*self.x).number, 3.0)
+        m = quantities.median(*self.x[1:])
+        self.assertEqual((m.number, quantities.sensitivities(m)), (3.5, {('x3', 0): 0.05, ('x4', 0): 0.05}))
+        with self.assertRaises(quantities.QuantError):
+            quantities.stdev(self.x[0])
+        with self.assertRaises(quantities.QuantError):
+            quantities.median(self.x[0], self.y[0])
+
+    def test_linfit(self):
+        slope, intercept = quantities.linfit(*(self.x + self.y))
+        self.assertAlmostEqual(slope.number, 2.0)
+        self.assertAlmostEqual(intercept.number, 1.02)
+        self.assertTrue(slope.units is Units(m=1, s=-1))
+        self.assertTrue(0 < slope.uncert < 0.1 and 0 < intercept.uncert < 0.5)
+        self.assertEqual(quantities.slope(*(self.x + self.y)).number, slope.number)
+        with self.assertRaises(quantities.QuantError):
+            quantities.linfit(*(self.x + self.y[1:]))
+
+    @unittest.skipIf(quantities.numpy is None, "NumPy is not installed")
+    def test_arrays(self):
+        x = quantities.QArray([1.0, 2.0, 3.0, 4.0, 5.0], "", Units(s=1), 0.1)
+        self.assertAlmostEqual(quantities.stdev(x).number, 2.5 ** 0.5)
+        self.assertEqual(quantities.median(x).number, 3.0)
+        y = quantities.QArray([q.number for q in self.y], "", Units(m=1), 0.1)
+        self.assertAlmostEqual(quantities.slope(x, y).number, 2.0)
+
+
+class UnitRegistry_TestCase(unittest.TestCase):
+    def test_same_as_cross_product(self):
+        known, prefices = quantities.known_units, quantities.metric_prefices
+        for unit in known:
+            names = [(unit, known[unit][0])]
+            if unit not in ["cm", "h", "d", "atm", "kg", "min", "mmHg", "$"]:
+                names.extend((prefix + unit, known[unit][0] * prefices[prefix]) for prefix in prefices)
+            for name, number in names:
+                self.assertTrue(name in unitquant)
+                q = unitquant[name]
+                self.assertEqual((q.number, type(q.number), q.name, q.units, q.prefu),
+                                 (number, type(number), name, known[unit][1], frozenset([name])))
+                self.assertIs(unitquant.get(name), q)
+        for name in ["kcm", "mmin", "x", "", "mass", "Ohm"]:
+            self.assertFalse(name in unitquant)
+            self.assertIsNone(unitquant.get(name))
+            self.assertRaises(KeyError, lambda: unitquant[name])
+
+    def test_lazy(self):
+        registry = quantities.UnitRegistry(quantities.known_units, quantities.metric_prefices, ["h"])
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry["uL"].number, quantities.known_units["L"][0] / 1000000)
+        self.assertEqual(sorted(registry), ["uL"])
+
+    def test_load(self):
+        registry = quantities.UnitRegistry(dict(quantities.known_units), quantities.metric_prefices, [])
+        registry.load("""# pressure
+                         bar  100000     kg m^-1 s^-2
+                         Torr 101325/760 kg m^-1 s^-2 noprefix
+                         """)
+        self.assertEqual((registry["kbar"].number, registry["kbar"].units), (100000000, Units(kg=1, m=-1, s=-2)))
+        self.assertEqual(registry["Torr"].number, Fraction(101325, 760))
+        self.assertFalse("mTorr" in registry)
+        self.assertRaises(ValueError, registry.load, "foo 1 furlong")
+
+
+class unit_string_TestCase(unittest.TestCase):
+    def test_same_as_greedy_search(self):
+        prefus = [{'M', 'L', 'J', 'C', 'V', 'N', 'W', 'Pa'}, {'mL', 'L', 'kJ', 'V'}, {'kJ', 'V', 'A', 's'},
+                  {'g', 'mg', 'cm', 'mol', 'mmol'}, {'J', 'kJ', 'K', 'mol'}, {'atm', 'L', 'mol', 'K'}, set()]
+        units = [Units(m=-3, mol=1), Units(kg=1, m=2, s=-2, mol=-1, K=-1), Units(A=1, s=1), Units(kg=1, m=-1, s=-2),
+                 Units(kg=1), Units(m=3), Units(A=-1, kg=1, m=2, s=-3), Units(kg=1, m=2, s=-3), Units(m=Fraction(1, 2)),
+                 Units(kg=2, m=4, s=-4), Units(mol=-1)]
+        for prefu in prefus:
+            for u in units:
+                for value in [1e-9, 0.0034, 1, 2.5, Fraction(3, 7), 42, 6.02e23, -17.5]:
+                    quantities.unit_layouts.clear()
+                    self.assertEqual(repr(quantities.unit_string(value, u, prefu)),
+                                     repr(greedy_unit_string(value, u, prefu)))
+                    self.assertEqual(repr(quantities.unit_string(value, u, prefu)),
+                                     repr(greedy_unit_string(value, u, prefu)))
+
+
+def greedy_unit_string(value, units, prefu):
+    """unit_string() as it was before unit_layouts, to check that the output did not change"""
+    if units == unity or not value:
+        return value, "", ""
+    SIunits = list(units)
+    derived = dict((pu, 0) for pu in prefu if sum(abs(t) for t in unitquant[pu].units) > 1)
+    while (1 and derived):
+        (improvement, d, sign) = max(try_all_derived(SIunits, derived))
+        if improvement <= 0:
+            break
+        derived[d] += sign
+        for i, used_in_derived in enumerate(unitquant[d].units):
+            SIunits[i] -= used_in_derived * sign
+        value /= unitquant[d].number ** sign
+    if derived.get('V') == 0 and derived.get('kJ') == 0 and SIunits[0] == 1 and SIunits[3] == 1:
+        derived['V'] -= 1
+        derived['kJ'] += 1
+        SIunits[0] = 0
+        SIunits[3] = 0
+        value /= 1000
+    allunits = dict([(x,derived[x]) for x in derived if derived[x]])
+    DUS = [du for du in allunits if du in derived]
+    for DU in DUS:
+        choices = [pu for pu in derived if unitquant[pu].units == unitquant[DU].units]
+        if not choices:
+            break
+        quality = [(abs(math_log10(abs(value) / (unitquant[c].number/unitquant[DU].number) ** allunits[DU])-1.0), c) for c in choices]
+        best = min(quality)[1]
+        if best != DU:
+            allunits[best] = allunits[DU]
+            value /= (unitquant[best].number/unitquant[DU].number) ** allunits[best]
+            allunits[DU] = 0
+    for i, SIU in enumerate(SIunit_symbols):
+        if not SIunits[i]:
+            continue
+        choices = [pu for pu in prefu if (pu not in derived) and unitquant[pu].units[i]]
+        if not choices:
+            break
+        quality = [(abs(math_log10(abs(value) / unitquant[c].number ** (SIunits[i] / unitquant[c].units[i]))-1.0), c) for c in choices]
+        best = min(quality)[1]
+        allunits[best] = Fraction(SIunits[i],unitquant[best].units[i])
+        if allunits[best].denominator == 1:
+            allunits[best] = int(allunits[best])
+        SIunits[i] = 0
+        value /= unitquant[best].number ** allunits[best]
+    for u, d in zip(SIunit_symbols, SIunits):
+        if d:
+            allunits[u] = d
+    poslist = [(u,exp) for u, exp in allunits.items() if exp > 0]
+    neglist = [(u,-exp) for u, exp in allunits.items() if exp < 0]
+    return value, poslist, neglist
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=110)
 
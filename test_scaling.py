@@ -0,0 +1,35 @@
+__author__ = 'Karsten Theis'
+
+import unittest
+import scaling
+from calculator import calc
+
+
+class Scaling_TestCase(unittest.TestCase):
+    def test_worksheet(self):
+        for notation in scaling.notations:
+            commands = scaling.worksheet(lines=5, symbols=7, depth=2, units=3, terms=3, notation=notation)
+            lines = commands.split("\n")
+            self.assertEqual(len([a for a in lines if a.startswith("x")]), 7)
+            self.assertEqual(len([a for a in lines if a.startswith("r")]), 5)
+            self.assertTrue(lines[-1].startswith("r4 = sumover(((r3 + "))
+            self.assertEqual(calc("", commands, False)[5], commands)
+        self.assertEqual(scaling.worksheet(seed=1), scaling.worksheet(seed=1))
+        with self.assertRaises(ValueError):
+            scaling.worksheet(units=len(scaling.unit_names) + 1)
+
+    def test_slope(self):
+        self.assertAlmostEqual(scaling.slope([1, 2, 4, 8], [3, 12, 48, 192]), 2.0)
+        self.assertAlmostEqual(scaling.slope([10, 20, 40], [5, 10, 20]), 1.0)
+        self.assertIsNone(scaling.slope([10], [5]))
+
+    def test_vary(self):
+        result = scaling.vary("lines", [2, 4], repeat=1, symbols=4, depth=1)
+        self.assertEqual(result["errors"], [None, None])
+        self.assertTrue(result["objects"][0] < result["objects"][1])
+        self.assertIn("lines: time ~ n^", scaling.report([result]))
+        self.assertTrue(scaling.csv([result]).startswith("parameter,value,seconds,objects,kib\nlines,2,"))
+
+
+if __name__ == '__main__':
+    unittest.main()
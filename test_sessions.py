@@ -0,0 +1,104 @@
+__author__ = 'Karsten Theis'
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from calculator import calc
+from sessions import SessionStore
+
+
+class SessionStore_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sessions.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_commands(self, store, sid, commands):
+        state = store.load(sid, 'ipud')
+        logbook, inputlog = store.logs(sid)
+        outp, logp, mem, known, oneline, good_input, linespace = calc(state, commands, 'ipud')
+        store.save(sid, state, logbook + "\n".join(logp), inputlog + good_input)
+        return outp, mem, known
+
+    def test_survives_restart(self):
+        store = SessionStore(self.path)
+        sid = store.new_id()
+        outp, mem, known = self.run_commands(store, sid, "a = 3.0 m\nb = 2 a")
+        self.assertEqual(mem, [])
+        self.assertEqual(known, ['a = 3.0 m', 'b = 6.0 m'])
+        store = SessionStore(self.path)
+        outp, mem, known = self.run_commands(store, sid, "c = a + b")
+        self.assertEqual(known, ['a = 3.0 m', 'b = 6.0 m', 'c = 9.0 m'])
+        self.assertTrue(store.logs(sid)[1].endswith("c = a + b"))
+
+    def test_only_changes_are_written(self):
+        store = SessionStore(self.path)
+        sid = store.new_id()
+        self.run_commands(store, sid, "a = 3.0 m\nb = 2 a")
+        state = store.load(sid, 'ipud')
+        calc(state, "b = 3 a", 'ipud')
+        self.assertEqual(state.changed, {'b'})
+
+    def test_bad_id(self):
+        store = SessionStore(self.path)
+        self.assertNotEqual(store.valid_id("../../etc"), "../../etc")
+        chosen = "0123456789abcdef" * 2
+        self.assertNotEqual(store.valid_id(chosen), chosen)
+        sid = store.new_id()
+        self.run_commands(store, sid, "a = 3.0 m")
+        self.assertEqual(SessionStore(self.path).valid_id(sid), sid)
+
+    def test_requests_take_turns(self):
+        store = SessionStore(self.path)
+        sid = store.new_id()
+        self.run_commands(store, sid, "n = 0")
+
+        def increment():
+            for i in range(20):
+                with store.locked(sid):
+                    self.run_commands(store, sid, "n = n + 1")
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(store.load(sid, 'ipud')['n'].number, 80)
+        self.assertIs(store.locked(sid), store.locked(sid))
+
+    @unittest.skipIf(not hasattr(os, "fork"), "no fork()")
+    def test_processes_take_turns(self):
+        sid = SessionStore(self.path).new_id()
+        self.run_commands(SessionStore(self.path), sid, "n = 0")
+        children = []
+        for p in range(3):
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    store = SessionStore(self.path)  # as in server.serve_preforked, one for each process
+                    for i in range(10):
+                        with store.locked(sid):
+                            self.run_commands(store, sid, "n = n + 1")
+                    status = 0
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        self.assertEqual([os.waitpid(pid, 0)[1] for pid in children], [0, 0, 0])
+        self.assertEqual(SessionStore(self.path).load(sid, 'ipud')['n'].number, 30)
+
+    def test_cached_state_is_checked(self):
+        first, second = SessionStore(self.path), SessionStore(self.path)
+        sid = first.new_id()
+        self.run_commands(first, sid, "a = 1")
+        self.run_commands(second, sid, "a = 2")
+        self.assertEqual(first.load(sid, 'ipud')['a'].number, 2)
+        self.assertEqual(first.logs(sid)[1], "a = 1a = 2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# coding=utf-8
+__author__ = 'Karsten Theis'
+
+import os
+import shutil
+import tempfile
+import unittest
+from fractions import Fraction
+from collections import OrderedDict
+import statecodec
+from calculator import State
+from quantities import Q, Units
+
+
+class Codec_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.symbols = OrderedDict()
+        self.symbols[u'c[Na+]'] = Q(0.025, u'c[Na+]', Units(m=-3, mol=1), 0.0001, [u'M'])
+        self.symbols[u'μ'] = Q(Fraction(3, 7), u'μ', Units(m=Fraction(1, 2)), 0.0, [u'm', u'μm'])
+        self.symbols[u'n'] = Q(10 ** 40, u'n')
+
+    def test_round_trip(self):
+        symbols, flags = statecodec.decode(statecodec.encode(self.symbols, {u'__tutor__'}))
+        self.assertEqual(flags, {u'__tutor__'})
+        self.assertEqual([s for s, q in symbols], list(self.symbols))
+        for sym, q in symbols:
+            old = self.symbols[sym]
+            self.assertEqual((q.number, type(q.number), q.units, q.uncert, q.prefu, q.name),
+                             (old.number, type(old.number), old.units, old.uncert, old.prefu, old.name))
+
+    def test_sensitivity(self):
+        sensitivity = {(u'c[Na+]', 0): 0.05, (u'x', 0): 0.01, (u'x', 1): 0.02}
+        self.symbols[u'x'] = Q(2.0, u'x', Units(), 0.1, sensitivity=sensitivity)
+        self.symbols[u'y'] = Q(2.0, u'y', Units(), 0.1, sensitivity={(u'y', 0): 0.1})
+        symbols = dict(statecodec.decode(statecodec.encode(self.symbols, set()))[0])
+        self.assertEqual(symbols[u'x'].sensitivity, sensitivity)
+        self.assertEqual(symbols[u'y'].sensitivity, None)
+        self.assertEqual(statecodec.loads(u'x', statecodec.dumps(self.symbols[u'x'])).sensitivity, sensitivity)
+        self.assertEqual(statecodec.decode_sensitivity([[[u'x', 0.01]]]), {(u'x', 0): 0.01})  # version 2
+
+    def test_tampering(self):
+        text = statecodec.encode(self.symbols, set())
+        head, body, signature = text.split(".")
+        forged = ".".join([head, statecodec.b64encode(statecodec.b64decode(body)[::-1]), signature])
+        with self.assertRaises(statecodec.CodecError):
+            statecodec.decode(forged)
+        with self.assertRaises(statecodec.CodecError):
+            statecodec.decode("PQ9.abc.def")
+
+    def test_legacy(self):
+        with self.assertRaises(statecodec.CodecError):
+            statecodec.decode_legacy("Q(2.5, 'a', Units(), 0.1)")
+        state = State("Q(2.5, 'a', Units(), 0.1)")
+        self.assertEqual(list(state), [])
+        self.assertIn("not accepted", state.output[0])
+        statecodec.legacy = True
+        self.addCleanup(setattr, statecodec, 'legacy', False)
+        symbols, flags = statecodec.decode_legacy(
+            "Q(2.5, 'a', Units(), 0.1)\r\n__tutor__\nQ(3000.0, 'c', Units(m=-3,mol=1), 0.0, set([u'L', u'mol']))\n"
+            "Q(Fraction(3, 7), 'f', Units(m=Fraction(1, 2)), 0.0)")
+        self.assertEqual([s for s, q in symbols], ['a', 'c', 'f'])
+        self.assertEqual(flags, {'__tutor__'})
+        self.assertEqual((symbols[1][1].units, symbols[1][1].prefu), (Units(m=-3, mol=1), {'L', 'mol'}))
+        self.assertEqual(symbols[2][1].number, Fraction(3, 7))
+        for text in ["__import__('os').system('true')", "Q(2, 'a', Units(), (lambda: 0.1)())",
+                     "Q(2, 'a', Units(), 0.1, set([]), [].__class__)", "Q(2.0, units=Units(), uncert=0.0)", "a = 2"]:
+            with self.assertRaises(statecodec.CodecError):
+                statecodec.decode_legacy(text)
+
+    def test_secret_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "secret")
+            key = statecodec.load_secret(path)
+            self.assertEqual(len(key), 64)
+            self.assertEqual(statecodec.load_secret(path), key)
+            self.assertEqual(os.listdir(directory), ["secret"])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+__author__ = 'Karsten Theis'
+
+import time
+import unittest
+import metrics
+import workers
+from calculator import calc, State
+
+
+class Pool_TestCase(unittest.TestCase):
+    worksheet = "T = 298 K\nn = 2 mol\nR = 8.314 J/(mol K)\nvol = 3 L\nP = n R T / vol"
+
+    def setUp(self):
+        self.pool = workers.Pool(size=1, queue_depth=0, timeout=10.0)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_same_as_calc(self):
+        for mob in [False, 'ipud']:
+            self.assertEqual(self.pool.calc("", self.worksheet, mob), calc("", self.worksheet, mob))
+        memory = calc("", self.worksheet, False)[2][0]
+        self.assertEqual(self.pool.calc(memory, "x = P * 2", False), calc(memory, "x = P * 2", False))
+
+    def test_state(self):
+        state = State(None, False)
+        outp, logp, mem, known, oneline, good_input, linespace = self.pool.calc(state, self.worksheet, False)
+        self.assertEqual((list(state), mem), (['T', 'n', 'R', 'vol', 'P'], []))
+        state.changed.clear()
+        self.pool.calc(state, "__showuncert__ = 1\nn = 3 mol", False)
+        self.assertEqual((state.changed, state['n'].number), ({'n'}, 3))
+        self.assertIn('__showuncert__', state.flags)
+
+    def test_timeout(self):
+        self.pool.timeout = 0.0001
+        with self.assertRaises(workers.PoolError):
+            self.pool.calc("", self.worksheet, False)
+        self.pool.timeout = 10.0
+        self.assertEqual(self.pool.calc("", "a = 2", False)[5], "a = 2")  # a new worker, if that one was killed
+
+    def test_dead_worker(self):
+        worker = self.pool.idle.get()
+        worker.kill()
+        worker.wait()
+        self.pool.idle.put(worker)
+        with self.assertRaises(workers.PoolError):
+            self.pool.calc("", "a = 2", False)
+        self.assertEqual(self.pool.calc("", "a = 2", False)[5], "a = 2")
+        self.assertEqual(self.pool.idle.qsize(), self.pool.size)
+
+    def test_waited_too_long(self):
+        get = self.pool.idle.get
+        waited = []
+
+        def slow_get(timeout):
+            worker = get(timeout=timeout)
+            waited.append(worker)
+            time.sleep(0.3)
+            return worker
+        self.pool.idle.get = slow_get
+        self.pool.timeout = 0.5
+        with self.assertRaises(workers.PoolError) as cm:
+            self.pool.calc("", "a = 2", False)
+        self.assertIn("busy", cm.exception.args[0])
+        self.assertIsNone(waited[0].poll())
+        self.assertIs(self.pool.idle.get_nowait(), waited[0])
+        self.pool.idle.put(waited[0])
+
+    def test_failed_start(self):
+        started = []
+        popen = workers.subprocess.Popen
+
+        def record(*args, **kwargs):
+            started.append(popen(*args, **kwargs))
+            return started[-1]
+        timeout, workers.startup_timeout = workers.startup_timeout, 0.0
+        workers.subprocess.Popen = record
+        try:
+            with self.assertRaises(workers.PoolError):
+                self.pool.start()
+        finally:
+            workers.subprocess.Popen = popen
+            workers.startup_timeout = timeout
+        self.assertIsNotNone(started[0].poll())
+
+    def test_backfill(self):
+        timeout, delay = workers.startup_timeout, workers.retry_delay
+        workers.startup_timeout, workers.retry_delay = 0.0, 0.1
+        try:
+            pool = workers.Pool(size=1, queue_depth=0, timeout=10.0)  # its worker is started in the background
+        finally:
+            workers.startup_timeout = timeout
+        try:
+            self.assertEqual(pool.calc("", "a = 2", False)[5], "a = 2")
+        finally:
+            workers.retry_delay = delay
+            pool.close()
+
+    def test_stage_timings(self):
+        enabled, stages = metrics.enabled, dict(metrics.stages)
+        metrics.stages.clear()
+        try:
+            for on, count in [(True, 1), (False, 1)]:
+                metrics.enable(on)  # for the workers started from now on
+                pool = workers.Pool(size=1, queue_depth=0, timeout=10.0)
+                try:
+                    pool.calc("", self.worksheet, False)
+                finally:
+                    pool.close()
+                self.assertEqual((metrics.stages["calc"].count, metrics.stages["lex"].count), (count, 5 * count))
+        finally:
+            metrics.enable(enabled)
+            metrics.stages.clear()
+            metrics.stages.update(stages)
+
+    def test_busy(self):
+        self.pool.slots.acquire()
+        try:
+            with self.assertRaises(workers.PoolError) as cm:
+                self.pool.calc("", "a = 2", False)
+            self.assertIn("busy", cm.exception.args[0])
+        finally:
+            self.pool.slots.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
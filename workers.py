@@ -0,0 +1,264 @@
+# coding=utf-8
+"""
+A pool of worker processes running calc() for the server, so that calculations use more than one core and a
+calculation that takes too long can be stopped.
+
+Each worker is a Python process running this module. It imports the calculator and warms up its caches once, then
+answers requests one at a time for as long as it lives, keeping its caches. Requests and results go through the
+pipes of the worker as marshal data, each preceded by its length. A worker that does not answer within the timeout is
+killed, and a new one is started in the background (as is one that failed to start), so that the pool keeps its size.
+Requests beyond the size of the pool wait for a free worker; if more than queue_depth are waiting, or a worker doesn't
+become free in time to do the calculation, PoolError is raised.
+
+The stages timed in a worker while it calculates (see metrics.py) are sent back with the result and added to the
+histograms of the server. The workers time their stages if the server did when they were started.
+
+Memory sent to a worker is the text written by statecodec.encode(). The workers use the HMAC key of the server,
+which is the first thing sent to them. A State kept on the server (see sessions.py) is encoded for the worker, and
+the quantities the worker changed are put back into it.
+
+Example:
+  pool = Pool(size=4, queue_depth=8, timeout=10.0)
+  outp, logp, mem, known, oneline, good_input, linespace = pool.calc(memory, commands, mob)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import marshal
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+from timeit import default_timer
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import metrics
+import statecodec
+from calculator import calc, State
+
+header = struct.Struct(">I")
+
+startup_timeout = 30.0  # seconds for a new worker to import the calculator and warm up
+retry_delay = 1.0  # seconds between attempts to start a worker
+least_time = 0.5  # seconds a calculation gets at least; a request that waited longer for a worker is turned away
+
+
+class PoolError(RuntimeError):
+    """Raised when a calculation could not be done in time, or by a worker at all"""
+    pass
+
+
+def write_frame(f, data):
+    """Writes data in the marshal format to the file f, preceded by its length"""
+    body = marshal.dumps(data, 2)
+    f.write(header.pack(len(body)) + body)
+    f.flush()
+
+
+def read_exactly(fd, n, deadline):
+    """
+    :param fd: file descriptor to read from
+    :param n: number of bytes to read
+    :param deadline: time (default_timer()) after which to give up, or None to wait as long as it takes
+    :return: the bytes read
+    :raise PoolError: if the deadline passed or the other side closed the pipe
+    """
+    chunks = []
+    while n:
+        if deadline is not None:
+            remaining = deadline - default_timer()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise PoolError("Sorry, the calculation took too long")
+        chunk = os.read(fd, n)
+        if not chunk:
+            raise PoolError("Sorry, the calculation failed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(fd, deadline=None):
+    """Reads data written by write_frame() from the file descriptor fd"""
+    n, = header.unpack(read_exactly(fd, header.size, deadline))
+    return marshal.loads(read_exactly(fd, n, deadline))
+
+
+class Pool(object):
+    """Worker processes running calc(), each one busy with at most one request.
+
+    Attributes:
+      size(int): number of worker processes
+      timeout(float): seconds a request may take, including the time waiting for a free worker
+      idle(Queue): workers waiting for a request
+      slots(Semaphore): requests that may be in the pool at once, running or waiting (size + queue_depth)
+      closed(bool): set by close(), after which workers started in the background are stopped right away
+    """
+
+    def __init__(self, size=2, queue_depth=4, timeout=10.0):
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue()
+        self.slots = threading.Semaphore(size + queue_depth)
+        self.closed = False
+        for i in range(size):
+            try:
+                self.idle.put(self.start())
+            except PoolError:
+                self.replace()
+
+    def start(self):
+        """
+        Starts a worker and waits until it has warmed up
+
+        :return: the worker process
+        :raise PoolError: if the worker could not be started, in which case it is killed
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PQCALC_METRICS="1" if metrics.enabled else "")  # read when the worker imports metrics
+        worker = subprocess.Popen([sys.executable, os.path.join(here, "workers.py")], cwd=here, close_fds=True,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        try:
+            write_frame(worker.stdin, statecodec.secret)
+            ready = read_frame(worker.stdout.fileno(), default_timer() + startup_timeout)
+        except (PoolError, IOError, OSError, EOFError, ValueError):
+            ready = None
+        if ready != "ready":
+            self.stop(worker)
+            raise PoolError("worker did not start")
+        return worker
+
+    def replace(self):
+        """Starts a worker in the background, trying again until it works, and adds it to the idle workers"""
+        thread = threading.Thread(target=self.backfill)
+        thread.daemon = True
+        thread.start()
+
+    def backfill(self):
+        while not self.closed:
+            try:
+                worker = self.start()
+            except PoolError:
+                time.sleep(retry_delay)
+                continue
+            if self.closed:
+                self.stop(worker)
+            else:
+                self.idle.put(worker)
+            return
+
+    def stop(self, worker):
+        if worker.poll() is None:
+            worker.kill()
+        worker.wait()
+        worker.stdin.close()
+        worker.stdout.close()
+
+    def close(self):
+        """Stops the workers that are idle (all of them, once no request is running)"""
+        self.closed = True
+        while True:
+            try:
+                self.stop(self.idle.get_nowait())
+            except Empty:
+                return
+
+    @metrics.timed("pool")
+    def calc(self, memory, commands, mob):
+        """
+        Same as calculator.calc(), in a worker process
+
+        :param memory: quantities already defined, as written by statecodec.encode(), or a State kept on the server
+        :param commands: string of user input specifying math operations to define new quantities
+        :param mob: device the output will be sent to (determines format)
+        :return: what calc() returns
+        :raise PoolError: if too many requests are waiting, or the calculation was not done in time
+        """
+        if not self.slots.acquire(False):
+            raise PoolError("Sorry, the calculator is busy, please try again")
+        try:
+            deadline = default_timer() + self.timeout
+            try:
+                worker = self.idle.get(timeout=self.timeout)
+            except Empty:
+                raise PoolError("Sorry, the calculator is busy, please try again")
+            if deadline - default_timer() < min(least_time, self.timeout / 2):
+                self.idle.put(worker)
+                raise PoolError("Sorry, the calculator is busy, please try again")
+            state = memory if isinstance(memory, State) else None
+            text = statecodec.encode(state, state.flags) if state is not None else memory
+            try:
+                write_frame(worker.stdin, (text, commands, mob))
+                reply = read_frame(worker.stdout.fileno(), deadline)
+            except PoolError:
+                self.stop(worker)
+                self.replace()
+                raise
+            except (IOError, OSError, EOFError, ValueError):  # the worker died
+                self.stop(worker)
+                self.replace()
+                raise PoolError("Sorry, the calculation failed")
+            self.idle.put(worker)
+        finally:
+            self.slots.release()
+        metrics.merge(reply[2])
+        if reply[0] == "error":
+            raise PoolError(reply[1])
+        outp, logp, mem, known, oneline, good_input, linespace, changed = reply[1]
+        if state is None:
+            return outp, logp, mem, known, oneline, good_input, linespace
+        symbols, flags = statecodec.decode(mem[0])
+        state.flags = set(flags)
+        for sym, q in symbols:
+            if sym in changed:
+                state[sym] = q
+        return outp, logp, [], known, oneline, good_input, linespace
+
+
+def run(memory, commands, mob):
+    """calc() as a worker runs it: the memory is encoded again after the calculation, and the names of the
+    quantities that changed are added to the result"""
+    state = State(memory, mob)
+    outp, logp, mem, known, oneline, good_input, linespace = calc(state, commands, mob)
+    return (outp, logp, [statecodec.encode(state, state.flags)], known, oneline, good_input, linespace,
+            sorted(state.changed))
+
+
+def serve(inp, out):
+    """
+    Answers requests from the pool, one at a time, until the pool closes the pipe. The timings of each calculation
+    follow its result (see metrics.snapshot).
+
+    :param inp: file the requests come from
+    :param out: file the results go to
+    """
+    statecodec.secret = read_frame(inp.fileno())
+    calc("", "x = 1.0 m\ny = x^2", False)
+    write_frame(out, "ready")
+    while True:
+        try:
+            memory, commands, mob = read_frame(inp.fileno())
+        except PoolError:
+            return
+        metrics.reset()
+        try:
+            reply = ("ok", run(memory, commands, mob))
+        except Exception as err:
+            reply = ("error", "Sorry, the calculation failed: %s" % err)
+        write_frame(out, reply + (metrics.snapshot(),))
+
+
+if __name__ == "__main__":
+    # results go to the original stdout, anything printed by the calculator to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin, results)